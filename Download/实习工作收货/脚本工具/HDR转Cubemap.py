@@ -1,47 +1,266 @@
+import time
+_T_START = time.perf_counter()
 import os
 import sys
+import io
+import glob
+import math
+import mmap
+import hashlib
+import argparse
+import importlib
+import importlib.util
+import contextlib
+import threading
+import traceback
 import subprocess
-
-def auto_install_deps():
-    need = []
-    try:
-        import numpy
-    except ImportError:
-        need.append("numpy")
-    try:
-        import PIL
-    except ImportError:
-        need.append("pillow")
-    try:
-        import imageio
-    except ImportError:
-        need.append("imageio")
-    try:
-        import PyQt5
-    except ImportError:
-        need.append("pyqt5")
-    try:
-        import av
-    except ImportError:
-        need.append("imageio[pyav]")
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# 设置 HDR2CUBE_PROFILE_IMPORTS=1 时打印各依赖的导入耗时和启动各阶段的时间点
+PROFILE_IMPORTS = os.environ.get("HDR2CUBE_PROFILE_IMPORTS", "") not in ("", "0")
+
+def profile_mark(label, seconds=None):
+    if PROFILE_IMPORTS:
+        extra = f"{seconds * 1000:7.1f} ms，" if seconds is not None else ""
+        print(f"[启动耗时] {label}: {extra}进程启动后 {(time.perf_counter() - _T_START) * 1000:.1f} ms", flush=True)
+
+# (pip 包名, import 名)；只用 find_spec 检查是否已安装，不真正导入
+REQUIRED_PACKAGES = (("numpy", "numpy"), ("pillow", "PIL"), ("imageio", "imageio"), ("imageio[pyav]", "av"))
+# 只有窗口模式需要；命令行批量模式在无 Qt 的环境 (服务器、CI) 也能跑
+GUI_PACKAGES = (("pyqt5", "PyQt5"),)
+# 检查通过后写入的标记文件，按 Python 解释器区分；之后启动不再检查，除非带 --check-deps
+DEPS_MARKER = os.path.join(os.path.expanduser("~"), ".cache", "hdr2cubemap",
+                           "deps_ok_" + hashlib.md5(f"{sys.executable}|{sys.version}".encode()).hexdigest()[:12])
+
+def auto_install_deps(gui=True):
+    packages = REQUIRED_PACKAGES + (GUI_PACKAGES if gui else ())
+    need = [pkg for pkg, module in packages if importlib.util.find_spec(module) is None]
     if need:
         print(f"[INFO] 正在为你自动安装: {' '.join(need)}")
     for pkg in need:
         subprocess.check_call([sys.executable, "-m", "pip", "install", pkg])
 
-auto_install_deps()
-
-import numpy as np
-from PIL import Image
-import imageio.v3 as iio
-from PyQt5 import QtWidgets, QtCore, QtGui
-import threading
+def ensure_deps(force=False, gui=True):
+    """只在首次运行 (没有标记文件) 或显式 --check-deps 时检查依赖；窗口模式的标记同时覆盖命令行模式"""
+    marker = DEPS_MARKER if gui else DEPS_MARKER + "_cli"
+    if not force and (os.path.exists(DEPS_MARKER) or os.path.exists(marker)):
+        return
+    t0 = time.perf_counter()
+    auto_install_deps(gui)
+    try:
+        os.makedirs(os.path.dirname(marker), exist_ok=True)
+        with open(marker, "w") as f:
+            f.write(sys.executable + "\n")
+    except OSError:
+        pass  # 写不了标记只是下次再检查一遍
+    profile_mark("依赖检查", time.perf_counter() - t0)
+
+class LazyModule:
+    """首次访问属性时才真正 import，随后把模块全局变量直接换成真模块，之后没有额外开销"""
+    _lock = threading.Lock()
+
+    def __init__(self, global_name, module_name):
+        self._global_name = global_name
+        self._module_name = module_name
+
+    def __getattr__(self, attr):
+        with LazyModule._lock:
+            t0 = time.perf_counter()
+            module = importlib.import_module(self._module_name)
+            if globals().get(self._global_name) is self:
+                globals()[self._global_name] = module
+                profile_mark(f"导入 {self._module_name}", time.perf_counter() - t0)
+        return getattr(module, attr)
+
+# 重依赖都延迟到第一次使用：窗口先出来，解码/图像库在后台任务里才加载
+np = LazyModule("np", "numpy")
+Image = LazyModule("Image", "PIL.Image")
+iio = LazyModule("iio", "imageio.v3")
 
 face_names = ['+X', '-X', '+Y', '-Y', '+Z', '-Z']
 
-def read_hdr(path):
+# ------------------------------------------------------------
+# Radiance RGBE (.hdr) 原生解码：mmap + 所有扫描线同步推进的 RLE 解析
+# ------------------------------------------------------------
+RGBE_EXTENSIONS = (".hdr", ".pic", ".rgbe")
+# 每批展开的扫描线数，控制 np.repeat 临时数组大小
+RGBE_BLOCK_ROWS = 256
+# 比这更宽的 .hdr 在 GUI 里先按整数步长降采样解码出预览，再在后台读完整图
+PREVIEW_DECODE_WIDTH = 2048
+_rgbe_scale = None
+
+def rgbe_scale_table():
+    """指数 e -> 2^(e-136)，e=0 表示纯黑 (与 OpenCV / stb_image 的约定一致)"""
+    global _rgbe_scale
+    if _rgbe_scale is None:
+        _rgbe_scale = np.array([0.0] + [math.ldexp(1.0, e - 136) for e in range(1, 256)], dtype=np.float32)
+    return _rgbe_scale
+
+def read_rgbe_header(mm):
+    """解析文件头，返回 (高, 宽, 是否上下翻转, 像素数据起始偏移)；不支持的变体抛 ValueError"""
+    if not (mm[:2] == b"#?"):
+        raise ValueError("不是 Radiance HDR 文件")
+    end = mm.find(b"\n\n")
+    if end < 0:
+        raise ValueError("文件头不完整")
+    for line in mm[:end].split(b"\n")[1:]:
+        if line.startswith(b"FORMAT=") and line.strip() != b"FORMAT=32-bit_rle_rgbe":
+            raise ValueError(f"不支持的像素格式: {line.decode(errors='replace')}")
+    nl = mm.find(b"\n", end + 2)
+    res = mm[end + 2:nl].split()
+    if len(res) != 4 or res[0] not in (b"-Y", b"+Y") or res[2] != b"+X":
+        raise ValueError(f"不支持的扫描线方向: {mm[end + 2:nl]!r}")
+    return int(res[1]), int(res[3]), res[0] == b"+Y", nl + 1
+
+def _rgbe_walk(buf, starts, w, counts=None, lit_diff=None):
+    """从每个候选扫描线起点同时推进 RLE 解析 (每轮每条扫描线前进一个游程)
+
+    返回 (结束位置, 是否合法)。传入 counts / lit_diff 时顺便记录展开方式：
+    重复游程在数据字节处记重复次数，字面游程在 lit_diff 上做差分标记。
+    """
+    size = len(buf)
+    p = starts + 4
+    ok = p < size
+    # 只在仍未解析完的扫描线上运算，解析完 (或出错) 的随时剔除
+    lane = np.flatnonzero(ok)
+    pl = p[lane]
+    n = np.zeros(len(lane), dtype=np.int64)
+    ch = np.zeros(len(lane), dtype=np.int8)
+    while len(lane):
+        cnt = buf[np.minimum(pl, size - 1)].astype(np.int64)
+        rep = cnt > 128
+        length = cnt - 128 * rep
+        nxt = pl + np.where(rep, 2, 1 + cnt)
+        n += length
+        bad = (length == 0) | (n > w) | (nxt > size)
+        if counts is not None:
+            r = rep & ~bad
+            counts[pl[r] + 1] = length[r]
+            l = ~rep & ~bad
+            lit_diff[pl[l] + 1] += 1
+            lit_diff[nxt[l]] -= 1
+        full = n == w
+        ch += full
+        n[full] = 0
+        done = bad | (ch == 4)
+        if done.any():
+            ok[lane[bad]] = False
+            fin = done & ~bad
+            p[lane[fin]] = nxt[fin]
+            keep = ~done
+            lane, pl, n, ch = lane[keep], nxt[keep], n[keep], ch[keep]
+        else:
+            pl = nxt
+    return p, ok
+
+def read_rgbe(path, step=1):
+    """原生读取 .hdr，返回 (h, w, 3) float32 线性辐亮度 (不做任何归一化猜测)
+
+    step > 1 时只展开每 step 行、每 step 列 (点采样)，给大图预览用。
+    只支持新式 RLE 和未压缩两种布局，旧式 RLE 等罕见变体抛 ValueError，由 read_hdr 回退到通用解码。
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        h, w, flip, pos = read_rgbe_header(mm)
+        rows = np.arange(0, h, step)
+        out_w = (w + step - 1) // step
+        out = np.empty((len(rows), out_w, 3), dtype=np.float32)
+        # +Y (自下而上) 的文件直接倒着填行，返回的数组始终是正步长的连续内存；
+        # 降采样时按图像行 (而不是文件行) 取 0, step, 2*step...，与通用解码的 img[::step] 一致
+        dst = out[::-1] if flip else out
+        if flip:
+            rows = (h - 1 - rows)[::-1]
+        buf = np.frombuffer(mm, dtype=np.uint8)[pos:]
+        try:
+            rle = 8 <= w <= 0x7FFF and len(buf) >= 4 and buf[0] == 2 and buf[1] == 2 and buf[2] < 128
+            if not rle:
+                if len(buf) != h * w * 4:
+                    raise ValueError("不支持的旧式 RLE 或文件被截断")
+                rgbe = buf.reshape(h, w, 4)[rows][:, ::step]
+                dst[:] = rgbe[..., :3] * rgbe_scale_table()[rgbe[..., 3]][..., None]
+            else:
+                # 1. 用扫描线头 (2, 2, 宽高位, 宽低位) 找候选起点，数据里偶然出现的同样 4 字节由链式校验剔除
+                pattern = bytes((2, 2, w >> 8, w & 0xFF))
+                candidates = []
+                i = mm.find(pattern, pos)
+                while i >= 0:
+                    candidates.append(i - pos)
+                    i = mm.find(pattern, i + 1)
+                candidates = np.array(candidates, dtype=np.int64)
+                # 没有伪起点时 (绝大多数文件) 第一遍就顺带记录展开方式，省掉第二遍
+                record = len(candidates) == h
+                counts = np.zeros(len(buf), dtype=np.uint8)
+                lit_diff = np.zeros(len(buf) + 1, dtype=np.int8)
+                ends, ok = _rgbe_walk(buf, candidates, w, *((counts, lit_diff) if record else ()))
+                row_starts = np.empty(h + 1, dtype=np.int64)
+                row_starts[0] = 0
+                for y in range(h):
+                    k = np.searchsorted(candidates, row_starts[y])
+                    if k >= len(candidates) or candidates[k] != row_starts[y] or not ok[k]:
+                        raise ValueError(f"第 {y} 行扫描线损坏")
+                    row_starts[y + 1] = ends[k]
+                # 2. 只对需要的行记录展开方式，每个压缩字节对应一个输出重复次数
+                if not record:
+                    _rgbe_walk(buf, row_starts[rows], w, counts, lit_diff)
+                counts += np.cumsum(lit_diff[:-1], dtype=np.int8).view(np.uint8)
+                # 3. 分块展开：np.repeat 一次就得到这些行的 [R..., G..., B..., E...] 平面数据
+                block = max(1, RGBE_BLOCK_ROWS // step)
+                for r0 in range(0, len(rows), block):
+                    r1 = min(r0 + block, len(rows))
+                    if step == 1:
+                        a, b = row_starts[r0], row_starts[r1]
+                        planes = np.repeat(buf[a:b], counts[a:b])
+                    else:
+                        # 降采样时跳过的行也可能记录过展开方式，只逐行展开要保留的行
+                        planes = np.concatenate([np.repeat(buf[row_starts[y]:row_starts[y + 1]],
+                                                           counts[row_starts[y]:row_starts[y + 1]]) for y in rows[r0:r1]])
+                    planes = planes.reshape(r1 - r0, 4, w)[:, :, ::step]
+                    scale = rgbe_scale_table()[planes[:, 3]]
+                    for c in range(3):
+                        dst[r0:r1, :, c] = planes[:, c] * scale
+        finally:
+            # 指向 mmap 的视图必须在关闭前释放，否则 close 抛 BufferError；结果里的数组都是拷贝
+            del buf
+    return out
+
+def rgbe_preview_step(path, max_width=PREVIEW_DECODE_WIDTH):
+    """只读文件头，返回把宽度降到 max_width 以内的整数步长；非 RGBE 文件返回 1"""
+    if not path.lower().endswith(RGBE_EXTENSIONS):
+        return 1
+    try:
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with mm:
+            w = read_rgbe_header(mm)[1]
+    except (OSError, ValueError):
+        return 1
+    return max(1, -(-w // max_width))
+
+def benchmark_read_hdr(paths, step=4):
+    """对比原生 RGBE 解码 / 降采样解码 / 旧的 imageio 路径"""
+    for path in paths:
+        print(os.path.basename(path))
+        for name, fn in (("原生解码", lambda: read_rgbe(path)),
+                         (f"原生解码 step={step}", lambda: read_rgbe(path, step)),
+                         ("imageio (旧路径)", lambda: _read_hdr_generic(path))):
+            t0 = time.perf_counter()
+            img = fn()
+            print(f"  {name:<20s} {time.perf_counter() - t0:6.2f}s  {img.shape} {img.dtype} max={img.max():.3f}")
+
+def read_hdr(path, step=1):
+    """返回 (h, w, 3) float32；原生 RGBE 和通用解码遵循同一约定:
+    浮点数据就是线性辐亮度，原样返回；整数数据按位深归一化到 [0, 1]。
+    """
     if not os.path.isfile(path):
         raise FileNotFoundError(f"No such file: '{path}'")
+    if path.lower().endswith(RGBE_EXTENSIONS):
+        try:
+            return read_rgbe(path, step)
+        except ValueError:
+            pass  # 罕见的 RGBE 变体交给通用解码
+    img = _read_hdr_generic(path)
+    return img[::step, ::step] if step > 1 else img
+
+def _read_hdr_generic(path):
     try:
         img = iio.imread(path, plugin="pyav")
     except Exception:
@@ -65,9 +284,8 @@ def read_hdr(path):
     elif img.dtype == np.uint16:
         img = img.astype(np.float32) / 65535.0
     elif img.dtype in [np.float32, np.float64]:
+        # 不再按 max > 2 猜测是否为 16 位整数范围: 真实 HDR 的高光本来就远大于 2
         img = img.astype(np.float32)
-        if img.max() > 2.0:
-            img = img / 65535.0
     else:
         img = img.astype(np.float32)
     return img
@@ -93,6 +311,67 @@ def direction_to_equirect(d, w, h):
     v = (phi / np.pi) * h
     return int(np.clip(u, 0, w - 1)), int(np.clip(v, 0, h - 1))
 
+def face_direction_map(face, N):
+    """整面批量版 face_pixel_direction，返回 (N, N, 3)，下标为 [j, i]"""
+    coords = (2.0 * np.arange(N, dtype=np.float64) / (N - 1) - 1.0).astype(np.float32)
+    a, b = np.meshgrid(coords, coords)  # a 随列 i 变化，b 随行 j 变化
+    one = np.ones_like(a)
+    if face == 0: direction = np.stack((one, -b, -a), axis=-1)
+    elif face == 1: direction = np.stack((-one, -b, a), axis=-1)
+    elif face == 2: direction = np.stack((a, one, b), axis=-1)
+    elif face == 3: direction = np.stack((a, -one, -b), axis=-1)
+    elif face == 4: direction = np.stack((a, -b, one), axis=-1)
+    elif face == 5: direction = np.stack((-a, -b, -one), axis=-1)
+    direction /= np.sqrt(np.sum(direction * direction, axis=-1, keepdims=True))
+    return direction
+
+def equirect_index_map(d, w, h):
+    """批量版 direction_to_equirect，返回展平后的像素下标 v * w + u"""
+    x, y, z = d[..., 0], d[..., 1], d[..., 2]
+    theta = np.arctan2(-z, x)
+    phi = np.arccos(np.clip(y, -1.0, 1.0))
+    u = ((theta + np.float32(np.pi)) / np.float32(2 * np.pi)) * w
+    v = (phi / np.float32(np.pi)) * h
+    u = np.clip(u, 0, w - 1).astype(np.int64)
+    v = np.clip(v, 0, h - 1).astype(np.int64)
+    index_dtype = np.int32 if h * w < 2 ** 31 else np.int64
+    return (v * w + u).astype(index_dtype)
+
+# (cube_size, h, w) -> 6面下标表；预览和导出反复调用时直接复用
+_cube_lut_cache = {}
+_CUBE_LUT_CACHE_MAX = 4
+
+def get_cube_lut(cube_size, w, h):
+    key = (cube_size, h, w)
+    lut = _cube_lut_cache.pop(key, None)
+    if lut is None:
+        lut = [equirect_index_map(face_direction_map(face, cube_size), w, h) for face in range(6)]
+        while len(_cube_lut_cache) >= _CUBE_LUT_CACHE_MAX:
+            _cube_lut_cache.pop(next(iter(_cube_lut_cache)))
+    _cube_lut_cache[key] = lut  # 重新插入到末尾，淘汰时按最久未使用
+    return lut
+
+def build_equirect_pyramid(eq_img, min_width=64):
+    """2x2 盒式下采样的全景图金字塔 [原图, 1/2, 1/4, ...]，小尺寸预览从小图采样，既快又不闪烁"""
+    levels = [eq_img]
+    while levels[-1].shape[1] // 2 >= min_width and levels[-1].shape[0] >= 2:
+        src = levels[-1]
+        h2, w2 = src.shape[0] // 2, src.shape[1] // 2
+        # 四个步长切片直接相加，比 reshape 后按轴求均值快得多
+        down = src[0:h2 * 2:2, 0:w2 * 2:2] + src[1:h2 * 2:2, 0:w2 * 2:2]
+        down += src[0:h2 * 2:2, 1:w2 * 2:2]
+        down += src[1:h2 * 2:2, 1:w2 * 2:2]
+        down *= np.float32(0.25)
+        levels.append(down)
+    return levels
+
+def pick_pyramid_level(pyramid, cube_size):
+    """取宽度仍不小于 4*cube_size 的最小一级 (赤道一圈4个面，纹素密度与源图大致相当)"""
+    for level in reversed(pyramid):
+        if level.shape[1] >= 4 * cube_size:
+            return level
+    return pyramid[0]
+
 def tonemap_reinhard(x):
     return x / (1.0 + x)
 
@@ -110,276 +389,347 @@ def correct_rgb_shape(img):
         raise Exception(f"[FATAL] 图像shape异常：{img.shape}")
     return img
 
-def generate_cube_faces(eq_img, cube_size, scale, tonemap_enabled=True, gamma_enabled=True):
-    """6面CubeMap，Tonemap/Gamma任意组合，返回uint8 RGB数组"""
-    eq_img = eq_img * scale
+def sample_cube_faces_linear(eq_img, cube_size, on_face=None):
+    """只做采样，返回6个线性HDR面 (cube_size, cube_size, 3)，缩放/Tonemap/Gamma留给 apply_display_transform
+
+    on_face(i) 在每个面采完后调用，后台任务用它汇报进度，抛 JobCancelled 即可中途取消。
+    """
     faces = []
-    h, w = eq_img.shape[:2]
     for face in range(6):
-        out = np.zeros((cube_size, cube_size, 3), np.float32)
-        for i in range(cube_size):
-            for j in range(cube_size):
-                d = face_pixel_direction(face, i, j, cube_size)
-                u, v = direction_to_equirect(d, w, h)
-                out[j, i, :] = eq_img[v, u, :3]
-        if tonemap_enabled:
-            out = tonemap_reinhard(out)
-        if gamma_enabled:
-            out = srgb_gamma(out)
-        out = np.clip(out, 0, 1)
-        out8 = (out * 255).astype(np.uint8)
-        out8 = correct_rgb_shape(out8)
-        faces.append(out8)
+        faces.append(cube_face_linear(eq_img, cube_size, face))
+        if on_face is not None:
+            on_face(face)
     return faces
 
-class CubeMapGUI(QtWidgets.QWidget):
-    def __init__(self):
-        super().__init__()
-        self.setWindowTitle("CubeMap生成工具（Tonemap/Gamma可单独控制）")
-        self.setGeometry(100, 100, 900, 590)
-        self.layout = QtWidgets.QHBoxLayout(self)
-
-        # 左侧预览
-        self.preview_label = QtWidgets.QLabel()
-        self.preview_label.setFixedSize(512, 512)
-        self.preview_label.setStyleSheet("border: 1px solid gray; background: black")
-        self.preview_label.setAlignment(QtCore.Qt.AlignCenter)
-        self.layout.addWidget(self.preview_label)
-
-        # 设置窗口接受拖放
-        self.setAcceptDrops(True)
-
-        # 右侧控制区
-        vbox = QtWidgets.QVBoxLayout()
-        self.layout.addLayout(vbox)
-
-        self.input_path = QtWidgets.QLineEdit()
-        self.input_path.setPlaceholderText("输入图片路径或点击浏览...")
-        btn_browse = QtWidgets.QPushButton("浏览图片")
-        btn_browse.clicked.connect(self.on_browse)
-        hbox1 = QtWidgets.QHBoxLayout()
-        hbox1.addWidget(self.input_path)
-        hbox1.addWidget(btn_browse)
-        vbox.addLayout(hbox1)
-
-        self.output_path = QtWidgets.QLineEdit()
-        self.output_path.setPlaceholderText("输出文件夹，不输入使用图片同目录")
-        btn_outbrowse = QtWidgets.QPushButton("浏览文件夹")
-        btn_outbrowse.clicked.connect(self.on_outbrowse)
-        hbox2 = QtWidgets.QHBoxLayout()
-        hbox2.addWidget(self.output_path)
-        hbox2.addWidget(btn_outbrowse)
-        vbox.addLayout(hbox2)
-
-        self.cube_size_box = QtWidgets.QComboBox()
-        self.cube_size_box.addItems(["512", "1024", "2048"])
-        vbox.addWidget(QtWidgets.QLabel("CubeMap面分辨率:"))
-        vbox.addWidget(self.cube_size_box)
-
-        vbox.addWidget(QtWidgets.QLabel("亮度缩放系数（0.1~10），右侧可滑动调节或输入:"))
-        self.scale_slider = QtWidgets.QSlider(QtCore.Qt.Horizontal)
-        self.scale_slider.setMinimum(1)
-        self.scale_slider.setMaximum(100)
-        self.scale_slider.setValue(10)
-        self.scale_slider.valueChanged.connect(self.on_scale_change)
-        vbox.addWidget(self.scale_slider)
-        self.scale_edit = QtWidgets.QLineEdit("1.00")
-        self.scale_edit.setFixedWidth(60)
-        self.scale_edit.editingFinished.connect(self.on_scale_edit_change)
-        hbox3 = QtWidgets.QHBoxLayout()
-        hbox3.addWidget(QtWidgets.QLabel("缩放系数:"))
-        hbox3.addWidget(self.scale_edit)
-        vbox.addLayout(hbox3)
-
-        self.face_select = QtWidgets.QComboBox()
-        self.face_select.addItems(face_names)
-        self.face_select.currentIndexChanged.connect(self.update_preview)
-        hbox4 = QtWidgets.QHBoxLayout()
-        hbox4.addWidget(QtWidgets.QLabel("预览cube面:"))
-        hbox4.addWidget(self.face_select)
-        vbox.addLayout(hbox4)
-
-        # Tonemap和Gamma勾选框（独立）
-        self.tonemap_checkbox = QtWidgets.QCheckBox("Tonemap (Reinhard)")
-        self.tonemap_checkbox.setChecked(True)
-        self.tonemap_checkbox.stateChanged.connect(self.on_any_effect_checked)
-        self.gamma_checkbox = QtWidgets.QCheckBox("Gamma校正 (sRGB)")
-        self.gamma_checkbox.setChecked(True)
-        self.gamma_checkbox.stateChanged.connect(self.on_any_effect_checked)
-        hbox5 = QtWidgets.QHBoxLayout()
-        hbox5.addWidget(self.tonemap_checkbox)
-        hbox5.addWidget(self.gamma_checkbox)
-        vbox.addLayout(hbox5)
-
-        self.status = QtWidgets.QLabel("")
-        vbox.addWidget(self.status)
-        self.btn_save = QtWidgets.QPushButton("导出6张CubeMap PNG")
-        self.btn_save.clicked.connect(self.on_save)
-        vbox.addWidget(self.btn_save)
-
-        self.btn_save_combined = QtWidgets.QPushButton("导出合成一张立方体CubeMap PNG")
-        self.btn_save_combined.clicked.connect(self.on_save_combined)
-        vbox.addWidget(self.btn_save_combined)
-
-        vbox.addStretch()
-
-        # 预览分辨率
-        self.preview_cubesize = 128
-
-        # 防抖定时器
-        self.preview_timer = QtCore.QTimer()
-        self.preview_timer.setSingleShot(True)
-        self.preview_timer.timeout.connect(self._do_preview)
-
-        self.eq_img = None
-        self.faces = None
-
-    def dragEnterEvent(self, event):
-        if event.mimeData().hasUrls():
-            event.accept()
+def cube_face_linear(eq_img, cube_size, face):
+    h, w = eq_img.shape[:2]
+    lut = get_cube_lut(cube_size, w, h)
+    return eq_img[..., :3].reshape(h * w, 3)[lut[face]]
+
+def apply_display_transform(linear_face, scale, tonemap_enabled=True, gamma_enabled=True, out8=None):
+    """逐像素后处理：缩放 -> Tonemap -> Gamma -> uint8，结果与原 generate_cube_faces 逐位一致
+
+    传入 out8 时直接写进这块 uint8 缓冲 (如整块6面缓冲的一个面)，不再另分配。
+    """
+    out = linear_face * scale
+    if tonemap_enabled:
+        np.divide(out, out + 1.0, out=out)  # tonemap_reinhard 的原地版
+    if gamma_enabled:
+        np.clip(out, 0, 1, out=out)
+        np.power(out, 1 / 2.2, out=out)  # srgb_gamma 的原地版
+    np.clip(out, 0, 1, out=out)
+    out *= 255
+    if out8 is not None:
+        np.copyto(out8, out, casting="unsafe")  # 与 astype(np.uint8) 一样向零截断
+        return out8
+    return correct_rgb_shape(out.astype(np.uint8))
+
+def generate_cube_faces(eq_img, cube_size, scale, tonemap_enabled=True, gamma_enabled=True):
+    """6面CubeMap，Tonemap/Gamma任意组合，返回uint8 RGB数组"""
+    return [apply_display_transform(face, scale, tonemap_enabled, gamma_enabled)
+            for face in sample_cube_faces_linear(eq_img, cube_size)]
+
+CUBE_LAYOUTS = ("faces", "cross", "vstrip", "hstrip")
+# 十字展开布局中每个面所在的 (行, 列)，单位为面边长
+CROSS_SLOTS = {2: (0, 1), 1: (1, 0), 4: (1, 1), 0: (1, 2), 5: (1, 3), 3: (2, 1)}
+
+def render_cube_faces(eq_img, cube_size, scale, tonemap_enabled=True, gamma_enabled=True,
+                      linear=None, timings=None, on_face=None):
+    """逐面 采样 + 后处理 到一整块 (6, N, N, 3) uint8 缓冲，线性结果用完即丢
+
+    linear 为已缓存的6个线性面时跳过采样；timings 字典里累加 "采样" / "后处理" 耗时。
+    """
+    timings = {} if timings is None else timings
+    faces = np.empty((6, cube_size, cube_size, 3), dtype=np.uint8)
+    for i in range(6):
+        t0 = time.perf_counter()
+        face = linear[i] if linear is not None else cube_face_linear(eq_img, cube_size, i)
+        t1 = time.perf_counter()
+        apply_display_transform(face, scale, tonemap_enabled, gamma_enabled, out8=faces[i])
+        timings["采样"] = timings.get("采样", 0.0) + t1 - t0
+        timings["后处理"] = timings.get("后处理", 0.0) + time.perf_counter() - t1
+        if on_face is not None:
+            on_face(i)
+    return faces
+
+def cube_layout_images(faces, layouts):
+    """按布局返回 [(文件名, uint8 图)]：faces=6张单面, cross=十字展开, vstrip/hstrip=竖条/横条
+
+    单面和竖条直接引用 faces 的内存，只有十字和横条需要重新排布。
+    """
+    n = faces.shape[1]
+    images = []
+    if "faces" in layouts:
+        images += [(f"cube_{face_names[i]}.png", faces[i]) for i in range(6)]
+    if "cross" in layouts:
+        cross = np.zeros((n * 3, n * 4, 3), dtype=np.uint8)
+        for face, (row, col) in CROSS_SLOTS.items():
+            cross[row * n:(row + 1) * n, col * n:(col + 1) * n] = faces[face]
+        images.append(("cubemap_combined.png", cross))
+    if "vstrip" in layouts:
+        images.append(("cubemap_strip_vertical.png", faces.reshape(6 * n, n, 3)))
+    if "hstrip" in layouts:
+        images.append(("cubemap_strip_horizontal.png",
+                       np.ascontiguousarray(faces.transpose(1, 0, 2, 3)).reshape(n, 6 * n, 3)))
+    return images
+
+def save_pngs_parallel(images, output_dir, on_saved=None, max_workers=None):
+    """线程池并行编码 PNG (zlib 压缩时释放 GIL)，返回写出的路径列表；on_saved(k) 在第 k 个文件写完后调用"""
+    def save(name, img):
+        path = os.path.join(output_dir, name)
+        Image.fromarray(img, "RGB").save(path)
+        return path
+    max_workers = max_workers or max(1, min(len(images), os.cpu_count() or 1))
+    paths = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(save, name, img) for name, img in images]
+        for done, future in enumerate(as_completed(futures), 1):
+            paths.append(future.result())
+            if on_saved is not None:
+                on_saved(done)
+    return paths
+
+class JobCancelled(Exception):
+    pass
+
+class BackgroundJob:
+    def __init__(self, worker, kind, token, fn, args, coalesce):
+        self.worker = worker
+        self.kind = kind
+        self.token = token
+        self.fn = fn
+        self.args = args
+        self.coalesce = coalesce
+
+    def is_current(self):
+        return not self.coalesce or self.worker.is_current(self.kind, self.token)
+
+    def check(self):
+        """协作式取消点：已被同类新任务取代时抛 JobCancelled"""
+        if not self.is_current():
+            raise JobCancelled()
+
+    def progress(self, done, total, text):
+        self.check()
+        self.worker.on_progress(self.kind, self.token, int(100 * done / max(total, 1)), text)
+
+    def deliver(self, result):
+        """任务中途先交付一份结果 (渐进式预览)，任务结束时的返回值仍会照常交付"""
+        self.check()
+        self.worker.on_finished(self.kind, self.token, result)
+
+class BackgroundWorker:
+    """唯一的后台线程，按提交顺序执行任务
+
+    coalesce=True 的同类任务只保留最新一个：排队中的旧任务直接丢弃，正在跑的旧任务在下一个检查点取消。
+    回调在后台线程里调用，GUI 里接的是 pyqtSignal.emit，会自动排队到 UI 线程。
+    """
+    def __init__(self, on_progress, on_finished, on_failed):
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self.on_failed = on_failed
+        self.cond = threading.Condition()
+        self.queue = []
+        self.generation = {}
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, kind, fn, *args, coalesce=True):
+        with self.cond:
+            token = self.cancel(kind) if coalesce else self.generation.get(kind, 0) + 1
+            self.generation[kind] = token
+            self.queue.append(BackgroundJob(self, kind, token, fn, args, coalesce))
+            self.cond.notify()
+        return token
+
+    def cancel(self, kind):
+        """取消同类的排队和正在执行的任务，返回新的代号"""
+        with self.cond:
+            token = self.generation.get(kind, 0) + 1
+            self.generation[kind] = token
+            self.queue = [job for job in self.queue if job.kind != kind]
+        return token
+
+    def is_current(self, kind, token):
+        return self.generation.get(kind) == token
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                job = self.queue.pop(0)
+            try:
+                job.check()
+                result = job.fn(job, *job.args)
+            except JobCancelled:
+                continue
+            except Exception as e:
+                self.on_failed(job.kind, job.token, str(e))
+                continue
+            if job.is_current():
+                self.on_finished(job.kind, job.token, result)
+
+def load_gui():
+    """导入窗口模块 HDR转Cubemap_gui (连带 PyQt5)；只有 GUI 入口会调用，命令行批量模式和它的子进程都不需要 Qt"""
+    # 以脚本运行时本模块叫 __main__，先按文件名登记，窗口模块 import 到的就是这一份，不会再执行一遍
+    sys.modules.setdefault(os.path.splitext(os.path.basename(__file__))[0], sys.modules[__name__])
+    t0 = time.perf_counter()
+    gui = importlib.import_module("HDR转Cubemap_gui")
+    profile_mark("导入窗口模块 (含 PyQt5)", time.perf_counter() - t0)
+    return gui
+
+# ------------------------------------------------------------
+# 无界面批量模式：python HDR转Cubemap.py cli 输入... [--variant 1 --variant 2:0 ...] [-j N]
+# ------------------------------------------------------------
+INPUT_EXTENSIONS = (".hdr", ".exr", ".jpg", ".jpeg", ".png")
+
+def expand_inputs(inputs, extensions=INPUT_EXTENSIONS):
+    """展开文件 / 目录 / 通配符，按出现顺序去重"""
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = sorted(os.path.join(item, name) for name in os.listdir(item)
+                             if os.path.isfile(os.path.join(item, name)) and name.lower().endswith(extensions))
+        elif glob.has_magic(item):
+            matches = sorted(p for p in glob.glob(item, recursive=True)
+                             if os.path.isfile(p) and p.lower().endswith(extensions))
         else:
-            event.ignore()
-
-    def dropEvent(self, event):
-        if event.mimeData().hasUrls():
-            url = event.mimeData().urls()[0]
-            filePath = url.toLocalFile()
-            if os.path.isfile(filePath):
-                self.input_path.setText(filePath)
-                self.load_image_and_update()
-
-    def on_browse(self):
-        fname, _ = QtWidgets.QFileDialog.getOpenFileName(self, "选取全景图片", "", "图片文件 (*.hdr *.exr *.jpg *.jpeg *.png)")
-        if fname:
-            self.input_path.setText(fname)
-            self.load_image_and_update()
-
-    def on_outbrowse(self):
-        fname = QtWidgets.QFileDialog.getExistingDirectory(self, "选取输出文件夹")
-        if fname:
-            self.output_path.setText(fname)
-
-    def on_any_effect_checked(self):
-        self.preview_timer.start(80)
-
-    def load_image_and_update(self):
-        try:
-            input_path = self.input_path.text().strip()
-            if not os.path.isfile(input_path):
-                self.status.setText("图片文件不存在")
-                return
-            self.eq_img = read_hdr(input_path)
-            self.status.setText(f"图片读取成功: {os.path.basename(input_path)}, shape: {self.eq_img.shape}")
-            self.preview_timer.start(80)
-        except Exception as e:
-            self.status.setText(f"读取图片失败: {e}")
-
-    def on_scale_change(self):
-        val = self.scale_slider.value() / 10.0
-        self.scale_edit.setText(f"{val:.2f}")
-        self.preview_timer.start(80)  # 80ms防抖
-
-    def on_scale_edit_change(self):
-        try:
-            val = float(self.scale_edit.text())
-            val = max(0.1, min(val, 10.0))
-            idx = int(round(val * 10))
-            self.scale_slider.setValue(idx)
-            self.scale_edit.setText(f"{val:.2f}")
-            self.preview_timer.start(80)
-        except:
-            self.scale_edit.setText("1.00")
-
-    def _do_preview(self):
-        if self.eq_img is None:
-            return
-        try:
-            scale = float(self.scale_edit.text())
-            tonemap = self.tonemap_checkbox.isChecked()
-            gamma = self.gamma_checkbox.isChecked()
-            def task():
-                faces = generate_cube_faces(self.eq_img, self.preview_cubesize, scale, tonemap_enabled=tonemap, gamma_enabled=gamma)
-                QtCore.QMetaObject.invokeMethod(self, "set_preview_faces", QtCore.Qt.QueuedConnection, QtCore.Q_ARG(object, faces))
-            threading.Thread(target=task, daemon=True).start()
-        except Exception as e:
-            self.status.setText(f"生成预览失败: {e}")
-
-    @QtCore.pyqtSlot(object)
-    def set_preview_faces(self, faces):
-        self.faces = faces
-        self.update_preview()
-
-    def update_preview(self):
-        if self.faces is None:
-            return
-        idx = self.face_select.currentIndex()
-        img = Image.fromarray(self.faces[idx], "RGB")
-        data = img.convert("RGBA").tobytes("raw", "RGBA")
-        qimg = QtGui.QImage(data, img.width, img.height, QtGui.QImage.Format_RGBA8888)
-        pix = QtGui.QPixmap.fromImage(qimg)
-        target_size = self.preview_label.size()
-        pix = pix.scaled(target_size, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
-        self.preview_label.setPixmap(pix)
-
-    def on_save(self):
-        try:
-            if self.eq_img is None:
-                self.status.setText("请先载入图片")
-                return
-            output_dir = self.output_path.text().strip()
-            if output_dir == '':
-                output_dir = os.path.dirname(self.input_path.text().strip())
-            os.makedirs(output_dir, exist_ok=True)
-            cube_size = int(self.cube_size_box.currentText())
-            scale = float(self.scale_edit.text())
-            tonemap = self.tonemap_checkbox.isChecked()
-            gamma = self.gamma_checkbox.isChecked()
-            self.status.setText("正在导出高分辨率图片，请稍候...")
-            QtWidgets.QApplication.processEvents()
-            faces = generate_cube_faces(self.eq_img, cube_size, scale, tonemap_enabled=tonemap, gamma_enabled=gamma)
-            for i in range(6):
-                fname = os.path.join(output_dir, f"cube_{face_names[i]}.png")
-                Image.fromarray(faces[i], "RGB").save(fname)
-            self.status.setText(f"保存完成: {output_dir}")
-        except Exception as e:
-            self.status.setText(f"保存失败: {e}")
-
-    def on_save_combined(self):
+            matches = [item]
+        files.extend(matches)
+    return list(dict.fromkeys(files))
+
+def parse_variant(text):
+    """解析 SCALE[:TONEMAP[:GAMMA]]，TONEMAP/GAMMA 取 1/0，省略时默认开启，如 2、0.5:0、1:1:0"""
+    parts = text.split(":")
+    try:
+        if not 1 <= len(parts) <= 3 or any(p not in ("0", "1") for p in parts[1:]):
+            raise ValueError
+        scale = float(parts[0])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"变体格式应为 SCALE[:TONEMAP[:GAMMA]]，如 1.5:1:0，收到: {text}")
+    flags = [p == "1" for p in parts[1:]] + [True] * (3 - len(parts))
+    return scale, flags[0], flags[1]
+
+def variant_dir_name(scale, tonemap, gamma):
+    return f"x{scale:g}_tm{int(tonemap)}_g{int(gamma)}"
+
+def convert_file_variants(path, output_root, cube_size, variants, layouts, png_threads=None):
+    """一张图只读取、采样一次，所有 (缩放, Tonemap, Gamma) 变体都从同一份线性面派生；返回各阶段耗时"""
+    timings = {}
+    t0 = time.perf_counter()
+    img = read_hdr(path)
+    timings["读取"] = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    linear = sample_cube_faces_linear(img, cube_size)
+    timings["采样"] = time.perf_counter() - t0
+    del img
+    stem = os.path.splitext(os.path.basename(path))[0]
+    root = output_root if output_root else os.path.dirname(os.path.abspath(path))
+    for scale, tonemap, gamma in variants:
+        out_dir = os.path.join(root, stem, variant_dir_name(scale, tonemap, gamma))
+        os.makedirs(out_dir, exist_ok=True)
+        faces = render_cube_faces(None, cube_size, scale, tonemap, gamma, linear, timings)
+        t0 = time.perf_counter()
+        images = cube_layout_images(faces, layouts)
+        timings["排版"] = timings.get("排版", 0.0) + time.perf_counter() - t0
+        t0 = time.perf_counter()
+        save_pngs_parallel(images, out_dir, max_workers=png_threads)
+        timings["PNG编码"] = timings.get("PNG编码", 0.0) + time.perf_counter() - t0
+    return timings
+
+def _cli_worker(path, output_root, cube_size, variants, layouts, png_threads):
+    log = io.StringIO()
+    t0 = time.perf_counter()
+    timings = {}
+    with contextlib.redirect_stdout(log):
         try:
-            if self.eq_img is None:
-                self.status.setText("请先载入图片")
-                return
-            output_dir = self.output_path.text().strip()
-            if output_dir == '':
-                output_dir = os.path.dirname(self.input_path.text().strip())
-            os.makedirs(output_dir, exist_ok=True)
-            cube_size = int(self.cube_size_box.currentText())
-            scale = float(self.scale_edit.text())
-            tonemap = self.tonemap_checkbox.isChecked()
-            gamma = self.gamma_checkbox.isChecked()
-            self.status.setText("正在导出合成图片，请稍候...")
-            QtWidgets.QApplication.processEvents()
-            faces = generate_cube_faces(self.eq_img, cube_size, scale, tonemap_enabled=tonemap, gamma_enabled=gamma)
-            combined_size = cube_size * 4
-            combined_height = cube_size * 3
-            combined = np.zeros((combined_height, combined_size, 3), dtype=np.uint8)
-
-            # 按特定位置放置面
-            combined[0:cube_size, cube_size:cube_size*2, :] = faces[2]  # +Y
-            combined[cube_size:cube_size*2, 0:cube_size, :] = faces[1] # -X
-            combined[cube_size:cube_size*2, cube_size:cube_size*2, :] = faces[4] # +Z
-            combined[cube_size:cube_size*2, cube_size*2:cube_size*3, :] = faces[0] # +X
-            combined[cube_size:cube_size*2, cube_size*3:cube_size*4, :] = faces[5] # -Z
-            combined[cube_size*2:cube_size*3, cube_size:cube_size*2, :] = faces[3] # -Y
-
-            fname = os.path.join(output_dir, f"cubemap_combined.png")
-            Image.fromarray(combined, "RGB").save(fname)
-            self.status.setText(f"合成图片保存完成: {fname}")
-        except Exception as e:
-            self.status.setText(f"合成导出失败: {e}")
+            timings = convert_file_variants(path, output_root, cube_size, variants, layouts, png_threads)
+            ok = True
+        except Exception:
+            traceback.print_exc(file=log)
+            ok = False
+    return path, ok, time.perf_counter() - t0, log.getvalue(), timings
+
+def run_cli(argv):
+    ap = argparse.ArgumentParser(prog="HDR转Cubemap.py cli",
+                                 description="无界面批量导出 CubeMap PNG：多个输入 x 多组 (缩放, Tonemap, Gamma) 变体")
+    ap.add_argument("inputs", nargs="+", help="图片文件、目录或通配符")
+    ap.add_argument("-o", "--output", help="输出根目录 (默认与输入同目录)，结构为 <根>/<文件名>/<变体>/")
+    ap.add_argument("--size", type=int, default=512, help="面分辨率，默认 512")
+    ap.add_argument("--variant", type=parse_variant, action="append", metavar="SCALE[:TM[:GAMMA]]",
+                    help="可重复；TM/GAMMA 取 1/0，默认 1:1:1")
+    ap.add_argument("--layout", nargs="+", choices=CUBE_LAYOUTS, default=["faces"],
+                    help="faces=6张单面 cross=十字 vstrip/hstrip=竖条/横条，默认 faces")
+    ap.add_argument("-j", "--jobs", type=int, default=0, help="并行进程数，0 = CPU 核数 (默认)，1 = 单进程")
+    ap.add_argument("--bench-read", action="store_true", help="只对比 .hdr 各读取路径的耗时，不导出")
+    args = ap.parse_args(argv)
+
+    files = expand_inputs(args.inputs)
+    if not files:
+        print("[跳过] 没有找到输入图片")
+        return 1
+    if args.bench_read:
+        benchmark_read_hdr(files)
+        return 0
+
+    variants = list(dict.fromkeys(args.variant or [(1.0, True, True)]))
+    layouts = set(args.layout)
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    jobs = min(jobs, len(files))
+    # 进程数 x PNG 线程数不超过核数
+    png_threads = max(1, (os.cpu_count() or 1) // jobs)
+    print(f"共 {len(files)} 个文件 x {len(variants)} 个变体，面分辨率 {args.size}，{jobs} 个进程")
+
+    results = []
+    t0 = time.perf_counter()
+    task_args = [(f, args.output, args.size, variants, layouts, png_threads) for f in files]
+    if jobs == 1:
+        outcomes = (_cli_worker(*a) for a in task_args)
+        pool = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=jobs)
+        outcomes = (fut.result() for fut in as_completed([pool.submit(_cli_worker, *a) for a in task_args]))
+    try:
+        for done, (f, ok, seconds, log, timings) in enumerate(outcomes, 1):
+            results.append((f, ok, seconds))
+            stages = " · ".join(f"{name} {sec:.2f}s" for name, sec in timings.items())
+            print(f"[{done}/{len(files)}] {'OK  ' if ok else 'FAIL'} {seconds:6.2f}s  {os.path.basename(f)}  {stages}")
+            if not ok:
+                print(log.rstrip())
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    failed = [r for r in results if not r[1]]
+    total = time.perf_counter() - t0
+    busy = sum(r[2] for r in results)
+    print("\n" + "=" * 50)
+    print(f"  成功 {len(results) - len(failed)} / {len(results)}，共 {len(results) * len(variants)} 组输出，"
+          f"总耗时 {total:.2f}s (并行加速 {busy / max(total, 1e-9):.1f}x)")
+    for f, _, _ in failed:
+        print(f"  [失败] {f}")
+    print("=" * 50)
+    return 1 if failed else 0
+
+def main(argv):
+    """python HDR转Cubemap.py [图片]        打开窗口 (可带一张图片预先载入，例如拖到脚本图标上的文件)
+       python HDR转Cubemap.py cli 输入...  无界面批量模式，不创建窗口，不需要显示器
+    """
+    force = "--check-deps" in argv
+    argv = [a for a in argv if a != "--check-deps"]
+    cli = argv[:1] == ["cli"]
+    # 命令行模式不检查 / 安装 PyQt5
+    ensure_deps(force=force, gui=not cli)
+    if cli:
+        return run_cli(argv[1:])
+    gui = load_gui()
+    app = gui.QtWidgets.QApplication(sys.argv[:1])
+    window = gui.CubeMapGUI()
+    window.show()
+    if argv:
+        window.open_image(argv[0])
+    return app.exec_()
 
 if __name__ == "__main__":
-    app = QtWidgets.QApplication(sys.argv)
-    gui = CubeMapGUI()
-    gui.show()
-    sys.exit(app.exec_())
\ No newline at end of file
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,409 @@
+"""HDR转Cubemap.py 的窗口界面
+
+由主脚本的 load_gui 在打开窗口时才导入 (连带 PyQt5)；命令行批量模式和它的子进程都不会加载本模块。
+图像处理、后台任务等都在主脚本里，这里通过 core 访问。
+"""
+import os
+import time
+
+from PyQt5 import QtWidgets, QtCore, QtGui
+
+import HDR转Cubemap as core
+
+
+class CubeMapGUI(QtWidgets.QWidget):
+    job_progress = QtCore.pyqtSignal(str, int, int, str)
+    job_finished = QtCore.pyqtSignal(str, int, object)
+    job_failed = QtCore.pyqtSignal(str, int, str)
+
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("CubeMap生成工具（Tonemap/Gamma可单独控制）")
+        self.setGeometry(100, 100, 900, 590)
+        self.layout = QtWidgets.QHBoxLayout(self)
+
+        # 左侧预览
+        self.preview_label = QtWidgets.QLabel()
+        self.preview_label.setFixedSize(512, 512)
+        self.preview_label.setStyleSheet("border: 1px solid gray; background: black")
+        self.preview_label.setAlignment(QtCore.Qt.AlignCenter)
+        self.layout.addWidget(self.preview_label)
+
+        # 设置窗口接受拖放
+        self.setAcceptDrops(True)
+
+        # 右侧控制区
+        vbox = QtWidgets.QVBoxLayout()
+        self.layout.addLayout(vbox)
+
+        self.input_path = QtWidgets.QLineEdit()
+        self.input_path.setPlaceholderText("输入图片路径或点击浏览...")
+        btn_browse = QtWidgets.QPushButton("浏览图片")
+        btn_browse.clicked.connect(self.on_browse)
+        hbox1 = QtWidgets.QHBoxLayout()
+        hbox1.addWidget(self.input_path)
+        hbox1.addWidget(btn_browse)
+        vbox.addLayout(hbox1)
+
+        self.output_path = QtWidgets.QLineEdit()
+        self.output_path.setPlaceholderText("输出文件夹，不输入使用图片同目录")
+        btn_outbrowse = QtWidgets.QPushButton("浏览文件夹")
+        btn_outbrowse.clicked.connect(self.on_outbrowse)
+        hbox2 = QtWidgets.QHBoxLayout()
+        hbox2.addWidget(self.output_path)
+        hbox2.addWidget(btn_outbrowse)
+        vbox.addLayout(hbox2)
+
+        self.cube_size_box = QtWidgets.QComboBox()
+        self.cube_size_box.addItems(["512", "1024", "2048"])
+        vbox.addWidget(QtWidgets.QLabel("CubeMap面分辨率:"))
+        vbox.addWidget(self.cube_size_box)
+
+        vbox.addWidget(QtWidgets.QLabel("亮度缩放系数（0.1~10），右侧可滑动调节或输入:"))
+        self.scale_slider = QtWidgets.QSlider(QtCore.Qt.Horizontal)
+        self.scale_slider.setMinimum(1)
+        self.scale_slider.setMaximum(100)
+        self.scale_slider.setValue(10)
+        self.scale_slider.valueChanged.connect(self.on_scale_change)
+        vbox.addWidget(self.scale_slider)
+        self.scale_edit = QtWidgets.QLineEdit("1.00")
+        self.scale_edit.setFixedWidth(60)
+        self.scale_edit.editingFinished.connect(self.on_scale_edit_change)
+        hbox3 = QtWidgets.QHBoxLayout()
+        hbox3.addWidget(QtWidgets.QLabel("缩放系数:"))
+        hbox3.addWidget(self.scale_edit)
+        vbox.addLayout(hbox3)
+
+        self.cube_size_box.currentIndexChanged.connect(self.on_any_effect_checked)
+
+        self.face_select = QtWidgets.QComboBox()
+        self.face_select.addItems(core.face_names)
+        self.face_select.currentIndexChanged.connect(self.update_preview)
+        hbox4 = QtWidgets.QHBoxLayout()
+        hbox4.addWidget(QtWidgets.QLabel("预览cube面:"))
+        hbox4.addWidget(self.face_select)
+        vbox.addLayout(hbox4)
+
+        # Tonemap和Gamma勾选框（独立）
+        self.tonemap_checkbox = QtWidgets.QCheckBox("Tonemap (Reinhard)")
+        self.tonemap_checkbox.setChecked(True)
+        self.tonemap_checkbox.stateChanged.connect(self.on_any_effect_checked)
+        self.gamma_checkbox = QtWidgets.QCheckBox("Gamma校正 (sRGB)")
+        self.gamma_checkbox.setChecked(True)
+        self.gamma_checkbox.stateChanged.connect(self.on_any_effect_checked)
+        hbox5 = QtWidgets.QHBoxLayout()
+        hbox5.addWidget(self.tonemap_checkbox)
+        hbox5.addWidget(self.gamma_checkbox)
+        vbox.addLayout(hbox5)
+
+        # 渐进式预览：先出 32²，再出预览分辨率，勾选后最后细化到导出分辨率
+        self.refine_checkbox = QtWidgets.QCheckBox("预览细化到导出分辨率")
+        self.refine_checkbox.stateChanged.connect(self.on_any_effect_checked)
+        vbox.addWidget(self.refine_checkbox)
+
+        self.status = QtWidgets.QLabel("")
+        vbox.addWidget(self.status)
+        self.progress = QtWidgets.QProgressBar()
+        self.progress.setRange(0, 100)
+        self.progress.hide()
+        vbox.addWidget(self.progress)
+        self.btn_save = QtWidgets.QPushButton("导出6张CubeMap PNG")
+        self.btn_save.clicked.connect(self.on_save)
+        vbox.addWidget(self.btn_save)
+
+        self.btn_save_combined = QtWidgets.QPushButton("导出合成一张立方体CubeMap PNG")
+        self.btn_save_combined.clicked.connect(self.on_save_combined)
+        vbox.addWidget(self.btn_save_combined)
+
+        self.btn_save_all = QtWidgets.QPushButton("一次导出6张单面 + 合成图")
+        self.btn_save_all.clicked.connect(self.on_save_all)
+        vbox.addWidget(self.btn_save_all)
+
+        # 条带布局附加在上面任意一种导出里
+        self.vstrip_checkbox = QtWidgets.QCheckBox("附带竖条布局")
+        self.hstrip_checkbox = QtWidgets.QCheckBox("附带横条布局")
+        hbox6 = QtWidgets.QHBoxLayout()
+        hbox6.addWidget(self.vstrip_checkbox)
+        hbox6.addWidget(self.hstrip_checkbox)
+        vbox.addLayout(hbox6)
+
+        vbox.addStretch()
+
+        # 预览分辨率 (渐进式预览的第一级用 preview_first_size)
+        self.preview_cubesize = 128
+        self.preview_first_size = 32
+
+        # 防抖定时器
+        self.preview_timer = QtCore.QTimer()
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.timeout.connect(self._do_preview)
+
+        self.eq_img = None
+        self.eq_pyramid = None
+        self.eq_img_step = 1
+        self.faces = None
+        # 线性采样结果缓存 {(图片序号, 预览分辨率): 6个float面}，拖动滑条时只重做后处理；
+        # 只保留两级预览和当前导出分辨率，换过的导出分辨率 (2048² 一份约 300 MB) 不再常驻
+        self.image_serial = 0
+        self.linear_cache = {}
+        self.preview_linear = None
+        self.preview_params = None
+        # 正在后台跑的预览请求 (图片序号, 待采样尺寸)，相同请求不重复提交
+        self.preview_request = None
+
+        # 预览和导出共用一个后台线程，UI 线程只负责提交任务和接收结果
+        self.job_progress.connect(self.on_job_progress)
+        self.job_finished.connect(self.on_job_finished)
+        self.job_failed.connect(self.on_job_failed)
+        self.worker = core.BackgroundWorker(self.job_progress.emit, self.job_finished.emit, self.job_failed.emit)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        if not getattr(self, "_warmed_up", False):
+            self._warmed_up = True
+            core.profile_mark("窗口显示")
+            # 窗口出来之后再在后台预热 numpy / PIL，用户拖图进来时已经就绪；imageio 仍等到真正需要时才加载
+            self.worker.submit("warmup", self._warmup_job)
+
+    def _warmup_job(self, job):
+        # 访问一次属性就会触发 LazyModule 的真正导入
+        core.np.ndarray
+        core.Image.Image
+
+    def dragEnterEvent(self, event):
+        if event.mimeData().hasUrls():
+            event.accept()
+        else:
+            event.ignore()
+
+    def dropEvent(self, event):
+        if event.mimeData().hasUrls():
+            url = event.mimeData().urls()[0]
+            filePath = url.toLocalFile()
+            if os.path.isfile(filePath):
+                self.open_image(filePath)
+
+    def on_browse(self):
+        fname, _ = QtWidgets.QFileDialog.getOpenFileName(self, "选取全景图片", "", "图片文件 (*.hdr *.exr *.jpg *.jpeg *.png)")
+        if fname:
+            self.open_image(fname)
+
+    def open_image(self, path):
+        self.input_path.setText(path)
+        self.load_image_and_update()
+
+    def on_outbrowse(self):
+        fname = QtWidgets.QFileDialog.getExistingDirectory(self, "选取输出文件夹")
+        if fname:
+            self.output_path.setText(fname)
+
+    def on_any_effect_checked(self):
+        self.preview_timer.start(80)
+
+    def load_image_and_update(self):
+        try:
+            input_path = self.input_path.text().strip()
+            if not os.path.isfile(input_path):
+                self.status.setText("图片文件不存在")
+                return
+            self.status.setText(f"正在读取: {os.path.basename(input_path)}")
+            # 大 .hdr 先降采样解码出预览，完整图在预览之后再读
+            self.worker.submit("load", self._load_job, input_path, core.rgbe_preview_step(input_path))
+        except Exception as e:
+            self.status.setText(f"读取图片失败: {e}")
+
+    def _load_job(self, job, path, step):
+        img = core.read_hdr(path, step)
+        job.check()
+        return path, img, core.build_equirect_pyramid(img), step
+
+    def set_loaded_image(self, result):
+        path, img, pyramid, step = result
+        self.eq_img = img
+        self.eq_pyramid = pyramid
+        self.eq_img_step = step
+        self.image_serial += 1
+        self.linear_cache.clear()
+        self.preview_request = None
+        if step > 1:
+            self.status.setText(f"预览已就绪 (1/{step} 解码): {os.path.basename(path)}，完整图片载入中...")
+            self._do_preview()
+            self.worker.submit("load", self._load_job, path, 1)
+        else:
+            self.status.setText(f"图片读取成功: {os.path.basename(path)}, shape: {img.shape}")
+            self._do_preview()
+
+    def on_scale_change(self):
+        val = self.scale_slider.value() / 10.0
+        self.scale_edit.setText(f"{val:.2f}")
+        self.preview_timer.start(80)  # 80ms防抖
+
+    def on_scale_edit_change(self):
+        try:
+            val = float(self.scale_edit.text())
+            val = max(0.1, min(val, 10.0))
+            idx = int(round(val * 10))
+            self.scale_slider.setValue(idx)
+            self.scale_edit.setText(f"{val:.2f}")
+            self.preview_timer.start(80)
+        except:
+            self.scale_edit.setText("1.00")
+
+    def _do_preview(self):
+        if self.eq_img is None:
+            return
+        try:
+            scale = float(self.scale_edit.text())
+            tonemap = self.tonemap_checkbox.isChecked()
+            gamma = self.gamma_checkbox.isChecked()
+            self.preview_params = (scale, tonemap, gamma)
+            export_size = int(self.cube_size_box.currentText())
+            sizes = {self.preview_first_size, self.preview_cubesize}
+            if self.refine_checkbox.isChecked():
+                sizes.add(export_size)
+            cached = [n for n in sizes if (self.image_serial, n) in self.linear_cache]
+            if cached:
+                # 只改了缩放/Tonemap/Gamma：直接在缓存上做后处理，不再重新采样
+                key = (self.image_serial, max(cached))
+                self.set_preview_faces((key, self.linear_cache[key]))
+            todo = tuple(sorted(n for n in sizes if not cached or n > max(cached)))
+            request = (self.image_serial, todo)
+            if not todo:
+                self.worker.cancel("preview")
+                self.preview_request = None
+            elif request != self.preview_request:
+                self.preview_request = request
+                self.worker.submit("preview", self._preview_job, self.eq_img, self.eq_pyramid,
+                                   self.image_serial, todo, export_size)
+        except Exception as e:
+            self.status.setText(f"生成预览失败: {e}")
+
+    def _preview_job(self, job, eq_img, pyramid, serial, sizes, export_size):
+        for n in sizes:
+            # 导出分辨率那一级用原图采样，保证和导出结果一致；更小的预览从金字塔里取够用的一级
+            src = eq_img if n == export_size else core.pick_pyramid_level(pyramid, n)
+            linear = core.sample_cube_faces_linear(src, n, lambda i: job.progress(i + 1, 6, f"预览 {n}²"))
+            job.deliver(((serial, n), linear))
+        return None
+
+    def on_job_progress(self, kind, token, percent, text):
+        if not self.worker.is_current(kind, token):
+            return
+        self.progress.setValue(percent)
+        self.progress.setFormat(f"{text} %p%")
+        self.progress.show()
+
+    def on_job_finished(self, kind, token, result):
+        if kind == "warmup":
+            core.profile_mark("后台预热完成")
+            return
+        if kind == "load":
+            if self.worker.is_current(kind, token):
+                self.set_loaded_image(result)
+        elif kind == "preview":
+            if not self.worker.is_current(kind, token):
+                return
+            if result is None:
+                self.preview_request = None
+            else:
+                self.set_preview_faces(result)
+                return
+        else:
+            self.status.setText(result)
+        self.progress.hide()
+
+    def on_job_failed(self, kind, token, message):
+        current = self.worker.is_current(kind, token)
+        # 和 on_job_finished 一样，被新任务取代的旧任务不能改状态栏、更不能藏掉新任务的进度条；
+        # 导出任务不合并，每次失败都要告诉用户
+        if not current and kind != "export":
+            return
+        if kind == "preview":
+            self.preview_request = None
+        prefix = {"warmup": "加载依赖失败", "load": "读取图片失败", "preview": "生成预览失败", "export": "导出失败"}[kind]
+        self.status.setText(f"{prefix}: {message}")
+        if current:
+            self.progress.hide()
+
+    @QtCore.pyqtSlot(object)
+    def set_preview_faces(self, result):
+        key, linear = result
+        if key[0] != self.image_serial:
+            return  # 旧图片的结果
+        keep = {self.preview_first_size, self.preview_cubesize, int(self.cube_size_box.currentText()), key[1]}
+        for stale in [k for k in self.linear_cache if k[1] not in keep]:
+            del self.linear_cache[stale]
+        self.linear_cache[key] = linear
+        self.preview_linear = linear
+        # 6个面都按需后处理，切换预览面时再算
+        self.faces = [None] * 6
+        self.update_preview()
+
+    def update_preview(self):
+        if self.faces is None:
+            return
+        idx = self.face_select.currentIndex()
+        if self.faces[idx] is None:
+            scale, tonemap, gamma = self.preview_params
+            self.faces[idx] = core.apply_display_transform(self.preview_linear[idx], scale, tonemap, gamma)
+        img = core.Image.fromarray(self.faces[idx], "RGB")
+        data = img.convert("RGBA").tobytes("raw", "RGBA")
+        qimg = QtGui.QImage(data, img.width, img.height, QtGui.QImage.Format_RGBA8888)
+        pix = QtGui.QPixmap.fromImage(qimg)
+        target_size = self.preview_label.size()
+        pix = pix.scaled(target_size, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
+        self.preview_label.setPixmap(pix)
+
+    def on_save(self):
+        self._start_export({"faces"})
+
+    def on_save_combined(self):
+        self._start_export({"cross"})
+
+    def on_save_all(self):
+        self._start_export({"faces", "cross"})
+
+    def _start_export(self, layouts):
+        """在 UI 线程里读取导出参数，后台任务不碰任何控件"""
+        try:
+            if self.eq_img is None:
+                self.status.setText("请先载入图片")
+                return
+            if self.eq_img_step > 1:
+                self.status.setText("完整图片仍在载入，请稍候再导出")
+                return
+            output_dir = self.output_path.text().strip()
+            if output_dir == '':
+                output_dir = os.path.dirname(self.input_path.text().strip())
+            os.makedirs(output_dir, exist_ok=True)
+            cube_size = int(self.cube_size_box.currentText())
+            scale = float(self.scale_edit.text())
+            tonemap = self.tonemap_checkbox.isChecked()
+            gamma = self.gamma_checkbox.isChecked()
+            layouts = set(layouts)
+            if self.vstrip_checkbox.isChecked():
+                layouts.add("vstrip")
+            if self.hstrip_checkbox.isChecked():
+                layouts.add("hstrip")
+            # 预览细化到导出分辨率时已有原图采样的线性面，直接复用
+            linear = self.linear_cache.get((self.image_serial, cube_size))
+            self.status.setText("正在导出高分辨率图片，请稍候...")
+            # 导出任务不合并：连续点两次就导出两次，不会互相取消
+            self.worker.submit("export", self._export_job, self.eq_img, linear, output_dir, cube_size,
+                               scale, tonemap, gamma, layouts, coalesce=False)
+        except Exception as e:
+            self.status.setText(f"导出失败: {e}")
+
+    def _export_job(self, job, eq_img, linear, output_dir, cube_size, scale, tonemap, gamma, layouts):
+        """采样一次，所有布局共用同一块6面缓冲"""
+        timings = {}
+        faces = core.render_cube_faces(eq_img, cube_size, scale, tonemap, gamma, linear, timings,
+                                  lambda i: job.progress(i + 1, 6, "采样+后处理"))
+        t0 = time.perf_counter()
+        images = core.cube_layout_images(faces, layouts)
+        timings["排版"] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        paths = core.save_pngs_parallel(images, output_dir, lambda k: job.progress(k, len(images), "PNG编码"))
+        timings["PNG编码"] = time.perf_counter() - t0
+        stages = " · ".join(f"{name} {sec:.2f}s" for name, sec in timings.items())
+        return f"导出完成: {len(paths)} 个文件 -> {output_dir} | {stages}"
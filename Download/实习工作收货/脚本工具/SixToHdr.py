@@ -1,15 +1,38 @@
 import os
+import sys
 import glob
+import struct
+import hashlib
+import importlib.metadata
+import argparse
 import numpy as np
-import torch
-import clip
 import imageio.v3 as iio
 from PIL import Image
 
 cube_dir = r"C:\Users\baolin.yin\Desktop\tex\hdr"
-cube_pattern = os.path.join(cube_dir, "[1-6].png")
-output_name = "output_equirectangular.png"
+cube_glob = "[1-6].png"
+output_name = "output_equirectangular.png"  # 扩展名决定格式：.hdr(RGBE) / .exr / .tif(半精度浮点) / 其它为8位
 output_w, output_h = 2048, 1024
+# "bilinear"：跨面边双线性；"nearest"：与旧逐像素循环逐位一致。命令行 --filter 可覆盖
+# 注意：默认值已从旧版的最近邻改为 bilinear，输出与旧版不再逐像素一致，需要复现旧输出时用 --filter nearest
+sample_filter = "bilinear"
+# "geometry"：按面边连续性识别（无需torch）；"clip"：CLIP文本提示识别。命令行 --detect 可覆盖
+# 注意：默认值已从旧版的CLIP改为geometry，需要旧行为时用 --detect clip
+face_detect = "geometry"
+match_size = 64              # 几何识别时把每个面缩小到的边长，只影响速度与抗噪
+match_beam = 4096            # 几何识别每层最多保留的候选数，限制低对比度输入的耗时与内存
+chunk_rows = 128             # 每块处理的输出行数，8K输出时每块约百MB级临时内存
+clip_model = "ViT-B/32"
+clip_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "sixtohdr")  # 文本特征磁盘缓存
+CLIP_PROMPTS = (
+    "sky or ceiling or clouds view",   # +Y
+    "ground or floor or earth view",   # -Y
+    "look forward outdoor",            # +Z
+    "look back indoor",                # -Z
+    "look right",                      # +X
+    "look left",                       # -X
+)
+FACE_NAMES = ['+X', '-X', '+Y', '-Y', '+Z', '-Z']
 
 def read_img(path):
     img = Image.open(path)
@@ -17,8 +40,11 @@ def read_img(path):
     arr = arr if arr.ndim == 3 else np.stack([arr]*3, axis=-1)
     if arr.shape[2] > 3:
         arr = arr[..., :3]
+    # 位深要在转float之前判断（旧代码转完再判断，16位面总被除以255）；
+    # Pillow把16位RGB PNG解成8位，只有16位灰度等单通道图会以uint16到这里
+    scale = 65535.0 if arr.dtype == np.uint16 else 255.0
     arr = arr.astype(np.float32)
-    arr /= 65535.0 if arr.dtype == np.uint16 else 255.0
+    arr /= scale
     return arr
 
 def img_for_clip(path):
@@ -27,26 +53,66 @@ def img_for_clip(path):
     arr = (arr * 255).astype('uint8')
     return Image.fromarray(arr)
 
+# 进程内缓存：(模型名, 设备) -> (model, preprocess) / 文本特征张量；批量处理多组Cube时模型只加载一次
+_clip_models = {}
+_clip_text_features = {}
+
+def load_clip(device):
+    key = (clip_model, device)
+    if key not in _clip_models:
+        import clip
+        print(f"[INFO] 加载CLIP模型 {clip_model}（{device}）")
+        _clip_models[key] = clip.load(clip_model, device=device)
+    return _clip_models[key]
+
+def clip_package_version(clip):
+    try:
+        return importlib.metadata.version("clip")
+    except importlib.metadata.PackageNotFoundError:
+        return getattr(clip, "__version__", "unknown")
+
+def clip_text_features(model, device):
+    """提示词的文本特征只算一次：先查进程内缓存，再查磁盘缓存，都没有才跑encode_text
+
+    磁盘缓存统一存float32；设备、模型精度、clip/torch版本都进缓存键，
+    GPU半精度算出的特征不会被CPU复用，升级clip后也不会读到旧特征。
+    """
+    import torch
+    import clip
+    key = (clip_model, device)
+    if key in _clip_text_features:
+        return _clip_text_features[key]
+    dtype = next(model.parameters()).dtype
+    parts = (clip_model, device, str(dtype), clip_package_version(clip), torch.__version__) + CLIP_PROMPTS
+    digest = hashlib.md5("\n".join(parts).encode("utf-8")).hexdigest()
+    path = os.path.join(clip_cache_dir, f"text_{digest}.npy")
+    feats = None
+    if os.path.exists(path):
+        try:
+            feats = np.load(path)
+        except (OSError, ValueError, EOFError):
+            pass  # 损坏的缓存文件直接重算覆盖
+    if feats is None or feats.dtype != np.float32 or feats.shape[:1] != (len(CLIP_PROMPTS),):
+        with torch.no_grad():
+            feats = model.encode_text(clip.tokenize(list(CLIP_PROMPTS)).to(device)).float().cpu().numpy()
+        feats = feats.astype(np.float32, copy=False)
+        os.makedirs(clip_cache_dir, exist_ok=True)
+        tmp = path + f".{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, feats)
+        os.replace(tmp, path)
+    _clip_text_features[key] = torch.from_numpy(feats).to(device)
+    return _clip_text_features[key]
+
 def detect_cube_faces(files):
+    import torch
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    model, preprocess = clip.load("ViT-B/32", device=device)
-    prompts = [
-        "sky or ceiling or clouds view",   # +Y
-        "ground or floor or earth view",   # -Y
-        "look forward outdoor",            # +Z
-        "look back indoor",                # -Z
-        "look right",                      # +X
-        "look left"                        # -X
-    ]
-    text = clip.tokenize(prompts).to(device)
-    imgs = [img_for_clip(path) for path in files]
-    scores = np.zeros((6,6))
+    model, preprocess = load_clip(device)
+    text_feat = clip_text_features(model, device)
+    batch = torch.stack([preprocess(img_for_clip(path)) for path in files]).to(device)
     with torch.no_grad():
-        for i, img in enumerate(imgs):
-            img_tensor = preprocess(img).unsqueeze(0).to(device)
-            feat = model.encode_image(img_tensor)
-            logit = (feat @ model.encode_text(text).T).cpu().numpy()
-            scores[i,:] = logit
+        feat = model.encode_image(batch).float()  # 6张图一次前向
+        scores = (feat @ text_feat.T).cpu().numpy().astype(np.float64)
     assigned = [-1]*6
     used = set()
     for face in range(6):
@@ -61,10 +127,9 @@ def detect_cube_faces(files):
         '+Z': assigned[2], '-Z': assigned[3],
         '+X': assigned[4], '-X': assigned[5],
     }
-    face_names = ['+X', '-X', '+Y', '-Y', '+Z', '-Z']
-    face_filenames = [files[mapping[x]] for x in face_names]
+    face_filenames = [files[mapping[x]] for x in FACE_NAMES]
     print("[INFO] Cube分面识别如下：")
-    for tag in face_names:
+    for tag in FACE_NAMES:
         print(f" {tag}: {files[mapping[tag]]}")
     return face_filenames
 
@@ -94,31 +159,426 @@ def texel_coord(size, sc, tc):
     v = (tc + 1) * 0.5 * (size - 1)
     return int(np.clip(u, 0, size-1)), int(np.clip(v, 0, size-1))
 
-def convert_cube_to_equirectangular(face_filenames, output_name, w, h):
+def directions_to_cube_faces(dx, dy, dz):
+    """direction_to_cube_face的数组版：一次分类全部方向，平局判定顺序与标量版一致（X优先于Y优先于Z）"""
+    ax, ay, az = np.abs(dx), np.abs(dy), np.abs(dz)
+    ma = np.maximum(np.maximum(ax, ay), az)
+    on_x = ax == ma
+    on_y = ~on_x & (ay == ma)
+    face_idx = np.where(on_x, np.where(dx > 0, 0, 1),
+                        np.where(on_y, np.where(dy > 0, 2, 3), np.where(dz > 0, 4, 5)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv = 1.0 / ma
+    sc = np.select([face_idx == 0, face_idx == 1, face_idx == 5], [-dz, dz, -dx], dx) * inv
+    tc = np.select([face_idx == 2, face_idx == 3], [dz, -dz], -dy) * inv
+    return face_idx, sc, tc
+
+def cube_face_directions(face_idx, sc, tc):
+    """directions_to_cube_faces的逆映射：面内坐标(sc,tc)还原为方向（未归一化）"""
+    one = np.ones_like(sc)
+    table = [
+        (one, -tc, -sc),   # +X
+        (-one, -tc, sc),   # -X
+        (sc, one, tc),     # +Y
+        (sc, -one, -tc),   # -Y
+        (sc, -tc, one),    # +Z
+        (-sc, -tc, -one),  # -Z
+    ]
+    return table[face_idx]
+
+def pad_cube_faces(cube_faces):
+    """给每个面外扩1像素边框，边框取相邻面上对应方向的最近像素，使双线性插值可以跨越面边"""
+    size = cube_faces[0].shape[0]
+    faces = np.stack([f[..., :3] for f in cube_faces]).astype(np.float32, copy=False)
+    padded = np.zeros((6, size + 2, size + 2, 3), dtype=np.float32)
+    padded[:, 1:-1, 1:-1] = faces
+    coord = (np.arange(size + 2) - 0.5) * 2.0 / size - 1.0  # 外扩后每个像素中心的面内坐标
+    tc, sc = np.meshgrid(coord, coord, indexing="ij")
+    ring = np.ones((size + 2, size + 2), dtype=bool)
+    ring[1:-1, 1:-1] = False
+    sc, tc = sc[ring], tc[ring]
+    for face in range(6):
+        idx, s2, t2 = directions_to_cube_faces(*cube_face_directions(face, sc, tc))
+        ix = np.clip(np.floor((s2 + 1) * 0.5 * size), 0, size - 1).astype(np.intp)
+        iy = np.clip(np.floor((t2 + 1) * 0.5 * size), 0, size - 1).astype(np.intp)
+        padded[face][ring] = faces[idx, iy, ix]
+    return padded
+
+# 几何识别时的填面顺序：+Y与四个侧面都相邻，侧面按环绕顺序，使每一层都尽早凑齐可打分的面边
+MATCH_SLOT_ORDER = (2, 0, 4, 1, 5, 3)
+
+def shrink_face(face, target):
+    """按整数倍块平均把面缩小到不超过target，块平均保证各面边缘像素仍一一对应"""
+    k = max(1, face.shape[0] // target)
+    n = face.shape[0] // k * k
+    face = face[:n, :n, :3]
+    return face.reshape(n // k, k, n // k, k, 3).mean(axis=(1, 3))
+
+def cube_edge_texels(size):
+    """列出立方体12条面边两侧对应的边缘像素：(面f, 行, 列, 相邻面g, 行, 列)，各为长度size的数组"""
+    edges = []
+    inner = (np.arange(size) + 0.5) * 2.0 / size - 1.0
+    outer = 1.0 + 1.0 / size  # 面外半个像素处的坐标，落到相邻面上
+    last = np.full(size, size - 1)
+    first = np.zeros(size, dtype=np.intp)
+    cols = np.arange(size)
+    sides = [  # (sc, tc, 本面行, 本面列)
+        (inner, np.full(size, -outer), first, cols),
+        (inner, np.full(size, outer), last, cols),
+        (np.full(size, -outer), inner, cols, first),
+        (np.full(size, outer), inner, cols, last),
+    ]
+    for face in range(6):
+        for sc, tc, rows, cols_ in sides:
+            idx, s2, t2 = directions_to_cube_faces(*cube_face_directions(face, sc, tc))
+            g = int(idx[size // 2])
+            if g < face:  # 每条边只保留一次
+                continue
+            ix = np.clip(np.floor((s2 + 1) * 0.5 * size), 0, size - 1).astype(np.intp)
+            iy = np.clip(np.floor((t2 + 1) * 0.5 * size), 0, size - 1).astype(np.intp)
+            edges.append((face, rows, cols_, g, iy, ix))
+    return edges
+
+def face_up_weights(rotated, n):
+    """up[面, 选择]：该选择放到该面时，亮度加权方向的竖直分量之和，各面相加即整个立方体的“亮处朝上”程度"""
+    coord = (np.arange(n) + 0.5) * 2.0 / n - 1.0
+    tc, sc = np.meshgrid(coord, coord, indexing="ij")
+    luminance = np.stack([img.mean(axis=-1) for img in rotated])
+    up = np.empty((6, len(rotated)))
+    for face in range(6):
+        dx, dy, dz = cube_face_directions(face, sc, tc)
+        dy = dy / np.sqrt(dx * dx + dy * dy + dz * dz)
+        up[face] = (luminance * dy).sum(axis=(1, 2)) / (n * n)
+    return up
+
+def cube_rotation_table():
+    """立方体的24种整体旋转对应的(面置换, 面内旋转)：旋转后面f的内容落到面perm[f]，且需再np.rot90 quarter[f]次"""
+    coord = (np.arange(3) + 0.5) * 2.0 / 3 - 1.0  # 3x3纹素中心足以分辨4种面内旋转
+    tc, sc = np.meshgrid(coord, coord, indexing="ij")
+    texel = np.arange(9).reshape(3, 3)
+    table = []
+    for axes in ((0, 1, 2), (0, 2, 1), (1, 0, 2), (1, 2, 0), (2, 0, 1), (2, 1, 0)):
+        for signs in np.ndindex(2, 2, 2):
+            rot = np.zeros((3, 3))
+            rot[range(3), axes] = [1 - 2 * k for k in signs]
+            if np.linalg.det(rot) < 0:
+                continue
+            perm, quarter = [], []
+            for face in range(6):
+                d = np.einsum("ij,j...->i...", rot, np.stack(cube_face_directions(face, sc, tc)))
+                idx, s2, t2 = directions_to_cube_faces(*d)
+                moved = np.empty_like(texel)
+                moved[np.floor((t2 + 1) * 1.5).astype(np.intp), np.floor((s2 + 1) * 1.5).astype(np.intp)] = texel
+                perm.append(int(idx[0, 0]))
+                quarter.append(next(q for q in range(4) if (np.rot90(texel, q) == moved).all()))
+            table.append((perm, quarter))
+    return table
+
+def identify_cube_faces(files, faces=None):
+    """按面边像素连续性识别6张图各是哪个面以及旋转了几次，不需要任何模型。
+
+    候选布局为6!·4^6种（每张图放到哪个面、逆时针旋转0~3次），逐层扩展并用
+    “已得代价+剩余边代价下界”剪枝，每层最多保留match_beam个；贪心解已达下界时直接采用。
+    连续性对整个立方体的24种整体旋转不敏感，最优解展开成这24种等价解后先按重力方向取：亮度加权的平均方向
+    最接近+Y的（天空在上），即使输入图片本身被旋转过也成立；绕竖直轴的4种转动无法从内容区分，
+    再依次优先侧面旋转次数少的、文件顺序最接近原顺序的。
+    返回按FACE_NAMES顺序的(文件名, 旋转次数)，旋转次数k表示该面=np.rot90(原图, k)。
+    """
+    if faces is None:
+        faces = [read_img(path) for path in files]
+    size = min(f.shape[0] for f in faces)
+    small = [shrink_face(f, min(match_size, size)) for f in faces]
+    n = min(f.shape[0] for f in small)
+    rotated = [np.rot90(f[:n, :n], r) for f in small for r in range(4)]  # 选择编号 = 图*4+旋转
+    image_of = np.repeat(np.arange(6), 4)
+    same_image = image_of[:, None] == image_of[None, :]
+    # 每条边一个24x24代价矩阵：两侧边缘像素的平均绝对差
+    costs = {}
+    for f, rf, cf, g, rg, cg in cube_edge_texels(n):
+        a = np.stack([img[rf, cf] for img in rotated])
+        b = np.stack([img[rg, cg] for img in rotated])
+        c = np.abs(a[:, None] - b[None, :]).mean(axis=(2, 3))
+        c[same_image] = np.inf
+        costs[(f, g)] = c
+    level_of = {slot: i for i, slot in enumerate(MATCH_SLOT_ORDER)}
+    # 第i层新凑齐的边：(已填面所在的列, 代价矩阵，行=已填面的选择，列=新面的选择)
+    level_edges = [[] for _ in MATCH_SLOT_ORDER]
+    for (f, g), c in costs.items():
+        if level_of[f] < level_of[g]:
+            level_edges[level_of[g]].append((level_of[f], c))
+        else:
+            level_edges[level_of[f]].append((level_of[g], c.T))
+    edge_min = [sum(c.min() for _, c in edges) for edges in level_edges]
+    remaining = np.cumsum(edge_min[::-1])[::-1].tolist() + [0.0]  # remaining[i]：第i层及以后的下界
+
+    def extend(assign, total):
+        level = assign.shape[1]
+        ext = np.repeat(total[:, None], 24, axis=1)
+        for col, c in level_edges[level]:
+            ext += c[assign[:, col]]
+        used = np.zeros((len(assign), 6), dtype=bool)
+        np.put_along_axis(used, image_of[assign], True, axis=1)
+        ext[used[:, image_of]] = np.inf
+        return ext
+
+    # 先贪心走一条完整路径得到上界
+    assign = np.zeros((1, 0), dtype=np.intp)
+    total = np.zeros(1)
+    for level in range(6):
+        ext = extend(assign, total)
+        k = int(np.argmin(ext[0]))
+        assign = np.hstack([assign, [[k]]])
+        total = ext[0, [k]]
+    bound = float(total[0])
+    tol = 1e-6 * (1.0 + bound)
+
+    # 贪心路径已达到下界时它就是最优解，不必再搜；否则逐层扩展，每层只保留下界最小的match_beam个，
+    # 纯色、阴天等低对比度的面几乎剪不掉候选，不限宽度时会膨胀到上百万行
+    if bound > remaining[0] + tol:
+        greedy, greedy_total = assign, total
+        assign = np.zeros((1, 0), dtype=np.intp)
+        total = np.zeros(1)
+        for level in range(6):
+            ext = extend(assign, total).ravel()
+            score = ext + remaining[level + 1]
+            keep = np.flatnonzero(score <= bound + tol)
+            if len(keep) > match_beam:
+                keep = keep[np.argsort(score[keep], kind="stable")[:match_beam]]
+            assign = np.hstack([assign[keep // 24], (keep % 24)[:, None]])
+            total = ext[keep]
+        if not len(total):
+            assign, total = greedy, greedy_total
+    best = total.min()
+    ties = assign[total <= best + 1e-6 * (1.0 + best)]
+
+    # 把每个最优解展开成24种整体旋转，截断的搜索也不会漏掉天空朝上的那一种
+    slot_col = [MATCH_SLOT_ORDER.index(slot) for slot in range(6)]
+    ties = ties[:, slot_col]  # 列按FACE_NAMES顺序
+    by_slot = np.empty((len(ties) * 24, 6), dtype=np.intp)
+    for i, (perm, quarter) in enumerate(cube_rotation_table()):
+        by_slot[i::24][:, perm] = image_of[ties] * 4 + (ties % 4 + quarter) % 4
+    up = face_up_weights(rotated, n)
+    gravity = up[np.arange(6), by_slot].sum(axis=1)
+    upright = gravity >= gravity.max() - 1e-6 * (1.0 + np.abs(gravity).max())
+    by_slot = by_slot[upright]
+    imgs, rots = image_of[by_slot], by_slot % 4
+    side = [0, 1, 4, 5]
+    order = np.lexsort(tuple(imgs[:, k] for k in reversed(range(6))) + (
+        np.count_nonzero(rots[:, side], axis=1),
+    ))
+    pick = order[0]
+    result = [(files[imgs[pick, k]], int(rots[pick, k])) for k in range(6)]
+    print(f"[INFO] Cube分面几何识别如下（面边平均差 {best / 12:.4f}，候选 {len(assign)} 个）：")
+    for tag, (path, rot) in zip(FACE_NAMES, result):
+        print(f" {tag}: {path}" + (f"（逆时针旋转{rot * 90}°）" if rot else ""))
+    return result
+
+def iter_equirect_rows(cube_faces, w, h, rows=None, filter=None):
+    """按行块生成等距柱状投影结果，产出(y0, block)，block为(行数, w, 3)的float32；内存只与块大小相关"""
+    rows = rows or chunk_rows
+    filter = filter or sample_filter
+    size = cube_faces[0].shape[0]
+    theta = 2 * np.pi * (np.arange(w) + 0.5) / w - np.pi
+    cos_t, sin_t = np.cos(theta), np.sin(theta)
+    if filter == "nearest":
+        faces = np.stack([f[..., :3] for f in cube_faces]).astype(np.float32, copy=False)
+    elif filter == "bilinear":
+        faces = pad_cube_faces(cube_faces)
+        stride = size + 2
+        flat = faces.reshape(-1, 3)
+    else:
+        raise ValueError(f"未知的采样方式: {filter}")
+    for y0 in range(0, h, rows):
+        phi = np.pi * (np.arange(y0, min(y0 + rows, h)) + 0.5) / h
+        sin_p = np.sin(phi)[:, None]
+        dx = sin_p * cos_t
+        dy = np.broadcast_to(np.cos(phi)[:, None], dx.shape)
+        dz = -sin_p * sin_t
+        idx, sc, tc = directions_to_cube_faces(dx, dy, dz)
+        if filter == "nearest":
+            # 与texel_coord相同的取整方式
+            ix = np.clip((sc + 1) * 0.5 * (size - 1), 0, size - 1).astype(np.intp)
+            iy = np.clip((tc + 1) * 0.5 * (size - 1), 0, size - 1).astype(np.intp)
+            yield y0, faces[idx, iy, ix]
+            continue
+        # 像素中心约定，外扩边框后坐标+1；范围落在[0.5, size+0.5]内，无需越界判断
+        u = (sc + 1) * 0.5 * size + 0.5
+        v = (tc + 1) * 0.5 * size + 0.5
+        ix = np.minimum(u.astype(np.intp), size)
+        iy = np.minimum(v.astype(np.intp), size)
+        fx = (u - ix).astype(np.float32)[..., None]
+        fy = (v - iy).astype(np.float32)[..., None]
+        base = (idx * stride + iy) * stride + ix
+        top = flat.take(base, axis=0)
+        top += (flat.take(base + 1, axis=0) - top) * fx
+        bottom = flat.take(base + stride, axis=0)
+        bottom += (flat.take(base + stride + 1, axis=0) - bottom) * fx
+        top += (bottom - top) * fy
+        yield y0, top
+
+def to_half(block):
+    return np.clip(np.nan_to_num(block, nan=0.0, posinf=65504.0), 0.0, 65504.0).astype(np.float16)
+
+def rgbe_encode(block):
+    """(行, w, 3) float -> (行, w, 4) uint8 的RGBE像素"""
+    block = np.clip(np.nan_to_num(block, nan=0.0, posinf=1e38), 0.0, 1e38)
+    v = block.max(axis=-1)
+    mant, expo = np.frexp(v)
+    lit = v > 1e-32
+    scale = np.where(lit, mant * 256.0 / np.where(lit, v, 1.0), 0.0)
+    rgbe = np.empty(block.shape[:2] + (4,), dtype=np.uint8)
+    rgbe[..., :3] = np.minimum(block * scale[..., None], 255.0)
+    rgbe[..., 3] = np.where(lit, expo + 128, 0)
+    return rgbe
+
+def rgbe_scanlines(rgbe):
+    """按新式RLE扫描线编码：每行写行头，每个通道拆成最多128字节的原样段；
+    不做游程压缩，但避免了平铺格式中首像素恰为(2,2,x,x)时被读成RLE行头的歧义"""
+    rows, w = rgbe.shape[:2]
+    if not 8 <= w < 32768:  # RLE只支持这个宽度范围，其余宽度读取端按平铺解析
+        return rgbe.tobytes()
+    nc = -(-w // 128)
+    length = w + nc
+    line = np.empty((rows, 4 + 4 * length), dtype=np.uint8)
+    line[:, :4] = (2, 2, w >> 8, w & 255)
+    body = line[:, 4:].reshape(rows, 4, length)
+    body[:, :, np.arange(nc) * 129] = np.minimum(128, w - np.arange(nc) * 128)
+    j = np.arange(w)
+    body[:, :, j + j // 128 + 1] = rgbe.transpose(0, 2, 1)
+    return line.tobytes()
+
+def write_rgbe(path, w, h, blocks):
+    with open(path, "wb") as f:
+        f.write(f"#?RADIANCE\nFORMAT=32-bit_rle_rgbe\n\n-Y {h} +X {w}\n".encode("ascii"))
+        for _, block in blocks:
+            f.write(rgbe_scanlines(rgbe_encode(block)))
+
+def exr_attr(name, kind, value):
+    return name.encode() + b"\0" + kind.encode() + b"\0" + struct.pack("<i", len(value)) + value
+
+def write_exr_half(path, w, h, blocks):
+    """无压缩、每块一行的单部件scanline EXR；偏移表可以提前算出，所以能边投影边写"""
+    channels = b"".join(c + b"\0" + struct.pack("<iB3xii", 1, 0, 1, 1) for c in (b"B", b"G", b"R")) + b"\0"
+    window = struct.pack("<iiii", 0, 0, w - 1, h - 1)
+    header = (struct.pack("<ii", 20000630, 2)
+              + exr_attr("channels", "chlist", channels)
+              + exr_attr("compression", "compression", b"\0")
+              + exr_attr("dataWindow", "box2i", window)
+              + exr_attr("displayWindow", "box2i", window)
+              + exr_attr("lineOrder", "lineOrder", b"\0")
+              + exr_attr("pixelAspectRatio", "float", struct.pack("<f", 1.0))
+              + exr_attr("screenWindowCenter", "v2f", struct.pack("<ff", 0.0, 0.0))
+              + exr_attr("screenWindowWidth", "float", struct.pack("<f", 1.0))
+              + b"\0")
+    line_bytes = 8 + 6 * w
+    first = len(header) + 8 * h
+    with open(path, "wb") as f:
+        f.write(header)
+        f.write((first + np.arange(h, dtype="<u8") * line_bytes).astype("<u8").tobytes())
+        for y0, block in blocks:
+            rows = len(block)
+            prefix = np.empty((rows, 2), dtype="<i4")
+            prefix[:, 0] = np.arange(y0, y0 + rows)
+            prefix[:, 1] = 6 * w
+            planes = to_half(block)[..., ::-1].transpose(0, 2, 1).astype("<f2")  # 通道按名字排序：B、G、R
+            f.write(np.concatenate([prefix.view(np.uint8), planes.reshape(rows, -1).view(np.uint8)], axis=1).tobytes())
+
+def write_tiff_half(path, w, h, blocks):
+    """16位浮点RGB、无压缩的TIFF，每个行块一个strip；strip偏移提前算出，行块到了直接写"""
+    blocks = iter(blocks)
+    _, first_block = next(blocks)
+    rows = len(first_block)
+    strips = -(-h // rows)
+    counts = [min(rows, h - i * rows) * w * 6 for i in range(strips)]
+    if sum(counts) > 0xFFFFFFFF - 4096:
+        raise ValueError("输出超过4GB，经典TIFF无法保存，请改用.exr或.hdr")
+    entries = [  # (tag, 类型 3=SHORT 4=LONG, 值)
+        (256, 4, [w]), (257, 4, [h]), (258, 3, [16, 16, 16]), (259, 3, [1]), (262, 3, [2]),
+        (273, 4, None), (277, 3, [3]), (278, 4, [rows]), (279, 4, counts), (284, 3, [1]),
+        (339, 3, [3, 3, 3]),
+    ]
+    ifd_size = 2 + 12 * len(entries) + 4
+    extra_at = 8 + ifd_size
+    extra_size = sum(len(v) * (2 if t == 3 else 4) for tag, t, v in entries
+                     if v is not None and len(v) * (2 if t == 3 else 4) > 4)
+    extra_size += 4 * strips if strips > 1 else 0
+    data_at = extra_at + extra_size
+    offsets = [data_at + sum(counts[:i]) for i in range(strips)]
+    ifd, extra = [struct.pack("<H", len(entries))], []
+    for tag, kind, values in entries:
+        values = offsets if values is None else values
+        packed = struct.pack(f"<{len(values)}{'H' if kind == 3 else 'I'}", *values)
+        if len(packed) <= 4:
+            ifd.append(struct.pack("<HHI", tag, kind, len(values)) + packed.ljust(4, b"\0"))
+        else:
+            ifd.append(struct.pack("<HHII", tag, kind, len(values), extra_at + sum(map(len, extra))))
+            extra.append(packed)
+    ifd.append(struct.pack("<I", 0))
+    with open(path, "wb") as f:
+        f.write(b"II*\0" + struct.pack("<I", 8) + b"".join(ifd) + b"".join(extra))
+        f.write(to_half(first_block).astype("<f2").tobytes())
+        for _, block in blocks:
+            f.write(to_half(block).astype("<f2").tobytes())
+
+# 浮点输出：按行块编码写盘，峰值内存只与chunk_rows成正比
+HDR_WRITERS = {".hdr": write_rgbe, ".exr": write_exr_half, ".tif": write_tiff_half, ".tiff": write_tiff_half}
+
+def convert_cube_to_equirectangular(face_filenames, output_name, w, h, rotations=None, filter=None):
     cube_faces = [read_img(fname) for fname in face_filenames]
-    face_size = cube_faces[0].shape[0]
-    out = np.zeros((h, w, 3), dtype=np.float32)
-    for y in range(h):
-        phi = np.pi * (y + 0.5) / h  # [0,pi]
-        for x in range(w):
-            theta = 2 * np.pi * (x + 0.5) / w - np.pi
-            dx = np.sin(phi) * np.cos(theta)
-            dy = np.cos(phi)
-            dz = -np.sin(phi) * np.sin(theta)
-            idx, sc, tc = direction_to_cube_face(dx, dy, dz)
-            ix, iy = texel_coord(face_size, sc, tc)
-            out[y, x, :] = cube_faces[idx][iy, ix, :3]
-    save = np.clip(out, 0, 1)
-    save = (save * 255).astype(np.uint8)
+    if rotations:
+        cube_faces = [np.rot90(face, k) for face, k in zip(cube_faces, rotations)]
+    blocks = iter_equirect_rows(cube_faces, w, h, filter=filter)
+    writer = HDR_WRITERS.get(os.path.splitext(output_name)[1].lower())
+    if writer:
+        writer(output_name, w, h, blocks)
+        print(f"[INFO] 已保存 {output_name}（浮点HDR）")
+        return output_name
+    save = np.empty((h, w, 3), dtype=np.uint8)
+    for y0, block in blocks:
+        save[y0:y0 + len(block)] = np.clip(block, 0, 1) * 255
     iio.imwrite(output_name, save)
-    print(f"[INFO] 已保存 {output_name}（8位PNG）。如需16位HDR请用TIFF/EXR保存")
-    return out
+    print(f"[INFO] 已保存 {output_name}（8位）。如需HDR请输出为 .hdr/.exr/.tif")
+    return output_name
+
+def find_cube_sets(root):
+    """递归查找root下所有含6张Cube贴图（cube_glob）的目录"""
+    sets = []
+    for dirpath, dirnames, _ in os.walk(root):
+        dirnames.sort()
+        if len(glob.glob(os.path.join(dirpath, cube_glob))) == 6:
+            sets.append(dirpath)
+    return sets
+
+def convert_cube_dir(cube_dir, output_path, detect=None, filter=None):
+    files = sorted(glob.glob(os.path.join(cube_dir, cube_glob)))
+    assert len(files) == 6, f"未找到6张Cube贴图: {cube_dir}"
+    if (detect or face_detect) == "clip":
+        face_filenames, rotations = detect_cube_faces(files), None
+    else:
+        face_filenames, rotations = zip(*identify_cube_faces(files))
+    return convert_cube_to_equirectangular(face_filenames, output_path, output_w, output_h, rotations, filter)
 
-def main():
-    files = sorted(glob.glob(cube_pattern))
-    assert len(files) == 6, "未找到6张Cube贴图"
-    face_filenames = detect_cube_faces(files)
-    convert_cube_to_equirectangular(face_filenames, output_name, output_w, output_h)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="六张Cube贴图拼成等距柱状全景图")
+    parser.add_argument("dirs", nargs="*", help=f"Cube贴图目录，每个目录含{cube_glob}，默认 {cube_dir}")
+    parser.add_argument("--batch", metavar="ROOT", help="批量模式：处理ROOT下所有含6张Cube贴图的子目录，CLIP模型常驻")
+    parser.add_argument("--detect", choices=("geometry", "clip"), default=face_detect,
+                        help=f"分面识别方式，默认 {face_detect}（旧版固定用CLIP）")
+    parser.add_argument("--filter", choices=("bilinear", "nearest"), default=sample_filter,
+                        help=f"采样滤波，默认 {sample_filter}（旧版为最近邻，复现旧输出时用 nearest）")
+    parser.add_argument("-o", "--output", default=output_name,
+                        help="输出文件名；处理多个目录时写到各自目录下")
+    args = parser.parse_args(argv)
+    dirs = list(args.dirs)
+    if args.batch:
+        dirs += find_cube_sets(args.batch)
+    if not dirs:
+        convert_cube_dir(cube_dir, args.output, args.detect, args.filter)
+        return
+    for i, d in enumerate(dirs):
+        print(f"[INFO] ({i + 1}/{len(dirs)}) {d}")
+        out_path = args.output if len(dirs) == 1 else os.path.join(d, os.path.basename(args.output))
+        convert_cube_dir(d, out_path, args.detect, args.filter)
 
 if __name__ == "__main__":
-    main()
+    main(sys.argv[1:])
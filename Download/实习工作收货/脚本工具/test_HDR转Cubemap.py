@@ -0,0 +1,191 @@
+import importlib.util
+import mmap
+import os
+import sys
+import types
+
+import numpy as np
+import pytest
+from PIL import Image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _load(name="hdr2cube_gui"):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(HERE, "HDR转Cubemap.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _write_flat_rgbe(path, rgbe, bottom_up=False):
+    h, w = rgbe.shape[:2]
+    header = f"#?RADIANCE\nFORMAT=32-bit_rle_rgbe\n\n{'+Y' if bottom_up else '-Y'} {h} +X {w}\n"
+    rows = rgbe[::-1] if bottom_up else rgbe
+    path.write_bytes(header.encode() + np.ascontiguousarray(rows, dtype=np.uint8).tobytes())
+
+
+def _random_rgbe(h, w):
+    rng = np.random.default_rng(0)
+    rgbe = rng.integers(128, 256, (h, w, 4)).astype(np.uint8)
+    rgbe[..., 3] = rng.integers(120, 140, (h, w))
+    return rgbe
+
+
+def _expected(rgbe):
+    return rgbe[..., :3] * np.ldexp(1.0, rgbe[..., 3].astype(np.int32) - 136)[..., None]
+
+
+def _track_mmaps(monkeypatch, tool):
+    opened = []
+
+    class TrackedMmap(mmap.mmap):
+        def __new__(cls, *args, **kwargs):
+            mm = super().__new__(cls, *args, **kwargs)
+            opened.append(mm)
+            return mm
+
+    monkeypatch.setattr(tool, "mmap", types.SimpleNamespace(mmap=TrackedMmap, ACCESS_READ=mmap.ACCESS_READ))
+    return opened
+
+
+def test_read_rgbe_returns_owned_contiguous_array_and_closes_mmap(monkeypatch, tmp_path):
+    tool = _load()
+    opened = _track_mmaps(monkeypatch, tool)
+    rgbe = _random_rgbe(12, 20)
+    top_down, bottom_up = tmp_path / "top.hdr", tmp_path / "bottom.hdr"
+    _write_flat_rgbe(top_down, rgbe)
+    _write_flat_rgbe(bottom_up, rgbe, bottom_up=True)
+    for path in (top_down, bottom_up):
+        for step in (1, 3):
+            img = tool.read_rgbe(str(path), step)
+            assert img.base is None and img.flags.c_contiguous
+            assert np.allclose(img, _expected(rgbe)[::step, ::step])
+    assert opened and all(mm.closed for mm in opened)
+
+
+def test_read_rgbe_closes_mmap_on_error(monkeypatch, tmp_path):
+    tool = _load()
+    opened = _track_mmaps(monkeypatch, tool)
+    path = tmp_path / "truncated.hdr"
+    _write_flat_rgbe(path, _random_rgbe(4, 4))
+    path.write_bytes(path.read_bytes()[:-3])
+    try:
+        tool.read_rgbe(str(path))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("截断的文件应抛 ValueError")
+    assert opened and all(mm.closed for mm in opened)
+
+
+def test_read_hdr_keeps_float_radiance_in_both_paths(monkeypatch, tmp_path):
+    tool = _load()
+    rgbe = _random_rgbe(8, 16)
+    hdr = tmp_path / "sky.hdr"
+    _write_flat_rgbe(hdr, rgbe)
+    native = tool.read_hdr(str(hdr))
+    assert native.max() > 2.0
+    # 通用解码 (如 EXR) 拿到同样的浮点数据时也不做缩放
+    monkeypatch.setattr(tool, "iio", types.SimpleNamespace(imread=lambda path, **kw: _expected(rgbe)))
+    exr = tmp_path / "sky.exr"
+    exr.write_bytes(b"")
+    assert np.allclose(tool.read_hdr(str(exr)), native)
+
+
+def test_run_cli_without_qt(monkeypatch, tmp_path):
+    # sys.modules 里放 None 时 import 直接抛 ImportError，等同于没装 PyQt5
+    for name in [m for m in sys.modules if m == "PyQt5" or m.startswith("PyQt5.")]:
+        monkeypatch.delitem(sys.modules, name)
+    monkeypatch.setitem(sys.modules, "PyQt5", None)
+    tool = _load()
+    src = tmp_path / "pano.png"
+    Image.fromarray((np.random.default_rng(0).random((32, 64, 3)) * 255).astype(np.uint8)).save(src)
+    assert tool.run_cli([str(src), "-o", str(tmp_path / "out"), "--size", "8", "-j", "1"]) == 0
+    out_dir = tmp_path / "out" / "pano" / tool.variant_dir_name(1.0, True, True)
+    assert len(list(out_dir.glob("*.png"))) == 6
+    assert "HDR转Cubemap_gui" not in sys.modules
+
+
+def test_main_needs_explicit_cli_subcommand(monkeypatch, tmp_path):
+    tool = _load()
+    monkeypatch.setattr(tool, "ensure_deps", lambda force=False, gui=True: None)
+    calls = []
+    monkeypatch.setattr(tool, "run_cli", lambda argv: calls.append(("cli", argv)) or 0)
+
+    class FakeWindow:
+        def show(self):
+            calls.append(("show",))
+
+        def open_image(self, path):
+            calls.append(("open", path))
+
+    fake_gui = types.SimpleNamespace(
+        QtWidgets=types.SimpleNamespace(QApplication=lambda argv: types.SimpleNamespace(exec_=lambda: 0)),
+        CubeMapGUI=FakeWindow)
+    monkeypatch.setattr(tool, "load_gui", lambda: fake_gui)
+
+    assert tool.main(["cli", "a.hdr", "--size", "8"]) == 0
+    assert calls == [("cli", ["a.hdr", "--size", "8"])]
+    calls.clear()
+    # 拖到脚本上的文件不会被当成命令行参数吞掉，而是在窗口里打开
+    assert tool.main(["dropped.hdr"]) == 0
+    assert calls == [("show",), ("open", "dropped.hdr")]
+
+
+@pytest.fixture
+def gui_window(monkeypatch):
+    """离屏创建真实窗口，返回 (脚本模块, 窗口模块, 窗口)"""
+    pytest.importorskip("PyQt5")
+    monkeypatch.setenv("QT_QPA_PLATFORM", "offscreen")
+    monkeypatch.delitem(sys.modules, "HDR转Cubemap", raising=False)
+    monkeypatch.delitem(sys.modules, "HDR转Cubemap_gui", raising=False)
+    monkeypatch.syspath_prepend(HERE)
+    tool = _load()
+    monkeypatch.setitem(sys.modules, tool.__name__, tool)
+    gui = tool.load_gui()
+    app = gui.QtWidgets.QApplication.instance() or gui.QtWidgets.QApplication([])
+    window = gui.CubeMapGUI()
+    yield tool, gui, window
+    window.close()
+    app.processEvents()
+
+
+def test_gui_module_shares_the_script_module(gui_window):
+    tool, gui, window = gui_window
+    assert gui.core is tool
+    assert window.face_select.count() == 6
+
+
+def test_stale_job_failure_keeps_current_status(gui_window):
+    _, _, window = gui_window
+    stale = window.worker.cancel("preview")
+    current = window.worker.cancel("preview")
+    window.status.setText("预览 128²")
+    window.progress.show()
+    window.on_job_failed("preview", stale, "boom")
+    assert window.status.text() == "预览 128²" and not window.progress.isHidden()
+    window.on_job_failed("preview", current, "boom")
+    assert window.status.text() == "生成预览失败: boom" and window.progress.isHidden()
+
+    # 导出任务不合并: 旧导出失败要提示，但不藏掉正在进行的导出的进度条
+    old_export = window.worker.cancel("export")
+    window.worker.cancel("export")
+    window.progress.show()
+    window.on_job_failed("export", old_export, "disk full")
+    assert window.status.text() == "导出失败: disk full" and not window.progress.isHidden()
+
+
+def test_linear_cache_keeps_only_current_export_size(gui_window):
+    _, _, window = gui_window
+    window.preview_params = (1.0, True, True)
+
+    def deliver(n):
+        window.set_preview_faces(((window.image_serial, n), [np.zeros((n, n, 3), np.float32)] * 6))
+
+    for n in (32, 128, 512):
+        deliver(n)
+    for text in ("1024", "2048"):
+        window.cube_size_box.setCurrentText(text)
+        deliver(int(text))
+    assert sorted(n for _, n in window.linear_cache) == [32, 128, 2048]
@@ -0,0 +1,181 @@
+import contextlib
+import importlib.util
+import os
+import re
+import sys
+import types
+
+import numpy as np
+from PIL import Image
+
+_spec = importlib.util.spec_from_file_location(
+    "sixtohdr", os.path.join(os.path.dirname(os.path.abspath(__file__)), "SixToHdr.py"))
+sixtohdr = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(sixtohdr)
+
+
+def _sky(dx, dy, dz):
+    """平滑的测试环境：上亮下暗的天空 + 随方位角变化的色调，各面边缘连续"""
+    n = np.sqrt(dx * dx + dy * dy + dz * dz)
+    x, y, z = dx / n, dy / n, dz / n
+    az = np.arctan2(z, x)
+    r = 0.45 + 0.35 * y + 0.15 * np.cos(az)
+    g = 0.45 + 0.30 * y + 0.15 * np.sin(2 * az)
+    b = 0.50 + 0.40 * y + 0.10 * np.cos(3 * az + 1.0)
+    return np.clip(np.stack([r, g, b], axis=-1), 0, 1)
+
+
+def _render_faces(size):
+    coord = (np.arange(size) + 0.5) * 2.0 / size - 1.0
+    tc, sc = np.meshgrid(coord, coord, indexing="ij")
+    return [_sky(*sixtohdr.cube_face_directions(face, sc, tc)) for face in range(6)]
+
+
+def _write_cube_set(directory, faces, order=range(6), dtype=np.uint8):
+    """按order把各面写成1.png..6.png，返回文件列表"""
+    directory.mkdir(parents=True, exist_ok=True)
+    peak = np.iinfo(dtype).max
+    files = []
+    for i, face in enumerate(order):
+        path = directory / f"{i + 1}.png"
+        Image.fromarray(np.round(faces[face] * peak).astype(dtype)).save(path)
+        files.append(str(path))
+    return files
+
+
+def test_read_img_normalizes_uint16_face(tmp_path):
+    path = tmp_path / "face16.png"
+    face = np.full((8, 8), 40000, dtype=np.uint16)
+    face[0, 0] = 65535
+    Image.fromarray(face).save(path)
+    img = sixtohdr.read_img(str(path))
+    assert img.dtype == np.float32 and img.shape == (8, 8, 3)
+    assert np.allclose(img[1:, 1:], 40000 / 65535.0)
+    assert img.max() == 1.0
+
+
+def test_uint16_faces_project_like_uint8(tmp_path):
+    gray = [f.mean(axis=-1) for f in _render_faces(16)]
+    rows = []
+    for dtype in (np.uint8, np.uint16):
+        files = _write_cube_set(tmp_path / np.dtype(dtype).name, gray, dtype=dtype)
+        faces = [sixtohdr.read_img(path) for path in files]
+        rows.append(np.concatenate([block for _, block in sixtohdr.iter_equirect_rows(faces, 32, 16)]))
+    assert np.abs(rows[1] - rows[0]).max() < 1 / 255
+
+
+def test_filter_flag_reaches_sampler(monkeypatch, tmp_path):
+    assert sixtohdr.sample_filter == "bilinear"
+    _write_cube_set(tmp_path / "cube", _render_faces(16))
+    monkeypatch.setattr(sixtohdr, "output_w", 32)
+    monkeypatch.setattr(sixtohdr, "output_h", 16)
+    used = []
+    original = sixtohdr.iter_equirect_rows
+
+    def spy(cube_faces, w, h, rows=None, filter=None):
+        used.append(filter or sixtohdr.sample_filter)
+        return original(cube_faces, w, h, rows, filter)
+
+    monkeypatch.setattr(sixtohdr, "iter_equirect_rows", spy)
+    for flag in ("nearest", "bilinear"):
+        sixtohdr.main([str(tmp_path / "cube"), "--filter", flag, "-o", str(tmp_path / f"{flag}.png")])
+    sixtohdr.main([str(tmp_path / "cube"), "-o", str(tmp_path / "default.png")])
+    assert used == ["nearest", "bilinear", "bilinear"]
+
+
+def test_identify_rotated_inputs_keeps_sky_up(tmp_path):
+    faces = _render_faces(32)
+    # 四个侧面文件都被逆时针转了90°，且文件顺序打乱
+    stored = [np.rot90(f, 1) if k in (0, 1, 4, 5) else f for k, f in enumerate(faces)]
+    order = (3, 5, 0, 2, 4, 1)
+    files = _write_cube_set(tmp_path / "cube", stored, order)
+    result = sixtohdr.identify_cube_faces(files)
+    assembled = [np.rot90(sixtohdr.read_img(path), k) for path, k in result]
+    # 立方体绕竖直轴的整体转动无法从内容判断，但天空必须在上、侧面必须是正的
+    assert result[2][0] == files[order.index(2)]
+    assert result[3][0] == files[order.index(3)]
+    for slot in (0, 1, 4, 5):
+        assert any(np.abs(assembled[slot] - faces[k]).max() < 2 / 255 for k in (0, 1, 4, 5))
+
+
+def test_cube_rotation_table_is_the_rotation_group():
+    table = sixtohdr.cube_rotation_table()
+    assert len({tuple(perm) + tuple(quarter) for perm, quarter in table}) == 24
+    assert ([0, 1, 2, 3, 4, 5], [0] * 6) in table
+    assert all(sorted(perm) == list(range(6)) for perm, _ in table)
+
+
+def _candidates(out):
+    return int(re.search(r"候选 (\d+) 个", out).group(1))
+
+
+def test_identify_flat_faces_is_bounded(monkeypatch, capsys):
+    # 纯色面上所有布局代价相同，剪枝不起作用；结果任意，但耗时和候选数必须有界
+    faces = [np.full((64, 64, 3), 0.5, dtype=np.float32) for _ in range(6)]
+    result = sixtohdr.identify_cube_faces([f"{i}.png" for i in range(6)], faces)
+    assert sorted(path for path, _ in result) == [f"{i}.png" for i in range(6)]
+    assert _candidates(capsys.readouterr().out) == 1  # 贪心解已达下界，不再搜索
+    # 低对比度噪声：下界不紧，走限宽搜索
+    monkeypatch.setattr(sixtohdr, "match_beam", 64)
+    rng = np.random.default_rng(0)
+    faces = [(0.5 + 0.002 * rng.random((64, 64, 3))).astype(np.float32) for _ in range(6)]
+    result = sixtohdr.identify_cube_faces([f"{i}.png" for i in range(6)], faces)
+    assert sorted(path for path, _ in result) == [f"{i}.png" for i in range(6)]
+    assert _candidates(capsys.readouterr().out) <= 64
+
+
+class _FakeTensor:
+    """只实现 clip_text_features 用到的几个张量方法"""
+    def __init__(self, array):
+        self.array = np.asarray(array)
+
+    def float(self):
+        return _FakeTensor(self.array.astype(np.float32))
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.array
+
+    def to(self, *args, **kwargs):
+        return self
+
+
+class _FakeClipModel:
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self.encoded = 0
+
+    def parameters(self):
+        yield types.SimpleNamespace(dtype=self.dtype)
+
+    def encode_text(self, tokens):
+        self.encoded += 1
+        return _FakeTensor(np.full((len(sixtohdr.CLIP_PROMPTS), 4), 0.5, dtype=np.float16))
+
+
+def test_clip_text_cache_key_covers_device_dtype_and_version(monkeypatch, tmp_path):
+    fake_clip = types.SimpleNamespace(__version__="1.0", tokenize=lambda prompts: _FakeTensor(np.zeros(len(prompts))))
+    monkeypatch.setitem(sys.modules, "torch", types.SimpleNamespace(
+        __version__="2.0", no_grad=contextlib.nullcontext, from_numpy=_FakeTensor))
+    monkeypatch.setitem(sys.modules, "clip", fake_clip)
+    monkeypatch.setattr(sixtohdr, "clip_package_version", lambda clip: clip.__version__)
+    monkeypatch.setattr(sixtohdr, "clip_cache_dir", str(tmp_path))
+    monkeypatch.setattr(sixtohdr, "_clip_text_features", {})
+
+    def encode_count(device, dtype):
+        sixtohdr._clip_text_features.clear()  # 只测磁盘缓存
+        model = _FakeClipModel(dtype)
+        feats = sixtohdr.clip_text_features(model, device)
+        assert feats.array.dtype == np.float32
+        return model.encoded
+
+    assert encode_count("cpu", "torch.float32") == 1
+    assert encode_count("cpu", "torch.float32") == 0
+    assert encode_count("cuda", "torch.float16") == 1
+    assert encode_count("cuda", "torch.float16") == 0
+    monkeypatch.setattr(fake_clip, "__version__", "1.1")
+    assert encode_count("cpu", "torch.float32") == 1
+    assert all(np.load(p).dtype == np.float32 for p in tmp_path.glob("text_*.npy"))
+    assert len(list(tmp_path.glob("text_*.npy"))) == 3
@@ -0,0 +1,119 @@
+import importlib.util
+import os
+import types
+
+import cv2
+import numpy as np
+import pytest
+
+_spec = importlib.util.spec_from_file_location(
+    "head_marks", os.path.join(os.path.dirname(os.path.abspath(__file__)), "识别头标.py"))
+head_marks = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(head_marks)
+
+
+class FakeCapture:
+    """按帧号产出 1x1 帧的假视频，统计 grab/set/read 次数；bad 里的帧号读取失败"""
+    frames = 10000
+    bad = ()
+    calls = None
+
+    def __init__(self, video):
+        self.pos = 0
+        FakeCapture.calls = {"grab": 0, "set": 0, "read": 0}
+
+    def isOpened(self):
+        return True
+
+    def grab(self):
+        self.calls["grab"] += 1
+        self.pos += 1
+        return self.pos <= self.frames
+
+    def set(self, prop, value):
+        assert prop == cv2.CAP_PROP_POS_FRAMES
+        self.calls["set"] += 1
+        self.pos = int(value)
+
+    def read(self):
+        self.calls["read"] += 1
+        fi = self.pos
+        self.pos += 1
+        if fi >= self.frames or fi in self.bad:
+            return False, None
+        return True, np.full((1, 1), fi)
+
+    def release(self):
+        pass
+
+
+def _decode(monkeypatch, start_f, end_f, step, seek_each, bad=()):
+    monkeypatch.setattr(head_marks.cv2, "VideoCapture", FakeCapture)
+    monkeypatch.setattr(FakeCapture, "bad", bad)
+    frames = list(head_marks._decode_frames("fake.mp4", start_f, end_f, step, seek_each, lambda: False))
+    for fi, frame in frames:
+        assert frame[0, 0] == fi
+    return [fi for fi, _ in frames], dict(FakeCapture.calls)
+
+
+def test_seek_each_only_seeks_sampled_frames(monkeypatch):
+    indices, calls = _decode(monkeypatch, 0, 9999, 1000, seek_each=True)
+    assert indices == list(range(0, 10000, 1000))
+    assert calls == {"grab": 0, "set": 10, "read": 10}
+
+
+def test_sequential_decode_grabs_skipped_frames(monkeypatch):
+    indices, calls = _decode(monkeypatch, 5, 104, 10, seek_each=False)
+    assert indices == list(range(5, 105, 10))
+    assert calls["set"] == 1 and calls["read"] == 10 and calls["grab"] == 90
+
+
+def test_decode_modes_agree_and_reseek_after_bad_frame(monkeypatch):
+    seq, calls = _decode(monkeypatch, 3, 60, 7, seek_each=False, bad=(17,))
+    seek, _ = _decode(monkeypatch, 3, 60, 7, seek_each=True, bad=(17,))
+    assert seq == seek == [fi for fi in range(3, 61, 7) if fi != 17]
+    assert calls["set"] == 2  # 开头一次，坏帧后一次
+
+
+def test_split_shards_cover_sampled_frames_in_order():
+    for start_f, end_f, step, jobs in ((0, 99, 1, 4), (5, 104, 10, 3), (3, 60, 7, 8), (0, 0, 1, 4), (10, 12, 5, 2)):
+        sampled = list(range(start_f, end_f + 1, step))
+        shards = head_marks.split_shards(start_f, end_f, step, jobs)
+        assert len(shards) == min(jobs, len(sampled))
+        covered = [fi for a, b in shards for fi in range(a, b + 1, step)]
+        # 段首落在抽样帧上，按段首步进正好覆盖全部抽样帧，不重不漏
+        assert covered == sampled
+        assert all(a in sampled and b in sampled for a, b in shards)
+        sizes = [len(range(a, b + 1, step)) for a, b in shards]
+        assert max(sizes) - min(sizes) <= 1
+
+
+def _state(H, W, frames, value):
+    st = {key: np.full((H, W), value, dtype=np.float32) for key in ("heatmap", "heatmap_circle", "heatmap_square")}
+    st["det_rows"] = [[fi, "circle"] for fi in frames]
+    st["previews"] = list(frames)
+    return st
+
+
+def test_merge_states_sums_heatmaps_and_keeps_time_order():
+    states = [_state(2, 3, [0, 5], 1.0), _state(2, 3, [], 0.0), _state(2, 3, [10], 2.0)]
+    merged = head_marks.merge_states(states, 2, 3)
+    for key in ("heatmap", "heatmap_circle", "heatmap_square"):
+        assert merged[key].dtype == np.float32 and np.all(merged[key] == 3.0)
+    assert merged["det_rows"] == [[0, "circle"], [5, "circle"], [10, "circle"]]
+    assert merged["previews"] == [0, 5, 10]
+    assert not head_marks.merge_states([], 2, 3)["heatmap"].any()
+
+
+def test_run_analysis_removes_shard_previews_on_error(monkeypatch, tmp_path):
+    def failing_shard(args, cfg, shard_start, shard_end, progress=None):
+        open(head_marks.preview_shard_path(args.out, shard_start), "wb").close()
+        raise RuntimeError("decode failed")
+
+    monkeypatch.setattr(head_marks, "analyze_shard", failing_shard)
+    monkeypatch.setattr(head_marks, "USE_TQDM", False)
+    (tmp_path / "keep.csv").write_text("x")
+    args = types.SimpleNamespace(out=str(tmp_path), sample_step=1, jobs=1)
+    with pytest.raises(RuntimeError):
+        head_marks.run_analysis(args, {"H": 2, "W": 2}, 0, 9)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["keep.csv"]
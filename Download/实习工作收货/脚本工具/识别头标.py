@@ -3,8 +3,12 @@ import os
 import sys
 import csv
 import math
+import queue
 import argparse
+import threading
+import multiprocessing as mp
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_EXCEPTION
 
 try:
     from tqdm import tqdm
@@ -177,6 +181,303 @@ def add_points_to_heatmap(heatmap, points):
         if 0 <= xi < W and 0 <= yi < H:
             heatmap[yi, xi] += 1.0
 
+def _decode_frames(video, start_f, end_f, step, seek_each, stopped):
+    """
+    顺序解码 [start_f, end_f]，只 read() 抽样帧，跳过的帧用 grab() 推进，产出 (帧号, 帧)。
+    只在开头（start_f>0）和读帧失败后才 seek；seek_each=True 时退回旧方式：
+    每个抽样帧 seek + read，跳过的帧完全不碰。
+    """
+    cap = cv2.VideoCapture(video)
+    try:
+        if not cap.isOpened():
+            raise RuntimeError(f"无法打开视频: {video}")
+        if seek_each:
+            for fi in range(start_f, end_f + 1, step):
+                if stopped():
+                    return
+                cap.set(cv2.CAP_PROP_POS_FRAMES, fi)
+                ok, frame = cap.read()
+                if ok:
+                    yield fi, frame
+            return
+        need_seek = start_f > 0
+        for fi in range(start_f, end_f + 1):
+            if stopped():
+                return
+            if (fi - start_f) % step:
+                # 待 seek 时跳过的帧不必解码，直接等下一个抽样帧定位
+                if not need_seek and not cap.grab():
+                    need_seek = True
+                continue
+            if need_seek:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, fi)
+            ok, frame = cap.read()
+            # 读失败（坏帧/到尾）时与旧逻辑一样跳过该帧，下一个抽样帧重新 seek
+            need_seek = not ok
+            if ok:
+                yield fi, frame
+    finally:
+        cap.release()
+
+def iter_frames(video, start_f, end_f, step=1, prefetch=8, seek_each=False):
+    """
+    按抽帧步长产出 (帧号, 帧)。prefetch>0 时在后台线程解码，经容量为 prefetch 的队列交给检测，
+    解码与检测重叠；队列有界，内存最多占 prefetch 帧。prefetch=0 时在当前线程解码。
+    """
+    step = max(1, step)
+    if prefetch <= 0:
+        yield from _decode_frames(video, start_f, end_f, step, seek_each, lambda: False)
+        return
+
+    q = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def worker():
+        try:
+            for item in _decode_frames(video, start_f, end_f, step, seek_each, stop.is_set):
+                put(item)
+        except Exception as e:
+            put(e)
+        finally:
+            put(None)
+
+    t = threading.Thread(target=worker, name="frame-prefetch", daemon=True)
+    t.start()
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        t.join()
+
+def detection_config(args, W, H, roi, start_f, fps):
+    """把比例参数换算成像素，连同 ROI/HSV 范围打包，供各分片进程共用"""
+    minHW = float(min(W, H))
+    circle_min_r = max(2.5, args.circle_min_r_ratio * minHW)
+    square_min_side = max(3.0, args.square_min_side_ratio * minHW)
+    return {
+        "W": W, "H": H, "fps": fps, "start_f": start_f, "roi": roi,
+        "circle_min_r": circle_min_r,
+        "circle_max_r": max(circle_min_r + 1.0, args.circle_max_r_ratio * minHW),
+        "square_min_side": square_min_side,
+        "square_max_side": max(square_min_side + 1.0, args.square_max_side_ratio * minHW),
+        "merge_dist": max(2.0, args.merge_dist_ratio * minHW),
+        "hsv_circle_ranges": parse_hsv_ranges(args.hsv_circle),
+        "hsv_square_ranges": parse_hsv_ranges(args.hsv_square),
+    }
+
+def preview_shard_path(out_dir, fi):
+    # 分片内先按帧号命名，合并后再按全局顺序改名为 preview_00000.png ...
+    return os.path.join(out_dir, f"preview_f{fi:09d}.tmp.png")
+
+def analyze_shard(args, cfg, shard_start, shard_end, progress=None):
+    """
+    处理 [shard_start, shard_end] 内的抽样帧（shard_start 须是抽样帧），返回可合并的统计状态：
+    三张热力图、检测行、保存了预览的帧号。
+    """
+    H, W, roi = cfg["H"], cfg["W"], cfg["roi"]
+    heatmap = np.zeros((H, W), dtype=np.float32)
+    heatmap_circle = np.zeros((H, W), dtype=np.float32)
+    heatmap_square = np.zeros((H, W), dtype=np.float32)
+    det_rows = []
+    previews = []
+
+    for fi, frame in iter_frames(args.video, shard_start, shard_end, args.sample_step, args.prefetch, args.seek_each):
+        # 圆形颜色掩码
+        circle_mask, (xoff_c, yoff_c) = color_mask_hsv(frame, cfg["hsv_circle_ranges"], blur_ksize=args.hsv_blur, roi=roi)
+        # 方形颜色掩码
+        square_mask, (xoff_s, yoff_s) = color_mask_hsv(frame, cfg["hsv_square_ranges"], blur_ksize=args.hsv_blur, roi=roi)
+
+        # 圆形检测
+        circles = find_circles_by_contour(
+            circle_mask, (xoff_c, yoff_c),
+            min_r=cfg["circle_min_r"], max_r=cfg["circle_max_r"],
+            min_circularity=args.circle_circularity,
+            min_area=10,
+            open_iter=args.circle_open, close_iter=args.circle_close, kernel=args.morph_kernel
+        )
+        if len(circles) > 0:
+            pts_c = [(c[0], c[1]) for c in circles]
+            sc_c = [c[3] for c in circles]
+            keep_c = nms_points(pts_c, sc_c, min_dist=cfg["merge_dist"])
+            circles = [circles[i] for i in keep_c]
+        # 方形检测
+        squares = find_squares(
+            square_mask, (xoff_s, yoff_s),
+            min_side=cfg["square_min_side"], max_side=cfg["square_max_side"],
+            ar_tol=args.square_ar_tol,
+            min_area=20,
+            open_iter=args.square_open, close_iter=args.square_close, kernel=args.morph_kernel
+        )
+        if len(squares) > 0:
+            pts_s = [(s[0], s[1]) for s in squares]
+            sc_s = [s[3] for s in squares]
+            keep_s = nms_points(pts_s, sc_s, min_dist=cfg["merge_dist"])
+            squares = [squares[i] for i in keep_s]
+
+        # 合并两类再做一次点级别NMS避免同点重复
+        all_pts = [(c[0], c[1]) for c in circles] + [(s[0], s[1]) for s in squares]
+        all_sc = [c[3] for c in circles] + [s[3] for s in squares]
+        if len(all_pts) > 0:
+            keep_all = nms_points(all_pts, all_sc, min_dist=cfg["merge_dist"])
+            kept_set = set(keep_all)
+        else:
+            kept_set = set()
+
+        t_sec = fi / max(1e-6, cfg["fps"])
+        # 累加热力图与导出行
+        c_count, s_count = 0, 0
+        for i, c in enumerate(circles):
+            if i in kept_set:
+                add_points_to_heatmap(heatmap, [(c[0], c[1])])
+                add_points_to_heatmap(heatmap_circle, [(c[0], c[1])])
+                det_rows.append([fi, f"{t_sec:.3f}", f"{c[0]:.1f}", f"{c[1]:.1f}", "circle", f"r={c[2]:.1f}", f"{c[3]:.1f}"])
+                c_count += 1
+        offset = len(circles)
+        for j, s in enumerate(squares):
+            idx = offset + j
+            if idx in kept_set:
+                add_points_to_heatmap(heatmap, [(s[0], s[1])])
+                add_points_to_heatmap(heatmap_square, [(s[0], s[1])])
+                det_rows.append([fi, f"{t_sec:.3f}", f"{s[0]:.1f}", f"{s[1]:.1f}", "square", f"side={s[2]:.1f}", f"{s[3]:.1f}"])
+                s_count += 1
+
+        # 可选预览
+        if args.save_preview_every and args.save_preview_every > 0 and (fi - cfg["start_f"]) % args.save_preview_every == 0:
+            vis = frame.copy()
+            for (cx, cy, r, _) in circles:
+                cv2.circle(vis, (int(round(cx)), int(round(cy))), int(round(r)), (0, 255, 255), 2)
+            for (cx, cy, side, _) in squares:
+                cv2.circle(vis, (int(round(cx)), int(round(cy))), int(max(3, round(side / 2))), (0, 165, 255), 2)
+            if roi is not None:
+                cv2.rectangle(vis, (roi[0], roi[1]), (roi[2], roi[3]), (255, 0, 0), 2)
+            cv2.putText(vis, f"C:{c_count} S:{s_count}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0,255,0), 2)
+            cv2.imwrite(preview_shard_path(args.out, fi), vis)
+            previews.append(fi)
+
+        if progress is not None:
+            progress(1)
+
+    return {"heatmap": heatmap, "heatmap_circle": heatmap_circle, "heatmap_square": heatmap_square,
+            "det_rows": det_rows, "previews": previews}
+
+def merge_states(states, H, W):
+    """按时间顺序归并各分片：热力图是整数计数，逐个相加与单进程累加结果完全一致"""
+    merged = {
+        "heatmap": np.zeros((H, W), dtype=np.float32),
+        "heatmap_circle": np.zeros((H, W), dtype=np.float32),
+        "heatmap_square": np.zeros((H, W), dtype=np.float32),
+        "det_rows": [],
+        "previews": [],
+    }
+    for st in states:
+        for key in ("heatmap", "heatmap_circle", "heatmap_square"):
+            merged[key] += st[key]
+        merged["det_rows"].extend(st["det_rows"])
+        merged["previews"].extend(st["previews"])
+    return merged
+
+def split_shards(start_f, end_f, step, jobs):
+    """把抽样帧序列按时间均分成 jobs 段，返回 [(段首帧, 段尾帧)]；段首都落在抽样帧上"""
+    sampled = range(start_f, end_f + 1, max(1, step))
+    n = len(sampled)
+    shards = []
+    for k in range(jobs):
+        a, b = k * n // jobs, (k + 1) * n // jobs
+        if a < b:
+            shards.append((sampled[a], sampled[b - 1]))
+    return shards
+
+_progress_queue = None
+
+def _init_shard_worker(progress_queue, threads):
+    global _progress_queue
+    _progress_queue = progress_queue
+    cv2.setNumThreads(threads)
+
+def _shard_worker(job):
+    args, cfg, shard_start, shard_end = job
+    pending = [0]
+
+    def progress(n):
+        pending[0] += n
+        if pending[0] >= 32:
+            _progress_queue.put(pending[0])
+            pending[0] = 0
+
+    state = analyze_shard(args, cfg, shard_start, shard_end, progress)
+    if pending[0]:
+        _progress_queue.put(pending[0])
+    return state
+
+def remove_preview_shards(out_dir):
+    """删掉分片留下的 preview_f*.tmp.png (成功时已全部改名，出错时是半成品)"""
+    for name in os.listdir(out_dir):
+        if name.startswith("preview_f") and name.endswith(".tmp.png"):
+            os.remove(os.path.join(out_dir, name))
+
+def run_analysis(args, cfg, start_f, end_f):
+    """--jobs 1 时在本进程处理；否则按时间分片交给进程池，各自统计后归并"""
+    total = len(range(start_f, end_f + 1, max(1, args.sample_step)))
+    bar = tqdm(total=total, desc="Processing") if USE_TQDM else None
+    update = bar.update if bar is not None else None
+    shards = split_shards(start_f, end_f, args.sample_step, max(1, args.jobs))
+    try:
+        if len(shards) <= 1:
+            states = [analyze_shard(args, cfg, a, b, update) for a, b in shards]
+        else:
+            states = _run_shards_in_pool(args, cfg, shards, update)
+        state = merge_states(states, cfg["H"], cfg["W"])
+        for idx, fi in enumerate(state["previews"]):
+            os.replace(preview_shard_path(args.out, fi), os.path.join(args.out, f"preview_{idx:05d}.png"))
+    finally:
+        if bar is not None:
+            bar.close()
+        remove_preview_shards(args.out)
+    return state
+
+def _run_shards_in_pool(args, cfg, shards, update):
+    # 用 ProcessPoolExecutor 而不是 mp.Pool：工作进程被杀 / 崩溃时 future 抛 BrokenProcessPool，而不是一直等下去
+    progress_queue = mp.Queue()
+    threads = max(1, (os.cpu_count() or 1) // len(shards))
+
+    def drain():
+        while True:
+            try:
+                n = progress_queue.get_nowait()
+            except queue.Empty:
+                return
+            if update is not None:
+                update(n)
+
+    with ProcessPoolExecutor(len(shards), initializer=_init_shard_worker, initargs=(progress_queue, threads)) as pool:
+        futures = [pool.submit(_shard_worker, (args, cfg, a, b)) for a, b in shards]
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=0.2, return_when=FIRST_EXCEPTION)
+                drain()
+                for fut in done:
+                    fut.result()  # 分片出错或进程崩溃时在这里抛出
+        except BaseException:
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise
+        drain()
+        return [fut.result() for fut in futures]
+
 def main():
     ap = argparse.ArgumentParser(description="统计FPS视频中圆形/方形头标的出现区域，输出热力图与遮罩图")
     ap.add_argument("--video", required=True, help="视频路径")
@@ -185,6 +486,10 @@ def main():
     ap.add_argument("--start", type=float, default=0.0, help="开始时间(秒)")
     ap.add_argument("--end", type=float, default=-1.0, help="结束时间(秒)，-1表示到末尾")
     ap.add_argument("--roi", type=str, default="", help="限定检测区域 x0,y0,x1,y1（可选）")
+    ap.add_argument("--prefetch", type=int, default=8 if (os.cpu_count() or 1) > 1 else 0,
+                    help="后台解码预读的帧数(0=不用后台线程；单核机器默认0，重叠不了反而多线程切换)")
+    ap.add_argument("--jobs", type=int, default=1, help="并行进程数，按时间把帧范围分片，结果与单进程一致")
+    ap.add_argument("--seek_each", action="store_true", help="每个抽样帧都 seek（旧方式，仅在抽帧步长极大时可能更快）")
 
     # 颜色阈值（示例默认：圆形偏蓝青，方形偏绿色；请按实际 UI 调整）
     ap.add_argument("--hsv_circle", type=str, default="80,80,80-130,255,255", help="圆形HSV范围，多段分号分隔")
@@ -243,7 +548,6 @@ def main():
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
     W = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH) or 0)
     H = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT) or 0)
-    minHW = float(min(W, H))
 
     start_f = int(max(0, args.start) * fps)
     end_f = total_frames - 1 if args.end < 0 else int(min(total_frames - 1, args.end * fps))
@@ -255,108 +559,15 @@ def main():
         print("[ERR] 无法读取参考帧")
         sys.exit(1)
     ref_bgr = ref.copy()
-
-    # 参数换算（像素）
-    circle_min_r = max(2.5, args.circle_min_r_ratio * minHW)
-    circle_max_r = max(circle_min_r + 1.0, args.circle_max_r_ratio * minHW)
-    square_min_side = max(3.0, args.square_min_side_ratio * minHW)
-    square_max_side = max(square_min_side + 1.0, args.square_max_side_ratio * minHW)
-    merge_dist = max(2.0, args.merge_dist_ratio * minHW)
-
-    hsv_circle_ranges = parse_hsv_ranges(args.hsv_circle)
-    hsv_square_ranges = parse_hsv_ranges(args.hsv_square)
-
-    # 统计容器
-    heatmap = np.zeros((H, W), dtype=np.float32)
-    heatmap_circle = np.zeros((H, W), dtype=np.float32)
-    heatmap_square = np.zeros((H, W), dtype=np.float32)
-    det_rows = []
-
-    frame_indices = range(start_f, end_f + 1, max(1, args.sample_step))
-    iterator = tqdm(frame_indices, desc="Processing") if USE_TQDM else frame_indices
-
-    preview_idx = 0
-
-    for fi in iterator:
-        cap.set(cv2.CAP_PROP_POS_FRAMES, fi)
-        ok, frame = cap.read()
-        if not ok:
-            continue
-
-        # 圆形颜色掩码
-        circle_mask, (xoff_c, yoff_c) = color_mask_hsv(frame, hsv_circle_ranges, blur_ksize=args.hsv_blur, roi=roi)
-        # 方形颜色掩码
-        square_mask, (xoff_s, yoff_s) = color_mask_hsv(frame, hsv_square_ranges, blur_ksize=args.hsv_blur, roi=roi)
-
-        # 圆形检测
-        circles = find_circles_by_contour(
-            circle_mask, (xoff_c, yoff_c),
-            min_r=circle_min_r, max_r=circle_max_r,
-            min_circularity=args.circle_circularity,
-            min_area=10,
-            open_iter=args.circle_open, close_iter=args.circle_close, kernel=args.morph_kernel
-        )
-        if len(circles) > 0:
-            pts_c = [(c[0], c[1]) for c in circles]
-            sc_c = [c[3] for c in circles]
-            keep_c = nms_points(pts_c, sc_c, min_dist=merge_dist)
-            circles = [circles[i] for i in keep_c]
-        # 方形检测
-        squares = find_squares(
-            square_mask, (xoff_s, yoff_s),
-            min_side=square_min_side, max_side=square_max_side,
-            ar_tol=args.square_ar_tol,
-            min_area=20,
-            open_iter=args.square_open, close_iter=args.square_close, kernel=args.morph_kernel
-        )
-        if len(squares) > 0:
-            pts_s = [(s[0], s[1]) for s in squares]
-            sc_s = [s[3] for s in squares]
-            keep_s = nms_points(pts_s, sc_s, min_dist=merge_dist)
-            squares = [squares[i] for i in keep_s]
-
-        # 合并两类再做一次点级别NMS避免同点重复
-        all_pts = [(c[0], c[1]) for c in circles] + [(s[0], s[1]) for s in squares]
-        all_sc = [c[3] for c in circles] + [s[3] for s in squares]
-        if len(all_pts) > 0:
-            keep_all = nms_points(all_pts, all_sc, min_dist=merge_dist)
-            kept_set = set(keep_all)
-        else:
-            kept_set = set()
-
-        t_sec = fi / max(1e-6, fps)
-        # 累加热力图与导出行
-        c_count, s_count = 0, 0
-        for i, c in enumerate(circles):
-            if i in kept_set:
-                add_points_to_heatmap(heatmap, [(c[0], c[1])])
-                add_points_to_heatmap(heatmap_circle, [(c[0], c[1])])
-                det_rows.append([fi, f"{t_sec:.3f}", f"{c[0]:.1f}", f"{c[1]:.1f}", "circle", f"r={c[2]:.1f}", f"{c[3]:.1f}"])
-                c_count += 1
-        offset = len(circles)
-        for j, s in enumerate(squares):
-            idx = offset + j
-            if idx in kept_set:
-                add_points_to_heatmap(heatmap, [(s[0], s[1])])
-                add_points_to_heatmap(heatmap_square, [(s[0], s[1])])
-                det_rows.append([fi, f"{t_sec:.3f}", f"{s[0]:.1f}", f"{s[1]:.1f}", "square", f"side={s[2]:.1f}", f"{s[3]:.1f}"])
-                s_count += 1
-
-        # 可选预览
-        if args.save_preview_every and args.save_preview_every > 0 and (fi - start_f) % args.save_preview_every == 0:
-            vis = frame.copy()
-            for (cx, cy, r, _) in circles:
-                cv2.circle(vis, (int(round(cx)), int(round(cy))), int(round(r)), (0, 255, 255), 2)
-            for (cx, cy, side, _) in squares:
-                cv2.circle(vis, (int(round(cx)), int(round(cy))), int(max(3, round(side / 2))), (0, 165, 255), 2)
-            if roi is not None:
-                cv2.rectangle(vis, (roi[0], roi[1]), (roi[2], roi[3]), (255, 0, 0), 2)
-            cv2.putText(vis, f"C:{c_count} S:{s_count}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0,255,0), 2)
-            cv2.imwrite(os.path.join(args.out, f"preview_{preview_idx:05d}.png"), vis)
-            preview_idx += 1
-
     cap.release()
 
+    cfg = detection_config(args, W, H, roi, start_f, fps)
+    state = run_analysis(args, cfg, start_f, end_f)
+    heatmap = state["heatmap"]
+    heatmap_circle = state["heatmap_circle"]
+    heatmap_square = state["heatmap_square"]
+    det_rows = state["det_rows"]
+
     # 若无检测
     total_det = int(np.sum(heatmap))
     if len(det_rows) == 0 or total_det == 0:
@@ -8,10 +8,20 @@ import sys
 # ============================================================
 os.environ["OPENCV_IO_ENABLE_OPENEXR"] = "1"
 
+import argparse
+import glob
+import hashlib
+import shutil
+import io
+import contextlib
 import subprocess
 import struct
 import math
+import time
+import json
 import pathlib
+import mmap
+import tempfile
 import traceback
 
 # ============================================================
@@ -41,21 +51,64 @@ def real_main():
     print("="*50)
 
     # 2. 获取输入文件
-    files = []
-    if len(sys.argv) > 1:
-        files = sys.argv[1:]
-    else:
+    ap = argparse.ArgumentParser(description="HDR/EXR 转 DDS Cubemap，可传入多个文件、目录或通配符")
+    ap.add_argument("inputs", nargs="*", help=".hdr/.exr 文件、目录 (取其中的 .hdr/.exr) 或通配符")
+    ap.add_argument("-j", "--jobs", type=int, default=0, help="并行进程数，0 = CPU 核数 (默认)，1 = 单进程")
+    ap.add_argument("--verify", action="store_true", help="只对输入的 .dds 做 memmap 结构校验，不转换")
+    ap.add_argument("--deep", action="store_true", help="配合 --verify，额外检查 mip0 的 NaN/Inf/负值")
+    ap.add_argument("--projection", choices=tuple(PROJECTION_PREFIXES),
+                    help="输出投影: cube / octahedral (八面体 2D) / paraboloid (双抛物面 2D)，默认取 PROJECTION 配置")
+    ap.add_argument("--filter", choices=SAMPLE_FILTERS,
+                    help="源图采样滤波，默认取 SAMPLE_FILTER 配置 (bilinear；旧版为 nearest，复现旧输出时传 nearest)")
+    ap.add_argument("--low-memory", action="store_true", help="强制低内存模式 (临时 memmap + 分块采样)")
+    ap.add_argument("--cache", metavar="DIR", help="启用增量构建缓存，输入内容和参数都没变时直接复用上次的输出")
+    ap.add_argument("--cache-link", action="store_true", help="缓存命中时用硬链接代替复制")
+    ap.add_argument("--cache-prune", metavar="MB", type=float, help="按最久未使用淘汰缓存条目，直到总大小不超过 MB")
+    args = ap.parse_args()
+    if args.projection:
+        globals()["PROJECTION"] = args.projection
+    if args.filter:
+        globals()["SAMPLE_FILTER"] = args.filter
+    if args.low_memory:
+        globals()["LOW_MEMORY"] = True
+    if args.cache:
+        globals()["BUILD_CACHE_DIR"] = args.cache
+    if args.cache_link:
+        globals()["CACHE_LINK"] = True
+
+    inputs = args.inputs
+    if args.cache_prune is not None:
+        if BUILD_CACHE_DIR is None:
+            print("[错误] --cache-prune 需要同时指定 --cache 目录")
+            return
+        prune_build_cache(BUILD_CACHE_DIR, args.cache_prune)
+        if not inputs:
+            return
+
+    if not inputs:
         print("请把 .hdr/.exr 文件直接拖入窗口，按回车...")
         user_input = input(">>> ").strip()
         if user_input:
-            files = [user_input.replace('"', '')]
+            inputs = [user_input.replace('"', '')]
 
-    if not files: return
+    if not inputs: return
 
-    for f in files:
-        process_file(f, np, cv2)
+    # --verify [--deep] a.dds b.dds ... : 只做 memmap 结构校验，不转换
+    if args.verify:
+        verify_files(expand_inputs(inputs, (".dds",)), np, args.deep)
+        return
 
+    files = expand_inputs(inputs, INPUT_EXTENSIONS)
+    if not files:
+        print("[跳过] 没有找到 .hdr/.exr 文件")
+        return
+
+    failed = run_batch(files, args.jobs, np, cv2)
+    if BUILD_CACHE_DIR is not None:
+        write_cache_manifest(BUILD_CACHE_DIR)
     print("\n[全部完成]")
+    if failed:
+        sys.exit(1)
 
 def check_dependencies():
     required = {'numpy': 'numpy', 'cv2': 'opencv-python'}
@@ -72,16 +125,350 @@ def check_dependencies():
                 print(f"安装 {pkg_name} 失败。请手动运行 pip install {pkg_name}")
                 raise
 
+# ============================================================
+# 批量转换 (进程池)
+# ============================================================
+INPUT_EXTENSIONS = (".hdr", ".exr")
+
+# 需要同步到子进程的配置项 (spawn 方式启动的子进程只会看到模块默认值)
+CONFIG_KEYS = (
+    "CUBEMAP_SIZE", "PROJECTION", "GENERATE_MIPS", "SAMPLE_FILTER", "REMAP_CACHE_DIR", "MIP_FILTER",
+    "PREFILTER_SAMPLES", "PREFILTER_CHUNK", "OUTPUT_FORMAT", "BC6H_PRESET", "BC6H_PSNR_CHECK",
+    "BC6H_CHUNK_BLOCKS", "EXPORT_SH9", "SH_IRRADIANCE_CUBE_SIZE", "SH_CHUNK_PIXELS",
+    "EXPORT_SAMPLING_TABLES", "SAMPLING_TABLE_MAX_WIDTH",
+    "LOW_MEMORY", "LOW_MEMORY_AUTO_PIXELS", "LOW_MEMORY_TILE_PIXELS", "LOW_MEMORY_TEMP_DIR",
+    "BUILD_CACHE_DIR", "CACHE_LINK",
+)
+
+def expand_inputs(inputs, extensions):
+    """展开文件 / 目录 / 通配符，按出现顺序去重"""
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = sorted(str(p) for p in pathlib.Path(item).iterdir()
+                             if p.is_file() and p.suffix.lower() in extensions)
+        elif glob.has_magic(item):
+            matches = sorted(p for p in glob.glob(item, recursive=True)
+                             if os.path.isfile(p) and pathlib.Path(p).suffix.lower() in extensions)
+        else:
+            matches = [item]
+        files.extend(matches)
+    return list(dict.fromkeys(files))
+
+def _init_batch_worker(config):
+    globals().update(config)
+    import cv2
+    # 多进程时每个进程只用一个 OpenCV 线程，避免核数被超额占用
+    cv2.setNumThreads(1)
+
+def _batch_worker(filepath):
+    import numpy as np
+    import cv2
+    log = io.StringIO()
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        try:
+            ok = process_file_cached(filepath, np, cv2)
+        except Exception:
+            traceback.print_exc(file=log)
+            ok = False
+    return filepath, ok, time.perf_counter() - t0, log.getvalue()
+
+def run_batch(files, jobs, np, cv2):
+    """转换全部文件并打印进度与汇总，返回失败数"""
+    jobs = jobs if jobs > 0 else (os.cpu_count() or 1)
+    jobs = min(jobs, len(files))
+    print(f"共 {len(files)} 个文件，{jobs} 个进程")
+
+    results = []
+    t0 = time.perf_counter()
+    if jobs == 1:
+        for f in files:
+            t1 = time.perf_counter()
+            try:
+                ok = process_file_cached(f, np, cv2)
+            except Exception:
+                traceback.print_exc()
+                ok = False
+            results.append((f, ok, time.perf_counter() - t1))
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        config = {k: globals()[k] for k in CONFIG_KEYS}
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_batch_worker, initargs=(config,)) as pool:
+            futures = [pool.submit(_batch_worker, f) for f in files]
+            for done, fut in enumerate(as_completed(futures), 1):
+                f, ok, seconds, log = fut.result()
+                results.append((f, ok, seconds))
+                print(f"[{done}/{len(files)}] {'OK  ' if ok else 'FAIL'} {seconds:6.2f}s  {pathlib.Path(f).name}")
+                if not ok:
+                    print(log.rstrip())
+
+    failed = [r for r in results if not r[1]]
+    total = time.perf_counter() - t0
+    busy = sum(r[2] for r in results)
+    print("\n" + "=" * 50)
+    print(f"  成功 {len(results) - len(failed)} / {len(results)}，总耗时 {total:.2f}s，"
+          f"单文件累计 {busy:.2f}s (并行加速 {busy / max(total, 1e-9):.1f}x)")
+    if results:
+        slowest = max(results, key=lambda r: r[2])
+        print(f"  最慢: {pathlib.Path(slowest[0]).name} ({slowest[2]:.2f}s)")
+    for f, _, _ in failed:
+        print(f"  [失败] {f}")
+    print("=" * 50)
+    return len(failed)
+
+# ============================================================
+# 增量构建缓存 (内容寻址)
+# ============================================================
+# 会影响输出内容的配置项；分块大小、低内存模式等只影响速度/内存，不参与缓存键
+CACHE_PARAM_KEYS = (
+    "CUBEMAP_SIZE", "PROJECTION", "GENERATE_MIPS", "SAMPLE_FILTER", "SEAM_PAD", "MIP_FILTER", "PREFILTER_SAMPLES",
+    "OUTPUT_FORMAT", "BC6H_PRESET", "EXPORT_SH9", "SH_IRRADIANCE_CUBE_SIZE",
+    "EXPORT_SAMPLING_TABLES", "SAMPLING_TABLE_MAX_WIDTH", "CACHE_VERSION",
+)
+
+def output_paths(path):
+    """按当前配置列出一个输入会生成的全部文件: 角色 -> 路径 (前缀随投影，不同投影的输出互不覆盖)"""
+    base = path.parent / f"{PROJECTION_PREFIXES[PROJECTION]}_{path.stem}"
+    outputs = {"radiance.dds": base.with_name(f"{base.name}_radiance.dds")}
+    if EXPORT_SH9:
+        outputs["sh9.json"] = base.with_name(f"{base.name}_sh9.json")
+        outputs["sh9.bin"] = base.with_name(f"{base.name}_sh9.bin")
+        if SH_IRRADIANCE_CUBE_SIZE > 0:
+            outputs["irradiance.dds"] = base.with_name(f"{base.name}_irradiance.dds")
+    if EXPORT_SAMPLING_TABLES:
+        outputs["envsampling.bin"] = base.with_name(f"{base.name}_envsampling.bin")
+    return outputs
+
+def cache_key(path):
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    params = {k: str(globals()[k]) for k in CACHE_PARAM_KEYS}
+    h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return h.hexdigest(), params
+
+def _write_json_atomic(path, data):
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(str(tmp), str(path))
+
+def _place_file(src, dst, link):
+    if dst.exists():
+        dst.unlink()
+    if link:
+        try:
+            os.link(str(src), str(dst))
+            return
+        except OSError:
+            pass
+    shutil.copyfile(str(src), str(dst))
+
+def evict_cache_entry(entry_dir):
+    """先把条目挪开再删，别的进程不会看到删了一半的目录"""
+    stale = entry_dir.with_name(f"{entry_dir.name}.{os.getpid()}.stale")
+    try:
+        os.replace(str(entry_dir), str(stale))
+    except FileNotFoundError:
+        return
+    shutil.rmtree(str(stale), ignore_errors=True)
+
+def restore_from_cache(entry_dir, entry, path):
+    """条目完整时把文件放回输出位置；文件缺失、大小不符 (写到一半、被截断) 的条目直接逐出"""
+    if not cache_entry_valid(entry_dir, path):
+        print(f"    [提示] 缓存条目不完整，已逐出: {entry_dir.name[:12]}")
+        evict_cache_entry(entry_dir)
+        return False
+    outputs = output_paths(path)
+    for role, dst in outputs.items():
+        if role == "sh9.json":
+            # json 里记录了源文件名，按本次输入改写
+            with open(entry_dir / role, encoding='utf-8') as f:
+                data = json.load(f)
+            data["source"] = path.name
+            _write_json_atomic(dst, data)
+        else:
+            _place_file(entry_dir / role, dst, CACHE_LINK)
+    entry["last_used"] = time.time()
+    _write_json_atomic(entry_dir / "entry.json", entry)
+    return True
+
+def cache_entry_valid(entry_dir, path):
+    """条目的 entry.json 可读，且记录的文件齐全、大小一致"""
+    try:
+        with open(entry_dir / "entry.json", encoding='utf-8') as f:
+            files = json.load(f)["files"]
+        if set(files) != set(output_paths(path)):
+            return False
+        return all((entry_dir / role).stat().st_size == size for role, size in files.items())
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return False
+
+def store_in_cache(entry_dir, key, params, path):
+    outputs = output_paths(path)
+    tmp_dir = entry_dir.with_name(f"{key}.{os.getpid()}.tmp")
+    shutil.rmtree(str(tmp_dir), ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    for role, src in outputs.items():
+        shutil.copyfile(str(src), str(tmp_dir / role))
+    now = time.time()
+    _write_json_atomic(tmp_dir / "entry.json", {
+        "key": key, "source": str(path), "params": params, "created": now, "last_used": now,
+        "files": {role: (tmp_dir / role).stat().st_size for role in outputs},
+    })
+    try:
+        os.replace(str(tmp_dir), str(entry_dir))
+        return
+    except OSError:
+        if cache_entry_valid(entry_dir, path):
+            # 另一个进程刚写好同一条目
+            shutil.rmtree(str(tmp_dir), ignore_errors=True)
+            return
+    # 已有条目损坏或不完整: 先挪开再换上新条目
+    evict_cache_entry(entry_dir)
+    os.replace(str(tmp_dir), str(entry_dir))
+
+def process_file_cached(filepath, np, cv2):
+    """带增量缓存的 process_file；BUILD_CACHE_DIR 为 None 时等同于 process_file"""
+    path = pathlib.Path(filepath)
+    if BUILD_CACHE_DIR is None or not path.is_file():
+        return process_file(filepath, np, cv2)
+
+    t0 = time.perf_counter()
+    key, params = cache_key(path)
+    entry_dir = pathlib.Path(BUILD_CACHE_DIR) / "objects" / key
+    entry_file = entry_dir / "entry.json"
+    if entry_file.exists():
+        try:
+            with open(entry_file, encoding='utf-8') as f:
+                entry = json.load(f)
+            if restore_from_cache(entry_dir, entry, path):
+                print(f"\n>>> [缓存命中] {path.name} ({key[:12]}, {time.perf_counter() - t0:.2f}s)")
+                return True
+        except (OSError, ValueError, KeyError) as e:
+            print(f"    [提示] 缓存条目损坏，重新转换: {e}")
+
+    ok = process_file(filepath, np, cv2)
+    if ok:
+        try:
+            store_in_cache(entry_dir, key, params, path)
+        except OSError as e:
+            print(f"    [提示] 写入缓存失败: {e}")
+    return ok
+
+def load_cache_entries(cache_dir):
+    entries = []
+    objects = pathlib.Path(cache_dir) / "objects"
+    if not objects.is_dir():
+        return entries
+    for entry_file in objects.glob("*/entry.json"):
+        try:
+            with open(entry_file, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            continue
+        entry["bytes"] = sum(entry.get("files", {}).values())
+        entry["dir"] = entry_file.parent
+        entries.append(entry)
+    return entries
+
+def write_cache_manifest(cache_dir):
+    """汇总各条目的 entry.json 生成 manifest.json (只在主进程里写，避免并发冲突)"""
+    entries = load_cache_entries(cache_dir)
+    manifest = {
+        "version": CACHE_VERSION,
+        "total_bytes": sum(e["bytes"] for e in entries),
+        "entries": {e["key"]: {k: v for k, v in e.items() if k not in ("key", "dir")} for e in entries},
+    }
+    pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    _write_json_atomic(pathlib.Path(cache_dir) / "manifest.json", manifest)
+    return manifest
+
+def prune_build_cache(cache_dir, max_mb):
+    """按 last_used 从旧到新删除条目，直到总大小不超过 max_mb"""
+    entries = sorted(load_cache_entries(cache_dir), key=lambda e: e.get("last_used", 0))
+    total = sum(e["bytes"] for e in entries)
+    limit = max_mb * 1048576
+    removed = 0
+    for e in entries:
+        if total <= limit:
+            break
+        shutil.rmtree(str(e["dir"]), ignore_errors=True)
+        total -= e["bytes"]
+        removed += 1
+    write_cache_manifest(cache_dir)
+    print(f"[缓存清理] 删除 {removed} 个条目，剩余 {len(entries) - removed} 个，共 {total / 1048576:.1f} MB")
+
 # ============================================================
 # 转换逻辑
 # ============================================================
 CUBEMAP_SIZE = 512
+# 输出投影: "cube" (6 面 cubemap) / "octahedral" (八面体，CUBEMAP_SIZE² 的 2D 纹理)
+#           "paraboloid" (双抛物面，左半 +Y 上半球、右半 -Y 下半球，2·CUBEMAP_SIZE x CUBEMAP_SIZE 的 2D 纹理)
+PROJECTION = "cube"
 GENERATE_MIPS = True
+# 采样滤波: "nearest" (旧版最近邻) / "bilinear" / "bicubic"，命令行可用 --filter 覆盖
+# 注意: 默认值已从旧版的 nearest 改为 bilinear (消除经纬图采样锯齿)，输出与旧版不再逐像素一致；
+#       需要复现旧输出时传 --filter nearest
+SAMPLE_FILTERS = ("nearest", "bilinear", "bicubic")
+SAMPLE_FILTER = "bilinear"
+# 重映射表磁盘缓存目录，同分辨率的批量转换只在第一张图时做三角函数运算
+REMAP_CACHE_DIR = pathlib.Path(tempfile.gettempdir()) / "hdr2cubemap_remap"
+# 重映射表的坐标约定 (像素中心、接缝偏移、面朝向等) 改变时加一，旧缓存文件名对不上，自然失效；
+# 不带版本号的旧文件名算第 1 版
+REMAP_CACHE_VERSION = 2
+# 经度接缝处左右各补的列数 (bicubic 需要 2 列邻域)
+SEAM_PAD = 2
+# Mip 生成方式: "box" (逐级 cv2.resize) / "ggx" (按粗糙度做 GGX 镜面预滤波)
+MIP_FILTER = "box"
+# GGX 预滤波每个纹素的重要性采样数，以及每批处理的纹素数 (控制临时数组大小)
+PREFILTER_SAMPLES = 64
+PREFILTER_CHUNK = 65536
+# DDS 像素格式: "rgba16f" (R16G16B16A16_FLOAT) / "bc6h" (BC6H_UF16，每纹素 1 字节)
+#               "r11g11b10f" (R11G11B10_FLOAT) / "rgb9e5" (R9G9B9E5_SHAREDEXP)，后两者每纹素 4 字节
+OUTPUT_FORMAT = "rgba16f"
+# BC6H 编码预设: "fast" (包围盒端点 + 投影取索引) / "quality" (主轴端点 + 全调色板搜索 + 最小二乘精修)
+BC6H_PRESET = "quality"
+# BC6H 写完后解码回来，按 mip0 打印各面 PSNR
+BC6H_PSNR_CHECK = True
+# 每批编码的 4x4 块数 (控制临时数组大小)
+BC6H_CHUNK_BLOCKS = 16384
+# SH9 漫反射辐照度导出 (_sh9.json / _sh9.bin)，以及可选的小尺寸辐照度 cubemap (0 = 不输出)
+EXPORT_SH9 = False
+SH_IRRADIANCE_CUBE_SIZE = 32
+# 单次积分的最大像素数，超过则按行分块累加
+SH_CHUNK_PIXELS = 1 << 20
+# 路径追踪用的重要性采样表 (_envsampling.bin，可直接 memmap)
+EXPORT_SAMPLING_TABLES = False
+# 采样表的最大宽度，源图更宽时先按面积缩小 (0 = 保持源分辨率)
+SAMPLING_TABLE_MAX_WIDTH = 2048
+# 低内存模式: True / False / "auto" (源图像素数 >= LOW_MEMORY_AUTO_PIXELS 时开启)
+# 解码后的图只转存一次到临时 np.memmap (顺带完成 BGR->RGB)，之后逐面按行分块采样
+LOW_MEMORY = "auto"
+LOW_MEMORY_AUTO_PIXELS = 1 << 26
+# 每个行分块的纹素数 (面) / 像素数 (转存)
+LOW_MEMORY_TILE_PIXELS = 1 << 20
+# 临时 memmap 所在目录，None = 系统临时目录
+LOW_MEMORY_TEMP_DIR = None
+# 增量构建缓存目录 (None = 关闭)：按 输入内容哈希 + 转换参数 复用上次的输出
+BUILD_CACHE_DIR = None
+# 命中时用硬链接代替复制 (需与输出目录在同一磁盘)
+CACHE_LINK = False
+# 转换算法有不兼容改动时加一，使旧缓存全部失效
+CACHE_VERSION = 1
 
 DDS_MAGIC = b'DDS '
 DDSD_CAPS = 0x1 | 0x2 | 0x4 | 0x1000 | 0x20000
+DDSD_LINEARSIZE = 0x80000
 DDSCAPS_COMPLEX = 0x8 | 0x1000 | 0x400000
 DDSCAPS2_CUBEMAP_ALLFACES = 0xFC00 
+# DX10 resourceDimension / miscFlag
+DDS_DIMENSION_TEXTURE2D = 3
+DDS_RESOURCE_MISC_TEXTURECUBE = 0x4
+
+PROJECTION_PREFIXES = {"cube": "cubemap", "octahedral": "octahedral", "paraboloid": "paraboloid"}
 
 def get_face_transform(face_idx, u, v, np):
     if face_idx == 0: return np.stack((np.ones_like(u), -v, -u), axis=-1)   # +X
@@ -91,52 +478,151 @@ def get_face_transform(face_idx, u, v, np):
     if face_idx == 4: return np.stack((u, -v, np.ones_like(u)), axis=-1)    # +Z
     if face_idx == 5: return np.stack((-u, -v, -np.ones_like(u)), axis=-1)  # -Z
 
-def process_file(filepath, np, cv2):
-    path = pathlib.Path(filepath)
-    if not path.exists():
-        print(f"[跳过] 文件不存在: {path}")
-        return
-        
-    print(f"\n>>> 正在读取: {path.name}")
+def direction_to_equirect_uv(vec, np):
+    """单位方向 -> 全景图 uv (0~1)，与 process_file 的投影约定一致"""
+    phi = np.arctan2(vec[..., 2], vec[..., 0])
+    theta = np.arcsin(np.clip(vec[..., 1], -1.0, 1.0))
+    return (phi / (2.0 * np.pi)) + 0.5, 0.5 - (theta / np.pi)
 
-    try:
-        # 读取 HDR/EXR (flags=-1 等同于 IMREAD_UNCHANGED)
-        img = cv2.imread(str(path), -1)
-        
-        # 如果读取失败，尝试 Numpy workaround (解决中文路径问题)
-        if img is None:
-            img_array = np.fromfile(str(path), dtype=np.uint8)
-            img = cv2.imdecode(img_array, -1)
-            
-        if img is None:
-            print("[错误] 无法解码文件，文件可能已损坏。")
-            return
+def projection_dims(projection, size):
+    """输出纹理 mip0 的 (宽, 高)，cube 为单个面的尺寸"""
+    return (2 * size, size) if projection == "paraboloid" else (size, size)
 
-        # 通道处理
-        if img.ndim == 2:
-            img = np.stack([img]*3, axis=-1)
-        
-        # OpenCV 默认读 EXR 为 BGR，必须转 RGB
-        if img.shape[2] >= 3:
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            if img.shape[2] > 3: img = img[..., :3] # 扔掉 alpha
+def projection_mip_dims(projection, size):
+    """各 mip 级的 (宽, 高)；双抛物面在宽度小于 2 时停止，保证两个半球始终各占至少一列"""
+    dims = [projection_dims(projection, size)]
+    while dims[-1] != (1, 1):
+        mw, mh = dims[-1]
+        dims.append((max(1, mw // 2), max(1, mh // 2)))
+    if projection == "paraboloid":
+        dims = [d for d in dims if d[0] >= 2]
+    return dims
 
-        img = img.astype(np.float32)
-        h, w = img.shape[:2]
+def octahedral_directions(s, t, np):
+    """八面体展开 (+Y 在中心，-Y 在四角)，s / t ∈ [-1, 1] 分别对应 x / z，返回单位方向 (..., 3)"""
+    x, z = s, t
+    y = 1.0 - np.abs(s) - np.abs(t)
+    lower = y < 0
+    # 下半球折回到外侧三角形
+    x = np.where(lower, (1.0 - np.abs(t)) * np.where(s >= 0, 1.0, -1.0), x)
+    z = np.where(lower, (1.0 - np.abs(s)) * np.where(t >= 0, 1.0, -1.0), z)
+    vec = np.stack((x, y, z), axis=-1)
+    return vec / np.linalg.norm(vec, axis=-1, keepdims=True)
 
-    except Exception as e:
-        print(f"[读取异常] {e}")
-        return
+def paraboloid_directions(s, t, hemisphere, np):
+    """单个抛物面 (hemisphere = +1 上半球 / -1 下半球)，s / t ∈ [-1, 1] 对应 x / z
 
-    # --- 采样 ---
-    print(f"    正在计算球面投影 (Size={CUBEMAP_SIZE})...")
-    
-    lin = np.linspace(-1, 1, CUBEMAP_SIZE, dtype=np.float32)
+    单位圆外的纹素钳到圆周 (地平线方向)，使 mip 缩小和双线性采样时边缘没有黑边。
+    """
+    r2 = s * s + t * t
+    scale = np.where(r2 > 1.0, 1.0 / np.sqrt(np.maximum(r2, 1e-12)), 1.0)
+    s, t = s * scale, t * scale
+    r2 = np.minimum(r2, 1.0)
+    vec = np.stack((2.0 * s, hemisphere * (1.0 - r2), 2.0 * t), axis=-1) / (1.0 + r2)[..., None]
+    return vec / np.linalg.norm(vec, axis=-1, keepdims=True)
+
+def projection_texel_directions(projection, width, height, np):
+    """2D 投影 (octahedral / paraboloid) 的纹素中心方向 (height, width, 3)"""
+    if projection == "octahedral":
+        s = ((np.arange(width, dtype=np.float32) + 0.5) / width) * 2.0 - 1.0
+        t = ((np.arange(height, dtype=np.float32) + 0.5) / height) * 2.0 - 1.0
+        s, t = np.meshgrid(s, t)
+        return octahedral_directions(s, t, np).astype(np.float32)
+    half = width // 2
+    s = ((np.arange(half, dtype=np.float32) + 0.5) / half) * 2.0 - 1.0
+    t = ((np.arange(height, dtype=np.float32) + 0.5) / height) * 2.0 - 1.0
+    s, t = np.meshgrid(s, t)
+    upper = paraboloid_directions(s, t, 1.0, np)
+    lower = paraboloid_directions(s, t, -1.0, np)
+    return np.concatenate((upper, lower), axis=1).astype(np.float32)
+
+def build_remap_tables(size, w, h, np, projection="cube"):
+    """计算 cv2.remap 采样坐标 (像素中心约定，x 已加上 SEAM_PAD 偏移)
+
+    cube 返回 (6, 2, size, size)；2D 投影只有一张图，返回 (1, 2, 高, 宽)。
+    """
+    if projection != "cube":
+        vec = projection_texel_directions(projection, *projection_dims(projection, size), np)
+        uv_u, uv_v = direction_to_equirect_uv(vec, np)
+        return np.stack((uv_u * w - 0.5 + SEAM_PAD, uv_v * h - 0.5)).astype(np.float32)[None]
+
+    lin = np.linspace(-1, 1, size, dtype=np.float32)
     u, v = np.meshgrid(lin, lin)
-    faces_mips = []
+    tables = np.empty((6, 2, size, size), dtype=np.float32)
+    for i in range(6):
+        vec = get_face_transform(i, u, v, np)
+        vec = vec / np.linalg.norm(vec, axis=-1, keepdims=True)
+        uv_u, uv_v = direction_to_equirect_uv(vec, np)
 
-    # 预计算像素映射以加速 (Linear Sampling)
-    # 这里为了代码简洁，使用最近邻+resize线性插值
+        tables[i, 0] = uv_u * w - 0.5 + SEAM_PAD
+        tables[i, 1] = uv_v * h - 0.5
+    return tables
+
+_remap_tables = {}
+
+def get_remap_tables(size, w, h, np, projection="cube"):
+    """按 (投影, size, 源图宽高) 取重映射表：进程内缓存 -> 磁盘缓存 -> 现算并落盘"""
+    key = (projection, size, w, h)
+    if key in _remap_tables:
+        return _remap_tables[key]
+
+    cache_path = REMAP_CACHE_DIR / f"remap_v{REMAP_CACHE_VERSION}_{projection}_{size}_{w}x{h}_pad{SEAM_PAD}.npy"
+    if projection == "cube":
+        expected_shape = (6, 2, size, size)
+    else:
+        pw, ph = projection_dims(projection, size)
+        expected_shape = (1, 2, ph, pw)
+    tables = None
+    if cache_path.exists():
+        try:
+            tables = np.load(str(cache_path))
+            if tables.shape != expected_shape or tables.dtype != np.float32:
+                tables = None
+        except Exception:
+            tables = None
+
+    if tables is None:
+        tables = build_remap_tables(size, w, h, np, projection)
+        try:
+            REMAP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            # 先写临时文件再替换，避免并行批处理读到半个文件
+            tmp_path = cache_path.with_name(f"{cache_path.stem}.{os.getpid()}.tmp.npy")
+            np.save(str(tmp_path), tables)
+            os.replace(str(tmp_path), str(cache_path))
+        except OSError as e:
+            print(f"    [提示] 重映射表缓存写入失败，本次仅在内存中使用: {e}")
+    else:
+        print(f"    命中重映射表缓存: {cache_path.name}")
+
+    _remap_tables[key] = tables
+    return tables
+
+def remap_interpolation(filter_mode, cv2):
+    return {"nearest": cv2.INTER_NEAREST, "bicubic": cv2.INTER_CUBIC}.get(filter_mode, cv2.INTER_LINEAR)
+
+def iter_faces_filtered(img, size, filter_mode, np, cv2, projection="cube"):
+    """按重映射表逐面采样 (生成器)，经度方向环绕，纬度方向 (两极) 钳制；2D 投影只产出一张图"""
+    h, w = img.shape[:2]
+    tables = get_remap_tables(size, w, h, np, projection)
+    interp = remap_interpolation(filter_mode, cv2)
+    # 左右各补 SEAM_PAD 列环绕像素，使接缝两侧的插值邻域连续
+    padded = cv2.copyMakeBorder(img, 0, 0, SEAM_PAD, SEAM_PAD, cv2.BORDER_WRAP)
+    for i in range(len(tables)):
+        face = cv2.remap(padded, tables[i, 0], tables[i, 1], interp, borderMode=cv2.BORDER_REPLICATE)
+        if filter_mode == "bicubic":
+            # 双三次会产生负的振铃，HDR 辐射度不能为负
+            np.maximum(face, 0, out=face)
+        yield face
+
+def iter_faces_nearest(img, size, np, tiled=False):
+    """旧版最近邻逐面采样 (生成器)
+
+    tiled=True 为低内存版：按源图行分块聚集，每块只读它覆盖到的源图行，结果与整体聚集逐字节相同。
+    """
+    h, w = img.shape[:2]
+    rows_per_tile = max(1, LOW_MEMORY_TILE_PIXELS // w)
+    lin = np.linspace(-1, 1, size, dtype=np.float32)
+    u, v = np.meshgrid(lin, lin)
     for i in range(6):
         vec = get_face_transform(i, u, v, np)
         norm = np.linalg.norm(vec, axis=-1, keepdims=True)
@@ -151,52 +637,1024 @@ def process_file(filepath, np, cv2):
         px_x = np.clip(uv_u * (w - 1), 0, w - 1).astype(int)
         px_y = np.clip(uv_v * (h - 1), 0, h - 1).astype(int)
         
-        face = img[px_y, px_x] 
+        if not tiled:
+            yield img[px_y, px_x]
+            continue
+        # 按源图行排序后切块，每块一次花式索引
+        order = np.argsort(px_y, axis=None, kind="stable")
+        ys, xs = px_y.ravel()[order], px_x.ravel()[order]
+        bounds = np.searchsorted(ys, np.arange(0, h + rows_per_tile, rows_per_tile))
+        face = np.empty((size * size, img.shape[2]), dtype=img.dtype)
+        for y0, a, b in zip(range(0, h, rows_per_tile), bounds[:-1], bounds[1:]):
+            if a < b:
+                face[order[a:b]] = img[y0:y0 + rows_per_tile][ys[a:b] - y0, xs[a:b]]
+                drop_memmap_pages(img)
+        yield face.reshape(size, size, -1)
 
-        # Mipmap 生成
-        mips = [face]
-        if GENERATE_MIPS:
-            curr = face
-            ch, cw = CUBEMAP_SIZE, CUBEMAP_SIZE
-            while ch > 1 or cw > 1:
-                ch, cw = max(1, ch//2), max(1, cw//2)
-                curr = cv2.resize(curr, (cw, ch), interpolation=cv2.INTER_LINEAR)
-                mips.append(curr)
-        faces_mips.append(mips)
-
-    # --- 写入 DDS ---
-    out_name = f"cubemap_{path.stem}_radiance.dds"
-    out_path = path.parent / out_name
-    print(f"    正在写入 DDS: {out_name}")
+def iter_faces_tiled(img, size, filter_mode, np, cv2, projection="cube"):
+    """低内存版 iter_faces_filtered: 每个面按行分块，只取该分块覆盖到的源图行"""
+    h, w = img.shape[:2]
+    tables = get_remap_tables(size, w, h, np, projection)
+    interp = remap_interpolation(filter_mode, cv2)
+    face_h, face_w = tables.shape[2:]
+    rows_per_tile = max(1, LOW_MEMORY_TILE_PIXELS // face_w)
+    for i in range(len(tables)):
+        face = np.empty((face_h, face_w, 3), dtype=np.float32)
+        for r0 in range(0, face_h, rows_per_tile):
+            map_x = tables[i, 0, r0:r0 + rows_per_tile]
+            map_y = tables[i, 1, r0:r0 + rows_per_tile]
+            # 上下多留 SEAM_PAD 行，保证分块边缘的插值邻域是真实像素；
+            # y0 取偶数: INTER_NEAREST 对 .5 按就近取偶舍入，平移奇数行会改变舍入方向
+            y0 = max(0, int(math.floor(float(map_y.min()))) - SEAM_PAD) & ~1
+            y1 = min(h, int(math.ceil(float(map_y.max()))) + SEAM_PAD + 1)
+            src = cv2.copyMakeBorder(np.ascontiguousarray(img[y0:y1]), 0, 0, SEAM_PAD, SEAM_PAD, cv2.BORDER_WRAP)
+            face[r0:r0 + rows_per_tile] = cv2.remap(src, map_x, map_y - np.float32(y0), interp,
+                                                    borderMode=cv2.BORDER_REPLICATE)
+            drop_memmap_pages(img)
+        if filter_mode == "bicubic":
+            np.maximum(face, 0, out=face)
+        yield face
 
-    mip_levels = len(faces_mips[0])
-    
+# ============================================================
+# GGX 镜面预滤波 (Split-Sum 近似，N = V = R)
+# ============================================================
+def hammersley(n, np):
+    """Hammersley 低差异序列，返回 (n, 2)"""
+    bits = np.arange(n, dtype=np.uint32)
+    bits = ((bits << 16) | (bits >> 16)).astype(np.uint32)
+    bits = (((bits & 0x55555555) << 1) | ((bits & 0xAAAAAAAA) >> 1)).astype(np.uint32)
+    bits = (((bits & 0x33333333) << 2) | ((bits & 0xCCCCCCCC) >> 2)).astype(np.uint32)
+    bits = (((bits & 0x0F0F0F0F) << 4) | ((bits & 0xF0F0F0F0) >> 4)).astype(np.uint32)
+    bits = (((bits & 0x00FF00FF) << 8) | ((bits & 0xFF00FF00) >> 8)).astype(np.uint32)
+    return np.stack([np.arange(n) / n, bits * 2.3283064365386963e-10], axis=-1)
+
+def build_equirect_pyramid(img, np, cv2, low_memory=False):
+    """源图 mip 金字塔，每级左右补好环绕列，供按采样 pdf 选级采样
+
+    低内存模式下超过一个分块的级别按行分块补列、降采样并写进临时文件，以只读 memmap 返回，
+    用完交给 release_pyramid；结果与整图构建逐字节一致。
+    """
+    pyramid = []
+    level, tiles = img, None
+    lh, lw = img.shape[:2]
+    try:
+        while low_memory and lh * lw > LOW_MEMORY_TILE_PIXELS:
+            rows = max(2, LOW_MEMORY_TILE_PIXELS // lw) & ~1
+            if tiles is None:
+                tiles = (level[r0:r0 + rows] for r0 in range(0, lh, rows))
+            pyramid.append(spill_padded_level(lh, lw, tiles, np, cv2))
+            drop_memmap_pages(level)
+            level, tiles = pyramid[-1][:, SEAM_PAD:SEAM_PAD + lw], None
+            if min(lh, lw) <= 1:
+                return pyramid
+            size = (max(1, lw // 2), max(1, lh // 2))
+            if lh % 2:
+                # 奇数行高时 INTER_AREA 的纵向权重跨分块，只能整级降采样
+                level = cv2.resize(level, size, interpolation=cv2.INTER_AREA)
+            else:
+                tiles = halve_row_tiles(level, rows, size[0], cv2)
+            lw, lh = size
+        if tiles is not None:
+            level = np.concatenate(list(tiles))
+    except BaseException:
+        release_pyramid(pyramid)
+        raise
+    levels = [level]
+    while min(levels[-1].shape[:2]) > 1:
+        lh, lw = levels[-1].shape[:2]
+        levels.append(cv2.resize(levels[-1], (max(1, lw // 2), max(1, lh // 2)), interpolation=cv2.INTER_AREA))
+    return pyramid + [cv2.copyMakeBorder(l, 0, 0, SEAM_PAD, SEAM_PAD, cv2.BORDER_WRAP) for l in levels]
+
+def halve_row_tiles(level, rows, width, cv2):
+    """偶数行分块逐块 INTER_AREA 降一级: 2:1 纵向面积平均不跨块，与整级降采样一致"""
+    for r0 in range(0, level.shape[0], rows):
+        tile = level[r0:r0 + rows]
+        yield cv2.resize(tile, (width, len(tile) // 2), interpolation=cv2.INTER_AREA)
+
+def face_texel_directions(face_idx, size, np):
+    """mip 级纹素中心方向 (size, size, 3)，小尺寸 mip 不会落在面的角上"""
+    lin = ((np.arange(size, dtype=np.float32) + 0.5) / size) * 2.0 - 1.0
+    u, v = np.meshgrid(lin, lin)
+    vec = get_face_transform(face_idx, u, v, np)
+    return vec / np.linalg.norm(vec, axis=-1, keepdims=True)
+
+def sample_pyramid(pyramid, vec, lod, np, cv2):
+    """在源金字塔上做三线性采样，lod 为标量"""
+    uv_u, uv_v = direction_to_equirect_uv(vec, np)
+    lo = int(math.floor(lod))
+    hi = min(lo + 1, len(pyramid) - 1)
+    frac = lod - lo
+    result = None
+    for level, weight in ((lo, 1.0 - frac), (hi, frac)):
+        if weight <= 0.0:
+            continue
+        src = pyramid[level]
+        lh, lw = src.shape[0], src.shape[1] - 2 * SEAM_PAD
+        map_x = (uv_u * lw - 0.5 + SEAM_PAD).astype(np.float32)
+        map_y = (uv_v * lh - 0.5).astype(np.float32)
+        s = cv2.remap(src, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        result = s * weight if result is None else result + s * weight
+    return result
+
+def ggx_sample_set(pyramid, src_w, src_h, roughness, np):
+    """一个粗糙度下的采样方向 (切线空间)、权重和源金字塔 lod，6 个面共用"""
+    a = roughness * roughness
+    xi = hammersley(PREFILTER_SAMPLES, np)
+    cos_t = np.sqrt((1.0 - xi[:, 1]) / (1.0 + (a * a - 1.0) * xi[:, 1]))
+    sin_t = np.sqrt(1.0 - cos_t * cos_t)
+    hx = (sin_t * np.cos(2.0 * np.pi * xi[:, 0])).astype(np.float32)
+    hy = (sin_t * np.sin(2.0 * np.pi * xi[:, 0])).astype(np.float32)
+    hz = cos_t.astype(np.float32)
+    n_dot_l = 2.0 * hz * hz - 1.0
+
+    # N = V 时 NdotH、pdf、NdotL 只和采样序号有关，可按样本统一选源 mip 级
+    d = (a * a) / (np.pi * ((hz * hz) * (a * a - 1.0) + 1.0) ** 2)
+    pdf = d / 4.0
+    sa_texel = 4.0 * np.pi / (src_w * src_h)
+    sa_sample = 1.0 / (PREFILTER_SAMPLES * pdf + 1e-6)
+    lods = np.clip(0.5 * np.log2(sa_sample / sa_texel) + 1.0, 0.0, len(pyramid) - 1)
+
+    valid = np.nonzero(n_dot_l > 0.0)[0]
+    return hx, hy, hz, n_dot_l, lods, valid, float(np.sum(n_dot_l[valid]))
+
+def prefilter_ggx_face(pyramid, samples, face_idx, size, np, cv2):
+    """对一个面的一个 mip 级做 GGX 重要性采样卷积"""
+    return prefilter_ggx_directions(pyramid, samples, face_texel_directions(face_idx, size, np), np, cv2)
+
+def prefilter_ggx_directions(pyramid, samples, n, np, cv2):
+    """对任意纹素方向图 n (h, w, 3) 做 GGX 重要性采样卷积，2D 投影也走这里"""
+    hx, hy, hz, n_dot_l, lods, valid, total_weight = samples
+    rows_per_chunk = max(1, PREFILTER_CHUNK // n.shape[1])
+    out = np.empty(n.shape, dtype=np.float32)
+    for r0 in range(0, n.shape[0], rows_per_chunk):
+        nc = n[r0:r0 + rows_per_chunk]
+        # 切线空间基
+        up = np.zeros_like(nc)
+        polar = np.abs(nc[..., 2]) >= 0.999
+        up[..., 2] = np.where(polar, 0.0, 1.0)
+        up[..., 0] = np.where(polar, 1.0, 0.0)
+        t = np.cross(up, nc)
+        t /= np.linalg.norm(t, axis=-1, keepdims=True)
+        b = np.cross(nc, t)
+
+        acc = np.zeros(nc.shape, dtype=np.float32)
+        for k in valid:
+            hvec = t * hx[k] + b * hy[k] + nc * hz[k]
+            lvec = 2.0 * hz[k] * hvec - nc
+            acc += n_dot_l[k] * sample_pyramid(pyramid, lvec, float(lods[k]), np, cv2)
+        out[r0:r0 + rows_per_chunk] = acc / total_weight
+    return out
+
+def prefilter_ggx_level(pyramid, src_w, src_h, size, roughness, np, cv2):
+    """对一个 mip 级的 6 个面做 GGX 重要性采样卷积"""
+    samples = ggx_sample_set(pyramid, src_w, src_h, roughness, np)
+    return [prefilter_ggx_face(pyramid, samples, face_idx, size, np, cv2) for face_idx in range(6)]
+
+# ============================================================
+# SH9 漫反射辐照度
+# ============================================================
+# l = 0, 1, 2 的余弦卷积系数 A_l
+SH_BAND_FACTORS = (math.pi,) + (2.0 * math.pi / 3.0,) * 3 + (math.pi / 4.0,) * 5
+
+def sh9_basis(vec, np):
+    """实数球谐前 9 项，方向坐标系与 get_face_transform 相同，返回 (..., 9)"""
+    x, y, z = vec[..., 0], vec[..., 1], vec[..., 2]
+    return np.stack([
+        np.full_like(x, 0.282095),
+        0.488603 * y,
+        0.488603 * z,
+        0.488603 * x,
+        1.092548 * x * y,
+        1.092548 * y * z,
+        0.315392 * (3.0 * z * z - 1.0),
+        1.092548 * x * z,
+        0.546274 * (x * x - y * y),
+    ], axis=-1)
+
+def project_sh9(img, np):
+    """按立体角加权把全景图投影到 SH9，返回 (9, 3) 辐亮度系数"""
+    h, w = img.shape[:2]
+    # 像素中心的经纬度，与 direction_to_equirect_uv 互逆
+    phi = ((np.arange(w, dtype=np.float64) + 0.5) / w - 0.5) * 2.0 * np.pi
+    lat = (0.5 - (np.arange(h, dtype=np.float64) + 0.5) / h) * np.pi
+    cos_phi, sin_phi = np.cos(phi), np.sin(phi)
+    # 每行的立体角: dω = cos(lat) · (2π / w) · (π / h)
+    d_omega = np.cos(lat) * (2.0 * np.pi / w) * (np.pi / h)
+
+    rows_per_chunk = max(1, SH_CHUNK_PIXELS // w)
+    coeffs = np.zeros((9, 3), dtype=np.float64)
+    for r0 in range(0, h, rows_per_chunk):
+        r1 = min(h, r0 + rows_per_chunk)
+        cl = np.cos(lat[r0:r1])[:, None]
+        vec = np.stack([
+            cl * cos_phi[None, :],
+            np.broadcast_to(np.sin(lat[r0:r1])[:, None], (r1 - r0, w)),
+            cl * sin_phi[None, :],
+        ], axis=-1)
+        basis = sh9_basis(vec, np) * d_omega[r0:r1, None, None]
+        coeffs += np.einsum('hwk,hwc->kc', basis, img[r0:r1, :, :3], optimize=True)
+        drop_memmap_pages(img)
+    return coeffs
+
+def sh9_irradiance_coeffs(coeffs, np):
+    """乘上 A_l / π，使 Σ c·Y(n) 直接等于 Lambert 出射辐亮度 (反照率=1)"""
+    return coeffs * (np.array(SH_BAND_FACTORS) / math.pi)[:, None]
+
+def export_sh9(img, path, np):
+    t0 = time.perf_counter()
+    radiance = project_sh9(img, np)
+    irradiance = sh9_irradiance_coeffs(radiance, np)
+
+    outputs = output_paths(path)
+    json_path = outputs["sh9.json"]
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            "source": path.name,
+            "basis": "real SH, l<=2, order: Y00, Y1-1(y), Y10(z), Y11(x), Y2-2, Y2-1, Y20, Y21, Y22",
+            "radiance": radiance.tolist(),
+            "irradiance": irradiance.tolist(),
+            "irradiance_note": "diffuse = albedo * sum(irradiance[k] * Y_k(n))",
+        }, f, indent=2)
+
+    # 9 x RGB float32 小端，即 json 里的 irradiance
+    bin_path = outputs["sh9.bin"]
+    irradiance.astype('<f4').tofile(str(bin_path))
+    print(f"    SH9 已导出: {json_path.name}, {bin_path.name} ({time.perf_counter() - t0:.2f}s)")
+
+    if SH_IRRADIANCE_CUBE_SIZE > 0:
+        def levels():
+            for face_idx in range(6):
+                basis = sh9_basis(face_texel_directions(face_idx, SH_IRRADIANCE_CUBE_SIZE, np), np)
+                yield face_idx, 0, np.maximum(basis @ irradiance.astype(np.float32), 0.0).astype(np.float32)
+        dds_path = outputs["irradiance.dds"]
+        write_dds_cubemap(dds_path, SH_IRRADIANCE_CUBE_SIZE, 1, levels(), np)
+        print(f"    辐照度 cubemap 已导出: {dds_path.name} ({SH_IRRADIANCE_CUBE_SIZE}²)")
+
+# ============================================================
+# 环境光重要性采样表
+# ============================================================
+# 文件布局 (小端): 128 字节头 + 各段 (64 字节对齐)
+#   头: magic 'ENVS', version, width, height, total (float32), 然后是下面 7 段的 uint64 偏移
+#   pmf                  float32 [h][w]    每像素离散概率 (亮度 * sinθ / total)
+#   marginal_cdf         float32 [h + 1]   行的边缘 CDF
+#   conditional_cdf      float32 [h][w + 1] 每行的条件 CDF
+#   marginal_alias_prob  float32 [h]       行的 Walker alias 表
+#   marginal_alias_idx   uint32  [h]
+#   conditional_alias_prob float32 [h][w]  每行的 Walker alias 表
+#   conditional_alias_idx  uint32  [h][w]
+# 像素 (row, col) 与全景图一致，方向换算见 direction_to_equirect_uv；
+# 立体角 pdf = pmf * w * h / (2 * π² * sinθ)
+SAMPLING_MAGIC = b'ENVS'
+SAMPLING_VERSION = 1
+SAMPLING_HEADER = struct.Struct('<4sIIIf7Q')
+SAMPLING_SECTIONS = (
+    ("pmf", 'f4', lambda h, w: (h, w)),
+    ("marginal_cdf", 'f4', lambda h, w: (h + 1,)),
+    ("conditional_cdf", 'f4', lambda h, w: (h, w + 1)),
+    ("marginal_alias_prob", 'f4', lambda h, w: (h,)),
+    ("marginal_alias_idx", 'u4', lambda h, w: (h,)),
+    ("conditional_alias_prob", 'f4', lambda h, w: (h, w)),
+    ("conditional_alias_idx", 'u4', lambda h, w: (h, w)),
+)
+
+def build_cdf(weights, np):
+    """每行权重 -> 每行 CDF (首项 0，末项 1)；全零行退化为均匀分布"""
+    sums = weights.sum(axis=-1, keepdims=True)
+    n = weights.shape[-1]
+    safe = np.where(sums > 0, weights / np.where(sums > 0, sums, 1.0), 1.0 / n)
+    cdf = np.zeros(weights.shape[:-1] + (n + 1,), dtype=np.float64)
+    np.cumsum(safe, axis=-1, out=cdf[..., 1:])
+    cdf[..., -1] = 1.0
+    return cdf
+
+def build_alias_tables(weights, np):
+    """每行一张 Walker alias 表 (Vose 算法)，对所有行同时推进
+
+    每行按概率升序排好后，小项指针 sp 从头走、大项指针 lp 从第一个 >= 1 的项走；
+    每一步各行要么用当前大项填一个小项，要么在当前大项被削到 < 1 时把它当小项、由下一个大项填。
+    每步至少推进一个指针，所以最多 n 步。
+    """
+    rows, n = weights.shape
+    sums = weights.sum(axis=-1, keepdims=True)
+    q = np.where(sums > 0, weights * (n / np.where(sums > 0, sums, 1.0)), 1.0).astype(np.float64)
+    order = np.argsort(q, axis=-1, kind='stable')
+    prob = np.ones((rows, n), dtype=np.float64)
+    alias = np.broadcast_to(np.arange(n, dtype=np.int64), (rows, n)).copy()
+
+    n_small = (q < 1.0).sum(axis=-1)
+    sp = np.zeros(rows, dtype=np.int64)
+    lp = n_small.copy()
+    active = np.nonzero(n_small < n)[0]
+    while active.size:
+        r = active
+        cur = order[r, lp[r]]
+        q_cur = q[r, cur]
+        # B: 当前大项已不足 1，转作小项，由下一个大项补齐
+        case_b = (q_cur < 1.0) & (lp[r] + 1 < n)
+        # A: 用当前大项补齐下一个小项
+        case_a = ~case_b & (sp[r] < n_small[r])
+
+        rb = r[case_b]
+        if rb.size:
+            j = cur[case_b]
+            nxt = order[rb, lp[rb] + 1]
+            prob[rb, j] = q[rb, j]
+            alias[rb, j] = nxt
+            q[rb, nxt] -= 1.0 - q[rb, j]
+            lp[rb] += 1
+
+        ra = r[case_a]
+        if ra.size:
+            i = order[ra, sp[ra]]
+            big = cur[case_a]
+            prob[ra, i] = q[ra, i]
+            alias[ra, i] = big
+            q[ra, big] -= 1.0 - q[ra, i]
+            sp[ra] += 1
+
+        active = r[case_a | case_b]
+    return np.clip(prob, 0.0, 1.0).astype(np.float32), alias.astype(np.uint32)
+
+def sampling_weights(img, np, cv2):
+    """sinθ 加权亮度，返回 (高, 宽, blocks)；blocks() 每次调用按行块产出 (r0, float64 权重)
+
+    源图按行分块读取 (可以是 memmap)，不整张拷贝。超过 SAMPLING_TABLE_MAX_WIDTH 时逐块做面积降采样，
+    降采样结果常驻内存 (大小受 MAX_WIDTH 限制)；不降采样时每次调用都从源图现算。
+    """
+    h, w = img.shape[:2]
+    rows = max(1, LOW_MEMORY_TILE_PIXELS // w)
+
+    def lum_tiles():
+        for r0 in range(0, h, rows):
+            tile = img[r0:r0 + rows]
+            yield r0, tile[..., 0] * 0.2126 + tile[..., 1] * 0.7152 + tile[..., 2] * 0.0722
+            drop_memmap_pages(img)
+
+    if SAMPLING_TABLE_MAX_WIDTH and w > SAMPLING_TABLE_MAX_WIDTH:
+        tw = SAMPLING_TABLE_MAX_WIDTH
+        th = max(1, int(round(h * tw / w)))
+        # 横向用 INTER_AREA，纵向按源行与目标行的覆盖长度累加，等价于整图面积平均
+        small = np.zeros((th, tw), dtype=np.float64)
+        sy = h / th
+        for r0, lum in lum_tiles():
+            lum = cv2.resize(np.ascontiguousarray(lum), (tw, len(lum)), interpolation=cv2.INTER_AREA)
+            r1 = r0 + len(lum)
+            o0, o1 = int(r0 // sy), min(th, int(math.ceil(r1 / sy)))
+            lo = np.arange(o0, o1, dtype=np.float64)[:, None] * sy
+            src = np.arange(r0, r1, dtype=np.float64)[None, :]
+            cover = np.clip(np.minimum(src + 1.0, lo + sy) - np.maximum(src, lo), 0.0, None) / sy
+            small[o0:o1] += cover @ lum
+        h, w = th, tw
+        rows = max(1, LOW_MEMORY_TILE_PIXELS // w)
+
+        def lum_tiles():
+            for r0 in range(0, h, rows):
+                yield r0, small[r0:r0 + rows]
+
+    # θ 为与 +Y 的夹角，像素中心 sinθ = cos(纬度)
+    sin_theta = np.cos((0.5 - (np.arange(h, dtype=np.float64) + 0.5) / h) * np.pi)
+
+    def blocks():
+        for r0, lum in lum_tiles():
+            yield r0, np.maximum(lum, 0.0) * sin_theta[r0:r0 + len(lum), None]
+    return h, w, blocks
+
+def export_sampling_tables(img, path, np, cv2):
+    """按行块流式写 pmf / CDF / alias 表：第一遍只求行和，第二遍逐块算条件表并写到各段对应位置"""
+    t0 = time.perf_counter()
+    h, w, blocks = sampling_weights(img, np, cv2)
+    row_sums = np.concatenate([weights.sum(axis=-1) for _, weights in blocks()])
+    total = float(row_sums.sum())
+    out_path = output_paths(path)["envsampling.bin"]
+
+    offsets = {}
+    offset = SAMPLING_HEADER.size
+    for name, dtype, shape in SAMPLING_SECTIONS:
+        offset = (offset + 63) // 64 * 64
+        offsets[name] = offset
+        offset += int(np.prod(shape(h, w))) * 4
+
+    dtypes = {name: dtype for name, dtype, _ in SAMPLING_SECTIONS}
+
+    def write(f, name, r0, data):
+        data = np.ascontiguousarray(data, dtype='<' + dtypes[name])
+        f.seek(offsets[name] + r0 * data[0].nbytes)
+        f.write(data.data)
+
+    with open(out_path, 'wb') as f:
+        f.write(SAMPLING_HEADER.pack(SAMPLING_MAGIC, SAMPLING_VERSION, w, h, total,
+                                     *(offsets[name] for name, _, _ in SAMPLING_SECTIONS)))
+        write(f, "marginal_cdf", 0, build_cdf(row_sums[None, :], np)[0])
+        prob, alias = build_alias_tables(row_sums[None, :], np)
+        write(f, "marginal_alias_prob", 0, prob[0])
+        write(f, "marginal_alias_idx", 0, alias[0])
+        for r0, weights in blocks():
+            write(f, "pmf", r0, weights / total if total > 0 else np.full(weights.shape, 1.0 / (h * w)))
+            write(f, "conditional_cdf", r0, build_cdf(weights, np))
+            prob, alias = build_alias_tables(weights, np)
+            write(f, "conditional_alias_prob", r0, prob)
+            write(f, "conditional_alias_idx", r0, alias)
+    print(f"    重要性采样表已导出: {out_path.name} ({w}x{h}, {out_path.stat().st_size / 1048576:.2f} MB, "
+          f"{time.perf_counter() - t0:.2f}s)")
+
+def read_sampling_tables(path, np):
+    """memmap 方式读取 _envsampling.bin，返回 dict: width / height / total 及各段只读视图"""
+    raw = np.memmap(str(path), dtype=np.uint8, mode='r')
+    magic, version, w, h, total, *offsets = SAMPLING_HEADER.unpack(bytes(raw[:SAMPLING_HEADER.size]))
+    if magic != SAMPLING_MAGIC or version != SAMPLING_VERSION:
+        raise ValueError(f"不是 v{SAMPLING_VERSION} 的采样表文件: {path}")
+    tables = {"width": w, "height": h, "total": total}
+    for (name, dtype, shape), off in zip(SAMPLING_SECTIONS, offsets):
+        dims = shape(h, w)
+        tables[name] = raw[off:off + int(np.prod(dims)) * 4].view('<' + dtype).reshape(dims)
+    return tables
+
+# ============================================================
+# BC6H_UF16 编码 (单分区 mode 11: 10 位端点，不做 delta 变换，4 位索引)
+# ============================================================
+BC6H_WEIGHTS = (0, 4, 9, 13, 17, 21, 26, 30, 34, 38, 43, 47, 51, 55, 60, 64)
+
+def bc6h_blocks(img, np):
+    """(h, w, 3) -> (块数, 16, 3)，不足 4 的边缘按边界像素补齐，块内行主序"""
+    h, w = img.shape[:2]
+    bh, bw = (h + 3) // 4, (w + 3) // 4
+    if bh * 4 != h or bw * 4 != w:
+        img = np.pad(img, ((0, bh * 4 - h), (0, bw * 4 - w), (0, 0)), mode='edge')
+    return img.reshape(bh, 4, bw, 4, 3).transpose(0, 2, 1, 3, 4).reshape(-1, 16, 3), bh, bw
+
+def bc6h_to_domain(img, np):
+    """float -> 编码域: half 位模式 h 映射到插值空间 (h + 0.5) * 64 / 31 (解码端 x * 31 >> 6 的逆)"""
+    half = np.clip(np.nan_to_num(img, nan=0.0, posinf=65504.0), 0.0, 65504.0).astype(np.float16)
+    return (half.view(np.uint16).astype(np.float32) + 0.5) * (64.0 / 31.0)
+
+def bc6h_unquantize(q, np):
+    """10 位端点 -> 16 位插值空间，与 D3D 解码规则一致"""
+    q = q.astype(np.int64)
+    unq = ((q << 16) + 0x8000) >> 10
+    unq = np.where(q == 0, 0, unq)
+    return np.where(q == 1023, 0xFFFF, unq)
+
+def bc6h_quantize(e, np):
+    return np.clip(np.rint((e - 32.0) / 64.0), 0, 1023).astype(np.int64)
+
+def bc6h_palette(qa, qb, np):
+    """(n, 3) 端点 -> (n, 16, 3) 调色板 (插值空间)"""
+    wts = np.array(BC6H_WEIGHTS, dtype=np.int64)[None, :, None]
+    a = bc6h_unquantize(qa, np)[:, None, :]
+    b = bc6h_unquantize(qb, np)[:, None, :]
+    return (a * (64 - wts) + b * wts + 32) >> 6
+
+def bc6h_pick_indices(x, pal, np):
+    """对每个像素在 16 色调色板中找最近项，返回 (索引, 每块误差)"""
+    d = x[:, :, None, :] - pal[:, None, :, :].astype(np.float32)
+    dist = np.einsum('npkc,npkc->npk', d, d)
+    idx = np.argmin(dist, axis=-1)
+    err = np.take_along_axis(dist, idx[..., None], axis=-1)[..., 0].sum(axis=-1)
+    return idx, err
+
+def bc6h_project_indices(x, qa, qb, np):
+    """fast 预设: 沿端点线段投影后按权重中点取索引"""
+    a = bc6h_unquantize(qa, np).astype(np.float32)[:, None, :]
+    b = bc6h_unquantize(qb, np).astype(np.float32)[:, None, :]
+    ab = b - a
+    t = np.einsum('npc,npc->np', x - a, np.broadcast_to(ab, x.shape)) / np.maximum(np.einsum('npc,npc->np', ab, ab), 1e-8)
+    mids = (np.array(BC6H_WEIGHTS[:-1]) + np.array(BC6H_WEIGHTS[1:])) / 128.0
+    return np.searchsorted(mids, np.clip(t, 0.0, 1.0))
+
+def bc6h_fit_endpoints(x, preset, np):
+    if preset == "fast":
+        return x.min(axis=1), x.max(axis=1)
+    # 主轴: 对协方差矩阵做几次幂迭代；编码域数值可达 1e5，平方后 float32 会溢出，故用 float64
+    x = x.astype(np.float64)
+    mean = x.mean(axis=1, keepdims=True)
+    c = x - mean
+    cov = np.einsum('npi,npj->nij', c, c)
+    # 从包围盒对角线 (min/max 轴) 起步并先归一化；迭代退化 (范数为 0) 的块保持该轴
+    box = x.max(axis=1) - x.min(axis=1)
+    norm = np.linalg.norm(box, axis=-1, keepdims=True)
+    box = np.where(norm > 0, box / np.maximum(norm, 1e-300), 1.0 / np.sqrt(3.0))
+    axis = box
+    for _ in range(4):
+        nxt = np.einsum('nij,nj->ni', cov, axis)
+        norm = np.linalg.norm(nxt, axis=-1, keepdims=True)
+        axis = np.where(norm > 0, nxt / np.maximum(norm, 1e-300), box)
+    t = np.einsum('npc,nc->np', c, axis)
+    e0 = mean[:, 0] + axis * t.min(axis=1, keepdims=True)
+    e1 = mean[:, 0] + axis * t.max(axis=1, keepdims=True)
+    return e0.astype(np.float32), e1.astype(np.float32)
+
+def bc6h_refine_endpoints(x, idx, np):
+    """固定索引，按最小二乘重新求端点"""
+    t = np.array(BC6H_WEIGHTS, dtype=np.float32)[idx] / 64.0
+    s = 1.0 - t
+    aa, ab, bb = (s * s).sum(1), (s * t).sum(1), (t * t).sum(1)
+    ra = np.einsum('np,npc->nc', s, x)
+    rb = np.einsum('np,npc->nc', t, x)
+    det = aa * bb - ab * ab
+    ok = (np.abs(det) > 1e-6)[:, None]
+    det = np.where(ok[:, 0], det, 1.0)[:, None]
+    e0 = (ra * bb[:, None] - rb * ab[:, None]) / det
+    e1 = (rb * aa[:, None] - ra * ab[:, None]) / det
+    mean = x.mean(axis=1)
+    return np.where(ok, e0, mean), np.where(ok, e1, mean)
+
+def bc6h_encode_blocks(x, preset, np):
+    """x: (n, 16, 3) 编码域像素 -> (n, 16) uint8 块数据"""
+    e0, e1 = bc6h_fit_endpoints(x, preset, np)
+    qa, qb = bc6h_quantize(e0, np), bc6h_quantize(e1, np)
+    if preset == "fast":
+        idx = bc6h_project_indices(x, qa, qb, np)
+    else:
+        idx, err = bc6h_pick_indices(x, bc6h_palette(qa, qb, np), np)
+        r0, r1 = bc6h_refine_endpoints(x, idx, np)
+        ra, rb = bc6h_quantize(r0, np), bc6h_quantize(r1, np)
+        # 候选: 主轴端点 / 最小二乘精修 / fast 的 min-max 端点，逐块取误差最小者，保证不劣于 fast
+        ma, mb = bc6h_quantize(x.min(axis=1), np), bc6h_quantize(x.max(axis=1), np)
+        for ca, cb in ((ra, rb), (ma, mb)):
+            cidx, cerr = bc6h_pick_indices(x, bc6h_palette(ca, cb, np), np)
+            better = cerr < err
+            qa = np.where(better[:, None], ca, qa)
+            qb = np.where(better[:, None], cb, qb)
+            idx = np.where(better[:, None], cidx, idx)
+            err = np.where(better, cerr, err)
+
+    # 锚点 (像素 0) 只存 3 位，最高位必须为 0，否则交换端点并翻转索引
+    flip = idx[:, 0] >= 8
+    qa, qb = np.where(flip[:, None], qb, qa), np.where(flip[:, None], qa, qb)
+    idx = np.where(flip[:, None], 15 - idx, idx).astype(np.uint64)
+    qa, qb = qa.astype(np.uint64), qb.astype(np.uint64)
+
+    # 128 位 = lo (位 0~63) + hi (位 64~127)
+    u64 = np.uint64
+    lo = np.full(len(x), 0x03, dtype=np.uint64)   # mode 11 = 00011
+    fields = [qa[:, 0], qa[:, 1], qa[:, 2], qb[:, 0], qb[:, 1], qb[:, 2]]
+    for k, v in enumerate(fields[:5]):
+        lo |= v << u64(5 + 10 * k)
+    bx = fields[5]
+    lo |= (bx & u64(0x1FF)) << u64(55)
+    hi = bx >> u64(9)
+    hi |= idx[:, 0] << u64(1)
+    for p in range(1, 16):
+        hi |= idx[:, p] << u64(4 * p)
+    return np.stack([lo, hi], axis=-1).astype('<u8').view(np.uint8)
+
+def encode_bc6h(img, np, preset=None, out=None):
+    """(h, w, 3) float -> BC6H_UF16 块数据 (块数, 16)，按块行主序；可传入预分配的 out"""
+    preset = preset or BC6H_PRESET
+    blocks, bh, bw = bc6h_blocks(img, np)
+    x = bc6h_to_domain(blocks, np)
+    if out is None:
+        out = np.empty((len(x), 16), dtype=np.uint8)
+    for b0 in range(0, len(x), BC6H_CHUNK_BLOCKS):
+        out[b0:b0 + BC6H_CHUNK_BLOCKS] = bc6h_encode_blocks(x[b0:b0 + BC6H_CHUNK_BLOCKS], preset, np)
+    return out
+
+def decode_bc6h(data, h, w, np):
+    """只解码本脚本写出的 mode 11 块，用于回读校验，返回 (h, w, 3) float32"""
+    words = data.reshape(-1, 16).view('<u8')
+    lo, hi = words[:, 0], words[:, 1]
+    u64 = np.uint64
+    fields = [(lo >> u64(5 + 10 * k)) & u64(0x3FF) for k in range(5)]
+    fields.append(((lo >> u64(55)) & u64(0x1FF)) | ((hi & u64(1)) << u64(9)))
+    qa = np.stack(fields[:3], axis=-1)
+    qb = np.stack(fields[3:], axis=-1)
+    idx = np.empty((len(lo), 16), dtype=np.int64)
+    idx[:, 0] = (hi >> u64(1)) & u64(0x7)
+    for p in range(1, 16):
+        idx[:, p] = (hi >> u64(4 * p)) & u64(0xF)
+    pal = bc6h_palette(qa, qb, np)
+    vals = np.take_along_axis(pal, idx[:, :, None], axis=1)
+    half = ((vals * 31) >> 6).astype(np.uint16).view(np.float16).astype(np.float32)
+    bh, bw = (h + 3) // 4, (w + 3) // 4
+    img = half.reshape(bh, bw, 4, 4, 3).transpose(0, 2, 1, 3, 4).reshape(bh * 4, bw * 4, 3)
+    return img[:h, :w]
+
+def hdr_psnr(ref, test, np):
+    """在 Reinhard 色调映射后的 [0, 1] 域上算 PSNR，避免高光主导误差"""
+    ref = np.clip(ref, 0.0, 65504.0)
+    test = np.clip(test, 0.0, 65504.0)
+    mse = float(np.mean((ref / (1.0 + ref) - test / (1.0 + test)) ** 2))
+    return float('inf') if mse == 0.0 else 10.0 * math.log10(1.0 / mse)
+
+# ============================================================
+# 32 位打包格式 (R11G11B10_FLOAT / R9G9B9E5_SHAREDEXP)
+# ============================================================
+def float_to_small_float(x, mant_bits, np):
+    """非负 float32 -> 无符号小浮点 (5 位指数, bias 15)，就近舍入到偶数，返回 uint32"""
+    max_val = (2.0 - 2.0 ** -mant_bits) * 32768.0
+    x = np.clip(np.nan_to_num(x, nan=0.0, posinf=max_val), 0.0, max_val).astype(np.float32)
+    bits = x.view(np.uint32)
+    shift = np.uint32(23 - mant_bits)
+    # 正规数: 指数从 bias 127 改到 bias 15，再按舍入到偶数截掉尾数
+    rebased = bits - np.uint32(112 << 23)
+    rounded = (rebased + (np.uint32(1) << (shift - np.uint32(1))) - np.uint32(1) + ((rebased >> shift) & np.uint32(1))) >> shift
+    # 非正规数 (< 2^-14): 直接按最小步长 2^-(14 + mant_bits) 量化
+    denorm = np.rint(np.minimum(x, np.float32(2.0 ** -14)) * np.float32(2.0 ** (14 + mant_bits))).astype(np.uint32)
+    return np.where(bits < np.uint32(0x38800000), denorm, rounded)
+
+def pack_r11g11b10f(mip, out, np):
+    """(h, w, 3) float -> out (h, w) uint32: R 位 0~10, G 位 11~21, B 位 22~31"""
+    np.bitwise_or(float_to_small_float(mip[..., 0], 6, np),
+                  float_to_small_float(mip[..., 1], 6, np) << np.uint32(11), out=out)
+    out |= float_to_small_float(mip[..., 2], 5, np) << np.uint32(22)
+    return out
+
+def pack_rgb9e5(mip, out, np):
+    """(h, w, 3) float -> out (h, w) uint32: 9 位尾数 x3 + 5 位共享指数 (bias 15)"""
+    max_val = 511.0 / 512.0 * 65536.0
+    rgb = np.clip(np.nan_to_num(mip, nan=0.0, posinf=max_val), 0.0, max_val).astype(np.float32)
+    max_c = rgb.max(axis=-1)
+    # frexp: max_c = m * 2^e, m ∈ [0.5, 1)，即 floor(log2(max_c)) = e - 1，无 log2 的舍入误差
+    _, e = np.frexp(np.maximum(max_c, np.float32(2.0 ** -16)))
+    exp_shared = np.maximum(e - 1, -16) + 16
+    scale = np.ldexp(np.float32(1.0), 24 - exp_shared).astype(np.float32)   # 1 / 2^(exp - 15 - 9)
+    # 最大分量舍入后溢出到 512 时指数再加一
+    bump = np.floor(max_c * scale + 0.5) >= 512.0
+    exp_shared = exp_shared + bump
+    scale = np.where(bump, scale * np.float32(0.5), scale)
+    m = np.floor(rgb * scale[..., None] + 0.5).astype(np.uint32)
+    np.bitwise_or(m[..., 0], m[..., 1] << np.uint32(9), out=out)
+    out |= m[..., 2] << np.uint32(18)
+    out |= exp_shared.astype(np.uint32) << np.uint32(27)
+    return out
+
+# ============================================================
+# DDS 写入
+# ============================================================
+# 格式名 -> (DXGI_FORMAT, 是否块压缩)
+DDS_FORMATS = {
+    "rgba16f": (10, False),       # DXGI_FORMAT_R16G16B16A16_FLOAT
+    "bc6h": (95, True),           # DXGI_FORMAT_BC6H_UF16
+    "r11g11b10f": (26, False),    # DXGI_FORMAT_R11G11B10_FLOAT
+    "rgb9e5": (67, False),        # DXGI_FORMAT_R9G9B9E5_SHAREDEXP
+}
+PACKED_32BIT_WRITERS = {
+    "r11g11b10f": pack_r11g11b10f,
+    "rgb9e5": pack_rgb9e5,
+}
+
+def dds_level_nbytes(fmt, mh, mw):
+    if DDS_FORMATS[fmt][1]:
+        return ((mh + 3) // 4) * ((mw + 3) // 4) * 16
+    return mh * mw * (4 if fmt in PACKED_32BIT_WRITERS else 8)
+
+def build_dds_header(width, height, mip_levels, fmt, cube=True):
+    dxgi_format, compressed = DDS_FORMATS[fmt]
     header = bytearray(124)
     struct.pack_into('<I', header, 0, 0x7C)
-    struct.pack_into('<I', header, 4, DDSD_CAPS)
-    struct.pack_into('<I', header, 8, CUBEMAP_SIZE)
-    struct.pack_into('<I', header, 12, CUBEMAP_SIZE)
+    struct.pack_into('<I', header, 4, DDSD_CAPS | (DDSD_LINEARSIZE if compressed else 0))
+    struct.pack_into('<I', header, 8, height)
+    struct.pack_into('<I', header, 12, width)
+    if compressed:
+        struct.pack_into('<I', header, 16, dds_level_nbytes(fmt, height, width))
     struct.pack_into('<I', header, 28, mip_levels)
     struct.pack_into('<I', header, 76, 32)
     struct.pack_into('<I', header, 80, 0x4)
     struct.pack_into('<4s', header, 84, b'DX10')
     struct.pack_into('<I', header, 108, DDSCAPS_COMPLEX)
-    struct.pack_into('<I', header, 112, DDSCAPS2_CUBEMAP_ALLFACES)
+    struct.pack_into('<I', header, 112, DDSCAPS2_CUBEMAP_ALLFACES if cube else 0)
+
+    misc = DDS_RESOURCE_MISC_TEXTURECUBE if cube else 0
+    dx10 = struct.pack('<I I I I I', dxgi_format, DDS_DIMENSION_TEXTURE2D, misc, 1, 0)
+    return DDS_MAGIC + header + dx10
+
+def write_dds_cubemap(out_path, size, mip_levels, levels, np, fmt="rgba16f"):
+    write_dds(out_path, size, size, mip_levels, levels, np, fmt, cube=True)
 
-    # DXGI_FORMAT_R16G16B16A16_FLOAT = 10
-    dx10 = struct.pack('<I I I I I', 10, 3, 4, 1, 0)
+def write_dds(out_path, width, height, mip_levels, levels, np, fmt="rgba16f", cube=False):
+    """流式写入 DX10 cubemap (cube=True) 或单张 2D 纹理
 
+    levels 按 face 主序逐个产出 (face_idx, level, mip)，mip 为 (h, w, 3) float32，2D 纹理的 face_idx 恒为 0。
+    每级都转换进同一块按顶层尺寸预分配的缓冲区，再直接写出，不产生额外拷贝。
+    """
+    buf = np.empty(dds_level_nbytes(fmt, height, width), dtype=np.uint8)
+    psnrs = []
     with open(out_path, 'wb') as f:
-        f.write(DDS_MAGIC + header + dx10)
-        for face_idx in range(6):
-            for mip in faces_mips[face_idx]:
-                mh, mw, mc = mip.shape
-                # 补全 Alpha=1.0
-                alpha = np.ones((mh, mw, 1), dtype=np.float32)
-                rgba = np.concatenate([mip, alpha], axis=-1)
-                f.write(rgba.astype(np.float16).tobytes())
-
-    print("    [√] 成功！")
+        f.write(build_dds_header(width, height, mip_levels, fmt, cube))
+        for face_idx, level, mip in levels:
+            mh, mw, mc = mip.shape
+            view = buf[:dds_level_nbytes(fmt, mh, mw)]
+            if fmt == "bc6h":
+                data = encode_bc6h(mip, np, out=view.reshape(-1, 16))
+                if BC6H_PSNR_CHECK and level == 0:
+                    psnrs.append(hdr_psnr(mip, decode_bc6h(data, mh, mw, np), np))
+            elif fmt in PACKED_32BIT_WRITERS:
+                PACKED_32BIT_WRITERS[fmt](mip, view.view('<u4').reshape(mh, mw), np)
+            else:
+                # 直接写进 half 缓冲区并补全 Alpha=1.0
+                rgba = view.view(np.float16).reshape(mh, mw, 4)
+                rgba[..., :3] = mip
+                rgba[..., 3] = 1.0
+            f.write(view.data)
+
+    if psnrs:
+        print(f"    BC6H ({BC6H_PRESET}) 回读 PSNR (mip0, Reinhard 域): "
+              + " / ".join(f"{p:.1f}" for p in psnrs) + " dB")
+
+# ============================================================
+# DDS 读取 / 校验 (np.memmap，不整体载入文件)
+# ============================================================
+def read_dds(path, np):
+    """映射本脚本写出的 DX10 cubemap 或 2D 纹理，返回 dict:
+
+    width / height / cube / mip_levels / format，以及 faces[face][mip] 的只读 memmap 视图 (2D 纹理只有 1 个 face):
+    rgba16f -> (h, w, 4) float16，r11g11b10f / rgb9e5 -> (h, w) uint32，bc6h -> (块数, 16) uint8
+    结构不合法时抛出 ValueError。
+    """
+    path = pathlib.Path(path)
+    file_size = path.stat().st_size
+    if file_size < 148:
+        raise ValueError(f"文件过小 ({file_size} 字节)")
+    raw = np.memmap(str(path), dtype=np.uint8, mode='r')
+    head = bytes(raw[:148])
+    if head[:4] != DDS_MAGIC:
+        raise ValueError("不是 DDS 文件 (magic 不匹配)")
+    hdr_size, = struct.unpack_from('<I', head, 4)
+    height, width = struct.unpack_from('<II', head, 12)
+    mip_levels, = struct.unpack_from('<I', head, 32)
+    four_cc = head[88:92]
+    caps2, = struct.unpack_from('<I', head, 116)
+    dxgi_format, = struct.unpack_from('<I', head, 128)
+    if hdr_size != 124 or four_cc != b'DX10':
+        raise ValueError("缺少 DX10 扩展头")
+    cube = caps2 & DDSCAPS2_CUBEMAP_ALLFACES == DDSCAPS2_CUBEMAP_ALLFACES
+    if caps2 & DDSCAPS2_CUBEMAP_ALLFACES and not cube:
+        raise ValueError("不是完整的 6 面 cubemap")
+    if width == 0 or height == 0 or (cube and width != height):
+        raise ValueError(f"纹理尺寸异常: {width}x{height}")
+    fmt = next((name for name, (dxgi, _) in DDS_FORMATS.items() if dxgi == dxgi_format), None)
+    if fmt is None:
+        raise ValueError(f"不支持的 DXGI 格式: {dxgi_format}")
+    dims = [(width, height)]
+    while dims[-1] != (1, 1):
+        dims.append((max(1, dims[-1][0] // 2), max(1, dims[-1][1] // 2)))
+    mip_levels = max(1, mip_levels)
+    if mip_levels > len(dims):
+        raise ValueError(f"mip 级数 {mip_levels} 超过尺寸 {width}x{height} 允许的上限")
+
+    num_faces = 6 if cube else 1
+    expected = 148 + num_faces * sum(dds_level_nbytes(fmt, mh, mw) for mw, mh in dims[:mip_levels])
+    if file_size != expected:
+        raise ValueError(f"文件大小 {file_size} 与头信息推算的 {expected} 不符")
+
+    faces = []
+    offset = 148
+    for face_idx in range(num_faces):
+        mips = []
+        for mw, mh in dims[:mip_levels]:
+            nbytes = dds_level_nbytes(fmt, mh, mw)
+            level = raw[offset:offset + nbytes]
+            if fmt == "bc6h":
+                mips.append(level.reshape(-1, 16))
+            elif fmt in PACKED_32BIT_WRITERS:
+                mips.append(level.view('<u4').reshape(mh, mw))
+            else:
+                mips.append(level.view('<f2').reshape(mh, mw, 4))
+            offset += nbytes
+        faces.append(mips)
+    return {"width": width, "height": height, "cube": cube, "mip_levels": mip_levels,
+            "format": fmt, "faces": faces}
+
+def validate_dds(path, np, deep=False):
+    """返回问题列表 (空表示通过)。deep=True 时额外检查 rgba16f 各面 mip0 的 NaN/Inf/负值"""
+    try:
+        dds = read_dds(path, np)
+    except (OSError, ValueError) as e:
+        return [str(e)]
+    problems = []
+    if deep and dds["format"] == "rgba16f":
+        for face_idx, mips in enumerate(dds["faces"]):
+            rgb = mips[0][..., :3]
+            if not np.isfinite(rgb).all():
+                problems.append(f"面 {face_idx} mip0 含 NaN/Inf")
+            elif (rgb < 0).any():
+                problems.append(f"面 {face_idx} mip0 含负值")
+    return problems
+
+def verify_files(files, np, deep=False):
+    bad = 0
+    for f in files:
+        problems = validate_dds(f, np, deep)
+        if problems:
+            bad += 1
+            print(f"[×] {f}: " + "; ".join(problems))
+    print(f"\n[校验完成] 共 {len(files)} 个文件，{bad} 个有问题")
+    return bad
+
+# ============================================================
+# 低内存模式
+# ============================================================
+def use_low_memory(shape):
+    if LOW_MEMORY == "auto":
+        return shape[0] * shape[1] >= LOW_MEMORY_AUTO_PIXELS
+    return bool(LOW_MEMORY)
+
+def spill_to_memmap(img, np):
+    """把解码结果按行分块写进临时文件 (写入时完成 BGR->RGB 和去 alpha)，再以只读 float32 memmap 打开
+
+    直接写文件而不是写 w+ 映射，避免转存期间脏页和解码结果同时常驻。
+    """
+    h, w = img.shape[:2]
+    fd, tmp_path = tempfile.mkstemp(prefix="hdr2cubemap_", suffix=".f32", dir=LOW_MEMORY_TEMP_DIR)
+    rows = max(1, LOW_MEMORY_TILE_PIXELS // w)
+    chunk = np.empty((rows, w, 3), dtype=np.float32)
+    with os.fdopen(fd, 'wb') as f:
+        for r0 in range(0, h, rows):
+            src = img[r0:r0 + rows]
+            dst = chunk[:len(src)]
+            if src.ndim == 2:
+                dst[...] = src[..., None]
+            elif src.shape[2] >= 3:
+                dst[...] = src[..., 2::-1]
+            else:
+                dst[...] = src[..., :1]
+            f.write(dst.data)
+    return np.memmap(tmp_path, dtype=np.float32, mode='r', shape=(h, w, 3)), tmp_path
+
+def spill_padded_level(h, w, tiles, np, cv2):
+    """把一级金字塔的行分块补上环绕列后依次写进临时文件，再以只读 float32 memmap 打开"""
+    fd, tmp_path = tempfile.mkstemp(prefix="hdr2cubemap_mip_", suffix=".f32", dir=LOW_MEMORY_TEMP_DIR)
+    with os.fdopen(fd, 'wb') as f:
+        for tile in tiles:
+            padded = cv2.copyMakeBorder(tile, 0, 0, SEAM_PAD, SEAM_PAD, cv2.BORDER_WRAP)
+            f.write(np.ascontiguousarray(padded, dtype=np.float32).data)
+    return np.memmap(tmp_path, dtype=np.float32, mode='r', shape=(h, w + 2 * SEAM_PAD, 3))
+
+def release_pyramid(pyramid):
+    """删除低内存模式下金字塔落盘的临时文件 (内存中的级别没有 filename，跳过)"""
+    for level in pyramid:
+        tmp_path = getattr(level, "filename", None)
+        if tmp_path:
+            release_memmap(level, tmp_path)
+
+def drop_memmap_pages(img):
+    """让内核回收已读过的映射页，使分块遍历时常驻内存不随遍历进度增长 (非 memmap 时什么也不做)"""
+    mm = getattr(img, "_mmap", None)
+    if mm is not None and hasattr(mm, "madvise") and hasattr(mmap, "MADV_DONTNEED"):
+        mm.madvise(mmap.MADV_DONTNEED)
+
+def release_memmap(mm, tmp_path):
+    # Windows 下映射未关闭时删不掉文件
+    try:
+        mm._mmap.close()
+    except (AttributeError, BufferError):
+        pass
+    try:
+        os.remove(tmp_path)
+    except OSError as e:
+        print(f"    [提示] 临时文件删除失败: {tmp_path} ({e})")
+
+def peak_rss_mb():
+    """进程峰值常驻内存 (MB)，取不到时返回 0"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1048576.0 if sys.platform == "darwin" else 1024.0)
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize / 1048576.0
+    except Exception:
+        return 0.0
+
+def process_file(filepath, np, cv2):
+    path = pathlib.Path(filepath)
+    if not path.exists():
+        print(f"[跳过] 文件不存在: {path}")
+        return False
+        
+    print(f"\n>>> 正在读取: {path.name}")
+
+    try:
+        # 读取 HDR/EXR (flags=-1 等同于 IMREAD_UNCHANGED)
+        img = cv2.imread(str(path), -1)
+        
+        # 如果读取失败，尝试 Numpy workaround (解决中文路径问题)
+        if img is None:
+            img_array = np.fromfile(str(path), dtype=np.uint8)
+            img = cv2.imdecode(img_array, -1)
+            
+        if img is None:
+            print("[错误] 无法解码文件，文件可能已损坏。")
+            return False
+
+        spill_path = None
+        if use_low_memory(img.shape):
+            # 解码结果转存后立即释放，后续不再有整图的 float 拷贝
+            img, spill_path = spill_to_memmap(img, np)
+            print(f"    低内存模式: 已转存到临时 memmap ({img.nbytes / 1048576:.0f} MB)")
+        else:
+            # 通道处理
+            if img.ndim == 2:
+                img = np.stack([img]*3, axis=-1)
+            
+            # OpenCV 默认读 EXR 为 BGR，必须转 RGB
+            if img.shape[2] >= 3:
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+                if img.shape[2] > 3: img = img[..., :3] # 扔掉 alpha
+
+            img = img.astype(np.float32)
+
+    except Exception as e:
+        print(f"[读取异常] {e}")
+        return False
+
+    try:
+        return convert_equirect(img, path, spill_path is not None, np, cv2)
+    finally:
+        if spill_path is not None:
+            release_memmap(img, spill_path)
+
+def convert_equirect(img, path, low_memory, np, cv2):
+    h, w = img.shape[:2]
+    # 先删掉旧输出再写新文件，旧文件可能是指向缓存的硬链接，原地覆盖会改坏缓存
+    for old in output_paths(path).values():
+        if old.exists():
+            old.unlink()
+
+    if EXPORT_SH9:
+        export_sh9(img, path, np)
+    if EXPORT_SAMPLING_TABLES:
+        export_sampling_tables(img, path, np, cv2)
+
+    # --- 采样 + 写入 DDS (逐面流式，同一时刻只保留一个面的 mip 链) ---
+    print(f"    正在计算球面投影 (Projection={PROJECTION}, Size={CUBEMAP_SIZE}, Filter={SAMPLE_FILTER})...")
+    out_path = output_paths(path)["radiance.dds"]
+    out_name = out_path.name
+    print(f"    正在写入 DDS: {out_name}")
+
+    cube = PROJECTION == "cube"
+    if SAMPLE_FILTER in ("bilinear", "bicubic") or not cube:
+        # 2D 投影没有旧版最近邻实现，nearest 直接用 cv2.INTER_NEAREST 查重映射表
+        iter_faces = iter_faces_tiled if low_memory else iter_faces_filtered
+        faces = iter_faces(img, CUBEMAP_SIZE, SAMPLE_FILTER, np, cv2, PROJECTION)
+    else:
+        faces = iter_faces_nearest(img, CUBEMAP_SIZE, np, tiled=low_memory)
+
+    dims = projection_mip_dims(PROJECTION, CUBEMAP_SIZE)
+    if not GENERATE_MIPS:
+        dims = dims[:1]
+    sizes = [mw for mw, mh in dims]
+    ggx = GENERATE_MIPS and MIP_FILTER == "ggx"
+    ggx_times = [0.0] * len(sizes)
+    if ggx:
+        t0 = time.perf_counter()
+        pyramid = build_equirect_pyramid(img, np, cv2, low_memory)
+        drop_memmap_pages(img)
+        ggx_samples = [None] + [ggx_sample_set(pyramid, w, h, level / (len(sizes) - 1), np)
+                                for level in range(1, len(sizes))]
+        print(f"    [GGX] 源金字塔 {len(pyramid)} 级: {time.perf_counter() - t0:.2f}s")
+
+    def levels():
+        for face_idx, face in enumerate(faces):
+            yield face_idx, 0, face
+            curr = face
+            for level in range(1, len(sizes)):
+                mw, mh = dims[level]
+                if ggx:
+                    t0 = time.perf_counter()
+                    if cube:
+                        curr = prefilter_ggx_face(pyramid, ggx_samples[level], face_idx, mw, np, cv2)
+                    else:
+                        n = projection_texel_directions(PROJECTION, mw, mh, np)
+                        curr = prefilter_ggx_directions(pyramid, ggx_samples[level], n, np, cv2)
+                    ggx_times[level] += time.perf_counter() - t0
+                    for src in pyramid:
+                        drop_memmap_pages(src)
+                else:
+                    # Mipmap 生成
+                    curr = cv2.resize(curr, (mw, mh), interpolation=cv2.INTER_LINEAR)
+                yield face_idx, level, curr
+
+    t0 = time.perf_counter()
+    width, height = dims[0]
+    try:
+        write_dds(out_path, width, height, len(sizes), levels(), np, OUTPUT_FORMAT, cube)
+    finally:
+        if ggx:
+            release_pyramid(pyramid)
+    if ggx:
+        for level in range(1, len(sizes)):
+            print(f"    [GGX] mip {level:2d}  {dims[level][0]:4d}x{dims[level][1]:<4d}  "
+                  f"roughness={level / (len(sizes) - 1):.3f}  "
+                  f"samples={PREFILTER_SAMPLES}  {ggx_times[level]:.2f}s")
+    print(f"    [√] 成功！({OUTPUT_FORMAT}, {out_path.stat().st_size / 1048576:.2f} MB, {time.perf_counter() - t0:.2f}s, "
+          f"进程峰值内存 {peak_rss_mb():.0f} MB)")
+    return True
 
 if __name__ == "__main__":
     main_wraper()
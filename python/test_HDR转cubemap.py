@@ -0,0 +1,430 @@
+import importlib.util
+import json
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+_spec = importlib.util.spec_from_file_location(
+    "hdr2cube", os.path.join(os.path.dirname(os.path.abspath(__file__)), "HDR转cubemap.py"))
+hdr2cube = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(hdr2cube)
+
+
+def _log_mse(a, b):
+    return float(np.mean((np.log1p(a) - np.log1p(b)) ** 2))
+
+
+def _bc6h_roundtrip(img, preset):
+    h, w = img.shape[:2]
+    return hdr2cube.decode_bc6h(hdr2cube.encode_bc6h(img, np, preset=preset), h, w, np)
+
+
+def test_bc6h_quality_keeps_high_contrast_block():
+    blk = np.full((4, 4, 3), 0.05, dtype=np.float32)
+    blk[:, 2:] = 20.0
+    for preset in ("fast", "quality"):
+        out = _bc6h_roundtrip(blk, preset)
+        assert np.allclose(out[:, :2], 0.05, rtol=0.05)
+        assert np.allclose(out[:, 2:], 20.0, rtol=0.05)
+
+
+def test_bc6h_quality_no_worse_than_fast_on_hdr_sun():
+    rng = np.random.default_rng(0)
+    img = (rng.random((64, 64, 3)) * 0.5).astype(np.float32)
+    img[20:30, 20:30] = 30000.0
+    img[25:27, :] = 5000.0
+    fast = _log_mse(img, _bc6h_roundtrip(img, "fast"))
+    quality = _log_mse(img, _bc6h_roundtrip(img, "quality"))
+    assert quality <= fast
+
+
+def _fake_outputs(tmp_path, content):
+    src = tmp_path / "sky.hdr"
+    src.write_bytes(b"#?RADIANCE\n")
+    for dst in hdr2cube.output_paths(src).values():
+        dst.write_bytes(content)
+    return src
+
+
+def test_store_in_cache_replaces_corrupt_entry(tmp_path):
+    src = _fake_outputs(tmp_path, b"old")
+    key, params = hdr2cube.cache_key(src)
+    entry_dir = tmp_path / "cache" / "objects" / key
+    hdr2cube.store_in_cache(entry_dir, key, params, src)
+    assert hdr2cube.cache_entry_valid(entry_dir, src)
+
+    # 条目损坏: 删掉一个产物
+    next(p for p in entry_dir.iterdir() if p.name != "entry.json").unlink()
+    assert not hdr2cube.cache_entry_valid(entry_dir, src)
+    src = _fake_outputs(tmp_path, b"new build")
+    hdr2cube.store_in_cache(entry_dir, key, params, src)
+    assert hdr2cube.cache_entry_valid(entry_dir, src)
+    assert all((entry_dir / role).read_bytes() == b"new build" for role in hdr2cube.output_paths(src))
+
+
+def test_store_in_cache_keeps_valid_entry(tmp_path):
+    src = _fake_outputs(tmp_path, b"first")
+    key, params = hdr2cube.cache_key(src)
+    entry_dir = tmp_path / "cache" / "objects" / key
+    hdr2cube.store_in_cache(entry_dir, key, params, src)
+    src = _fake_outputs(tmp_path, b"second")
+    hdr2cube.store_in_cache(entry_dir, key, params, src)
+    assert all((entry_dir / role).read_bytes() == b"first" for role in hdr2cube.output_paths(src))
+    assert sorted(p.name for p in entry_dir.parent.iterdir()) == [key]
+
+
+def test_restore_from_cache_evicts_truncated_entry(tmp_path):
+    src = _fake_outputs(tmp_path, b"cached output")
+    key, params = hdr2cube.cache_key(src)
+    entry_dir = tmp_path / "cache" / "objects" / key
+    hdr2cube.store_in_cache(entry_dir, key, params, src)
+    entry = json.loads((entry_dir / "entry.json").read_text(encoding="utf-8"))
+    outputs = hdr2cube.output_paths(src)
+    for dst in outputs.values():
+        dst.unlink()
+    assert hdr2cube.restore_from_cache(entry_dir, entry, src)
+    assert all(dst.read_bytes() == b"cached output" for dst in outputs.values())
+
+    # 文件都在但被截断: 只查存在性会把坏文件放回去
+    (entry_dir / "radiance.dds").write_bytes(b"cached")
+    for dst in outputs.values():
+        dst.unlink()
+    assert not hdr2cube.restore_from_cache(entry_dir, entry, src)
+    assert not entry_dir.exists() and not list(entry_dir.parent.iterdir())
+    assert not any(dst.exists() for dst in outputs.values())
+
+
+@pytest.mark.parametrize("projection", ["cube", "octahedral"])
+def test_remap_cache_name_has_version_and_projection(monkeypatch, tmp_path, projection):
+    monkeypatch.setattr(hdr2cube, "REMAP_CACHE_DIR", tmp_path)
+    monkeypatch.setattr(hdr2cube, "_remap_tables", {})
+    fresh = hdr2cube.get_remap_tables(8, 64, 32, np, projection)
+    (cache_file,) = tmp_path.glob("*.npy")
+    assert cache_file.name.startswith(f"remap_v{hdr2cube.REMAP_CACHE_VERSION}_{projection}_8_")
+
+    # 形状对得上的旧表: 同版本照用，换版本后不再命中
+    np.save(str(cache_file), np.zeros_like(fresh))
+    hdr2cube._remap_tables.clear()
+    assert not hdr2cube.get_remap_tables(8, 64, 32, np, projection).any()
+    monkeypatch.setattr(hdr2cube, "REMAP_CACHE_VERSION", hdr2cube.REMAP_CACHE_VERSION + 1)
+    hdr2cube._remap_tables.clear()
+    assert np.array_equal(hdr2cube.get_remap_tables(8, 64, 32, np, projection), fresh)
+
+
+def _convert_bytes(monkeypatch, tmp_path, bgr, low_memory, projection, sample_filter):
+    monkeypatch.setattr(hdr2cube, "PROJECTION", projection)
+    monkeypatch.setattr(hdr2cube, "SAMPLE_FILTER", sample_filter)
+    src = tmp_path / f"{'low' if low_memory else 'ram'}_{projection}_{sample_filter}.hdr"
+    if low_memory:
+        img, spill_path = hdr2cube.spill_to_memmap(bgr, np)
+        try:
+            assert hdr2cube.convert_equirect(img, src, True, np, cv2)
+        finally:
+            hdr2cube.release_memmap(img, spill_path)
+    else:
+        assert hdr2cube.convert_equirect(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB), src, False, np, cv2)
+    return hdr2cube.output_paths(src)["radiance.dds"].read_bytes()
+
+
+@pytest.mark.parametrize("projection", ["cube", "octahedral", "paraboloid"])
+@pytest.mark.parametrize("sample_filter", ["nearest", "bilinear", "bicubic"])
+@pytest.mark.parametrize("size", [32, 64])
+def test_low_memory_matches_in_memory(monkeypatch, tmp_path, projection, sample_filter, size):
+    monkeypatch.setattr(hdr2cube, "REMAP_CACHE_DIR", tmp_path / "remap")
+    monkeypatch.setattr(hdr2cube, "LOW_MEMORY_TEMP_DIR", str(tmp_path))
+    monkeypatch.setattr(hdr2cube, "LOW_MEMORY_TILE_PIXELS", 1 << 10)
+    monkeypatch.setattr(hdr2cube, "CUBEMAP_SIZE", size)
+    monkeypatch.setattr(hdr2cube, "MIP_FILTER", "ggx")
+    monkeypatch.setattr(hdr2cube, "PREFILTER_SAMPLES", 8)
+    bgr = (np.random.default_rng(0).random((128, 256, 3)) * 10).astype(np.float32)
+    ram = _convert_bytes(monkeypatch, tmp_path, bgr, False, projection, sample_filter)
+    low = _convert_bytes(monkeypatch, tmp_path, bgr, True, projection, sample_filter)
+    assert ram == low
+    # 金字塔的临时文件和转存文件都已删除
+    assert not list(tmp_path.glob("hdr2cubemap_*"))
+
+
+def test_low_memory_pyramid_matches_in_memory(monkeypatch):
+    monkeypatch.setattr(hdr2cube, "LOW_MEMORY_TILE_PIXELS", 1 << 8)
+    rng = np.random.default_rng(1)
+    for h, w in ((128, 256), (101, 203), (64, 130)):
+        img = rng.random((h, w, 3), dtype=np.float32)
+        ram = hdr2cube.build_equirect_pyramid(img, np, cv2)
+        low = hdr2cube.build_equirect_pyramid(img, np, cv2, low_memory=True)
+        try:
+            assert len(ram) == len(low)
+            assert all(np.array_equal(a, np.asarray(b)) for a, b in zip(ram, low))
+        finally:
+            hdr2cube.release_pyramid(low)
+
+
+def _sampling_tables(monkeypatch, tmp_path, img, tile_pixels, name):
+    monkeypatch.setattr(hdr2cube, "LOW_MEMORY_TILE_PIXELS", tile_pixels)
+    src = tmp_path / f"{name}.hdr"
+    hdr2cube.export_sampling_tables(img, src, np, cv2)
+    return hdr2cube.read_sampling_tables(hdr2cube.output_paths(src)["envsampling.bin"], np)
+
+
+@pytest.mark.parametrize("max_width", [0, 64, 100])
+def test_sampling_tables_stream_from_memmap(monkeypatch, tmp_path, max_width):
+    monkeypatch.setattr(hdr2cube, "EXPORT_SAMPLING_TABLES", True)
+    monkeypatch.setattr(hdr2cube, "SAMPLING_TABLE_MAX_WIDTH", max_width)
+    monkeypatch.setattr(hdr2cube, "LOW_MEMORY_TEMP_DIR", str(tmp_path))
+    bgr = (np.random.default_rng(2).random((101, 256, 3)) ** 4 * 10).astype(np.float32)
+    img, spill_path = hdr2cube.spill_to_memmap(bgr, np)
+    try:
+        ram = _sampling_tables(monkeypatch, tmp_path, cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB), 1 << 30, "ram")
+        low = _sampling_tables(monkeypatch, tmp_path, img, 1 << 9, "low")
+    finally:
+        hdr2cube.release_memmap(img, spill_path)
+    assert (low["width"], low["height"]) == (ram["width"], ram["height"])
+    for name, _, _ in hdr2cube.SAMPLING_SECTIONS:
+        if max_width:
+            # 分块面积降采样与整块只差浮点求和顺序
+            assert np.allclose(low[name], ram[name], rtol=1e-5, atol=1e-7), name
+        else:
+            assert np.array_equal(low[name], ram[name]), name
+
+
+def _alias_pdf(prob, alias, np):
+    """alias 表每行还原出的离散分布: 自身 prob/n，加上所有指向它的槽位的 (1-prob)/n"""
+    rows, n = prob.shape
+    pdf = prob.astype(np.float64) / n
+    for r in range(rows):
+        np.add.at(pdf[r], alias[r], (1.0 - prob[r].astype(np.float64)) / n)
+    return pdf
+
+
+def test_sampling_tables_invariants(monkeypatch, tmp_path):
+    monkeypatch.setattr(hdr2cube, "EXPORT_SAMPLING_TABLES", True)
+    monkeypatch.setattr(hdr2cube, "SAMPLING_TABLE_MAX_WIDTH", 0)
+    rgb = (np.random.default_rng(3).random((24, 48, 3)) ** 6 * 50).astype(np.float32)
+    rgb[5] = 0.0  # 全零行: 条件分布退化为均匀
+    t = _sampling_tables(monkeypatch, tmp_path, rgb, 1 << 8, "inv")
+    h, w = t["height"], t["width"]
+    pmf = t["pmf"].astype(np.float64)
+    assert np.isclose(pmf.sum(), 1.0, atol=1e-5)
+    assert not pmf[5].any()
+
+    for cdf in (t["marginal_cdf"][None, :], t["conditional_cdf"]):
+        assert np.all(cdf[:, 0] == 0.0) and np.allclose(cdf[:, -1], 1.0)
+        assert np.all(np.diff(cdf, axis=-1) >= 0)
+    row_pdf = pmf.sum(axis=-1)
+    assert np.allclose(np.diff(t["marginal_cdf"]), row_pdf, atol=1e-6)
+    cond_pdf = np.where(row_pdf[:, None] > 0, pmf / np.maximum(row_pdf[:, None], 1e-30), 1.0 / w)
+    assert np.allclose(np.diff(t["conditional_cdf"], axis=-1), cond_pdf, atol=1e-5)
+
+    assert np.allclose(_alias_pdf(t["marginal_alias_prob"][None, :], t["marginal_alias_idx"][None, :], np)[0],
+                       row_pdf, atol=1e-6)
+    assert np.all(t["conditional_alias_idx"] < w)
+    assert np.allclose(_alias_pdf(t["conditional_alias_prob"], t["conditional_alias_idx"], np),
+                       cond_pdf, atol=1e-5)
+
+
+def test_output_names_follow_projection(monkeypatch, tmp_path):
+    monkeypatch.setattr(hdr2cube, "EXPORT_SH9", True)
+    monkeypatch.setattr(hdr2cube, "SH_IRRADIANCE_CUBE_SIZE", 8)
+    monkeypatch.setattr(hdr2cube, "EXPORT_SAMPLING_TABLES", True)
+    names = {}
+    for projection, prefix in hdr2cube.PROJECTION_PREFIXES.items():
+        monkeypatch.setattr(hdr2cube, "PROJECTION", projection)
+        paths = hdr2cube.output_paths(tmp_path / "sky.hdr")
+        assert all(p.name.startswith(f"{prefix}_sky_") for p in paths.values())
+        names[projection] = {p.name for p in paths.values()}
+    assert not names["cube"] & names["octahedral"] and not names["cube"] & names["paraboloid"]
+
+
+def test_filter_flag_overrides_sample_filter(monkeypatch, tmp_path):
+    assert hdr2cube.SAMPLE_FILTER == "bilinear"
+    monkeypatch.setattr(hdr2cube, "SAMPLE_FILTER", hdr2cube.SAMPLE_FILTER)
+    # 空目录: 解析完参数后直接 "[跳过]"，不做转换
+    monkeypatch.setattr(sys, "argv", ["HDR转cubemap.py", "--filter", "nearest", str(tmp_path)])
+    hdr2cube.real_main()
+    assert hdr2cube.SAMPLE_FILTER == "nearest"
+
+
+def _unit_directions(n, seed):
+    vec = np.random.default_rng(seed).normal(size=(n, 3))
+    return vec / np.linalg.norm(vec, axis=-1, keepdims=True)
+
+
+def test_sh9_constant_and_linear_environments():
+    h, w = 64, 128
+    lat = (0.5 - (np.arange(h) + 0.5) / h) * np.pi
+    y = np.broadcast_to(np.sin(lat)[:, None, None], (h, w, 3))
+    n = _unit_directions(256, 0)
+    basis = hdr2cube.sh9_basis(n, np)
+
+    # 常数环境: 只有 Y00 非零，Lambert 出射辐亮度 (反照率 1) 处处等于环境值
+    env = np.full((h, w, 3), 2.5, dtype=np.float32)
+    radiance = hdr2cube.project_sh9(env, np)
+    assert np.allclose(radiance[0], 2.5 * 0.282095 * 4 * np.pi, rtol=1e-3)
+    assert np.abs(radiance[1:]).max() < 1e-3 * radiance[0, 0]  # 只剩经纬网格的求积误差
+    assert np.allclose(basis @ hdr2cube.sh9_irradiance_coeffs(radiance, np), 2.5, rtol=1e-3)
+
+    # L = 1 + y: 余弦卷积后 l=1 项乘 2/3
+    radiance = hdr2cube.project_sh9((1.0 + y).astype(np.float32), np)
+    expected = 1.0 + 2.0 / 3.0 * n[:, 1:2]
+    assert np.allclose(basis @ hdr2cube.sh9_irradiance_coeffs(radiance, np), expected, atol=2e-3)
+
+
+def _small_float_to_float(bits, mant_bits):
+    e = (bits >> mant_bits).astype(np.int32)
+    m = (bits & ((1 << mant_bits) - 1)).astype(np.float64)
+    return np.where(e == 0, m * 2.0 ** (-14 - mant_bits), (1.0 + m / 2 ** mant_bits) * np.exp2(e - 15.0))
+
+
+def _unpack_r11g11b10f(packed):
+    return np.stack([_small_float_to_float(packed & 0x7FF, 6),
+                     _small_float_to_float((packed >> 11) & 0x7FF, 6),
+                     _small_float_to_float(packed >> 22, 5)], axis=-1)
+
+
+def _unpack_rgb9e5(packed):
+    scale = np.exp2((packed >> 27).astype(np.float64) - 24.0)
+    return np.stack([(packed >> shift) & 0x1FF for shift in (0, 9, 18)], axis=-1) * scale[..., None]
+
+
+def _hdr_samples():
+    """跨越非正规数、正规数、格式上限附近的非负 HDR 值，外加几个精确可表示的边界值"""
+    rng = np.random.default_rng(4)
+    rgb = np.exp2(rng.uniform(-20.0, 16.5, (64, 64, 3))).astype(np.float32)
+    rgb[0, :4] = [[0, 0, 0], [2.0 ** -14] * 3, [1, 1, 1], [65024, 65024, 64512]]
+    return rgb
+
+
+def test_r11g11b10f_round_trip_error_bound():
+    rgb = _hdr_samples()
+    out = _unpack_r11g11b10f(hdr2cube.pack_r11g11b10f(rgb, np.empty(rgb.shape[:2], np.uint32), np))
+    for c, mant_bits in enumerate((6, 6, 5)):
+        max_val = (2.0 - 2.0 ** -mant_bits) * 32768.0
+        ref = np.minimum(rgb[..., c].astype(np.float64), max_val)
+        # 正规数相对误差不超过半个 ulp，非正规数绝对误差不超过半个最小步长
+        bound = np.maximum(ref * 2.0 ** -(mant_bits + 1), 2.0 ** -(15 + mant_bits))
+        assert np.all(np.abs(out[..., c] - ref) <= bound)
+    assert np.array_equal(out[0, :4], [[0, 0, 0], [2.0 ** -14] * 3, [1, 1, 1], [65024, 65024, 64512]])
+
+
+def test_rgb9e5_round_trip_error_bound():
+    rgb = _hdr_samples()
+    rgb[1, 0] = [1.0, 1e-6, 300.0]  # 共享指数下小分量被量化掉
+    out = _unpack_rgb9e5(hdr2cube.pack_rgb9e5(rgb, np.empty(rgb.shape[:2], np.uint32), np))
+    ref = np.minimum(rgb.astype(np.float64), 511.0 / 512.0 * 65536.0)
+    # 误差不超过共享指数下半个量化步长: 步长 <= 最大分量 / 256，最小指数时为 2^-24
+    bound = np.maximum(ref.max(axis=-1) * 2.0 ** -9, 2.0 ** -25)[..., None]
+    assert np.all(np.abs(out - ref) <= bound)
+    assert np.array_equal(out[0, :3], [[0, 0, 0], [2.0 ** -14] * 3, [1, 1, 1]])
+
+
+def _write_test_dds(path, fmt, cube, width, height):
+    """按 face 主序写满整条 mip 链，返回写进去的 mips[face][level]"""
+    rng = np.random.default_rng(5)
+    dims = [(width, height)]
+    while dims[-1] != (1, 1):
+        dims.append((max(1, dims[-1][0] // 2), max(1, dims[-1][1] // 2)))
+    mips = [[(rng.random((mh, mw, 3)) * 8).astype(np.float32) for mw, mh in dims] for _ in range(6 if cube else 1)]
+    levels = ((face, level, mip) for face, chain in enumerate(mips) for level, mip in enumerate(chain))
+    hdr2cube.write_dds(path, width, height, len(dims), levels, np, fmt, cube)
+    return mips
+
+
+@pytest.mark.parametrize("fmt", ["rgba16f", "r11g11b10f", "rgb9e5", "bc6h"])
+@pytest.mark.parametrize("cube, width, height", [(True, 16, 16), (False, 32, 16)])
+def test_read_dds_round_trip(tmp_path, fmt, cube, width, height):
+    path = tmp_path / f"{fmt}.dds"
+    mips = _write_test_dds(path, fmt, cube, width, height)
+    dds = hdr2cube.read_dds(path, np)
+    assert (dds["width"], dds["height"], dds["cube"], dds["format"]) == (width, height, cube, fmt)
+    assert dds["mip_levels"] == len(mips[0]) and len(dds["faces"]) == len(mips)
+    assert hdr2cube.validate_dds(path, np, deep=True) == []
+    for chain, stored in zip(mips, dds["faces"]):
+        for mip, level in zip(chain, stored):
+            mh, mw = mip.shape[:2]
+            if fmt == "rgba16f":
+                assert np.array_equal(level[..., :3], mip.astype(np.float16)) and np.all(level[..., 3] == 1.0)
+            elif fmt == "bc6h":
+                assert np.array_equal(level, hdr2cube.encode_bc6h(mip, np).reshape(-1, 16))
+            else:
+                packed = hdr2cube.PACKED_32BIT_WRITERS[fmt](mip, np.empty((mh, mw), np.uint32), np)
+                assert np.array_equal(level, packed)
+
+
+def test_validate_dds_reports_broken_files(tmp_path):
+    good = tmp_path / "good.dds"
+    _write_test_dds(good, "rgba16f", True, 8, 8)
+    data = good.read_bytes()
+
+    truncated = tmp_path / "truncated.dds"
+    truncated.write_bytes(data[:-2])
+    assert any("文件大小" in p for p in hdr2cube.validate_dds(truncated, np))
+    not_dds = tmp_path / "not.dds"
+    not_dds.write_bytes(b"XXXX" + data[4:])
+    assert any("magic" in p for p in hdr2cube.validate_dds(not_dds, np))
+    tiny = tmp_path / "tiny.dds"
+    tiny.write_bytes(data[:100])
+    assert hdr2cube.validate_dds(tiny, np)
+
+    # mip0 第一个纹素写成 NaN (float16 0x7E00)，只有 deep 检查会发现
+    nan = bytearray(data)
+    nan[148:150] = b"\x00\x7e"
+    bad = tmp_path / "nan.dds"
+    bad.write_bytes(bytes(nan))
+    assert hdr2cube.validate_dds(bad, np) == []
+    assert hdr2cube.validate_dds(bad, np, deep=True) == ["面 0 mip0 含 NaN/Inf"]
+
+
+def _octahedral_encode(vec):
+    """着色器里常用的八面体编码，应是 octahedral_directions 的逆"""
+    p = vec / np.abs(vec).sum(axis=-1, keepdims=True)
+    s, y, t = p[..., 0], p[..., 1], p[..., 2]
+    sign_s, sign_t = np.where(s >= 0, 1.0, -1.0), np.where(t >= 0, 1.0, -1.0)
+    return np.where(y < 0, (1.0 - np.abs(t)) * sign_s, s), np.where(y < 0, (1.0 - np.abs(s)) * sign_t, t)
+
+
+def _paraboloid_encode(vec):
+    """返回 (s, t, 半球)；半球 +1 为左半张 (+Y)，-1 为右半张 (-Y)"""
+    hemisphere = np.where(vec[..., 1] >= 0, 1.0, -1.0)
+    denom = 1.0 + np.abs(vec[..., 1])
+    return vec[..., 0] / denom, vec[..., 2] / denom, hemisphere
+
+
+def _texel_index(coord, n):
+    return np.floor((coord + 1.0) * 0.5 * n).astype(int)
+
+
+def test_octahedral_directions_invert_encoding():
+    vec = _unit_directions(4096, 6)
+    s, t = _octahedral_encode(vec)
+    assert np.allclose(hdr2cube.octahedral_directions(s, t, np), vec, atol=1e-6)
+
+    # 每个纹素中心的方向编码回来还落在同一个纹素里
+    size = 16
+    dirs = hdr2cube.projection_texel_directions("octahedral", size, size, np).astype(np.float64)
+    assert np.allclose(np.linalg.norm(dirs, axis=-1), 1.0, atol=1e-6)
+    s, t = _octahedral_encode(dirs)
+    rows, cols = np.mgrid[:size, :size]
+    assert np.array_equal(_texel_index(s, size), cols) and np.array_equal(_texel_index(t, size), rows)
+
+
+def test_paraboloid_directions_invert_encoding():
+    vec = _unit_directions(4096, 7)
+    s, t, hemisphere = _paraboloid_encode(vec)
+    assert np.all(s * s + t * t <= 1.0 + 1e-9)
+    for hemi in (1.0, -1.0):
+        sel = hemisphere == hemi
+        assert np.allclose(hdr2cube.paraboloid_directions(s[sel], t[sel], hemi, np), vec[sel], atol=1e-6)
+
+    size = 16
+    dirs = hdr2cube.projection_texel_directions("paraboloid", 2 * size, size, np).astype(np.float64)
+    assert dirs.shape == (size, 2 * size, 3)
+    assert np.all(dirs[:, :size, 1] >= 0) and np.all(dirs[:, size:, 1] <= 0)
+    s, t, hemisphere = _paraboloid_encode(dirs)
+    rows, cols = np.mgrid[:size, :2 * size]
+    centre = ((cols % size + 0.5) / size * 2 - 1) ** 2 + ((rows + 0.5) / size * 2 - 1) ** 2
+    inside = centre < 1.0  # 圆外纹素被钳到地平线上，不可逆
+    assert np.array_equal(_texel_index(s, size)[inside], (cols % size)[inside])
+    assert np.array_equal(_texel_index(t, size)[inside], rows[inside])
+    assert np.array_equal((hemisphere < 0)[inside], (cols >= size)[inside])